@@ -26,7 +26,7 @@ class Command(BaseCommand):
         
         with TemporaryDirectory() as tmp:
             logger.info('Downloading latest production backup...')
-            db_path, log_path, tunes_path = backup.download_latest_production_backup(to_dir=tmp)
+            db_path, log_path, tune_store_path = backup.download_latest_production_backup(to_dir=tmp)
             
             logger.info('Applying database...')
             with tarfile.open(name=db_path, mode='r:bz2') as tar:
@@ -38,8 +38,18 @@ class Command(BaseCommand):
             with tarfile.open(name=log_path, mode='r:bz2') as tar:
                 tar.extractall(path='/')
             
-            logger.info('Applying tune...')
-            with tarfile.open(name=tunes_path, mode='r:bz2') as tar:
+            logger.info('Applying tune store...')
+            with tarfile.open(name=tune_store_path, mode='r:bz2') as tar:
                 tar.extractall(path='/')
+            # The index may have been archived before or after the segments it indexes
+            call_command('migratetunestore', rebuild_index=True)
+            
+            # Tunes from before the tune store, if not yet moved into it when backed up
+            legacy_tunes_path = backup.download_latest_production_legacy_tunes(to_dir=tmp)
+            if legacy_tunes_path:
+                logger.info('Applying tunes from before the tune store...')
+                with tarfile.open(name=legacy_tunes_path, mode='r:bz2') as tar:
+                    tar.extractall(path='/')
+                call_command('migratetunestore', delete=True)
         
         logger.info('Apply Backup finished.')
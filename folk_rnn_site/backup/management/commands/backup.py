@@ -52,7 +52,10 @@ class Command(BaseCommand):
         logger.info('Backup starting.')
         
         logger.info('Backing up tunes...')
-        self.archive_store_folder('/var/opt/folk_rnn_task/tunes')
+        self.archive_store_folder('/var/opt/folk_rnn_task/tune_store')
+        # Tunes from before the tune store, until moved by migratetunestore
+        if os.listdir('/var/opt/folk_rnn_task/tunes'):
+            self.archive_store_folder('/var/opt/folk_rnn_task/tunes')
         logger.info('Backing up logs...')
         self.archive_store_folder('/var/log/folk_rnn_webapp/')
         logger.info('Backing up database...')
@@ -212,7 +215,7 @@ class Command(BaseCommand):
         names = [
             ['db_data_backup_production_', None, None],
             ['folk_rnn_webapp_backup_production_', None, None],
-            ['tunes_backup_production_', None, None],
+            ['tune_store_backup_production_', None, None],
             ]
             
         # relies on _list_stored_files's newest-first ordering request
@@ -228,6 +231,20 @@ class Command(BaseCommand):
                     name.append(download_path)
                 break
         return ([x[3] for x in names])
+    
+    def download_latest_production_legacy_tunes(self, to_dir=''):
+        '''
+        Download the latest archive of the tunes' files from before the tune store, if any.
+        Returns the path downloaded to, or None.
+        '''
+        prefix = 'tunes_backup_production_'
+        drive_list = self.drive.files().list(q=f"name contains '{prefix}'", orderBy='createdTime desc').execute()
+        for meta in drive_list['files']:
+            if meta['name'].startswith(prefix):
+                download_path = os.path.join(to_dir, meta['name'])
+                self.download_file(meta['id'], download_path)
+                return download_path
+        return None
                     
     def delete_file(self, file_id):
         """
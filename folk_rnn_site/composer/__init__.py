@@ -8,11 +8,87 @@ ABC2ABC_PATH = '/usr/bin/abc2abc'
 
 # folk_rnn task
 
-FOLKRNN_INSTANCE_CACHE_COUNT = 2
+# Model instances are cached per worker up to this many bytes of weights, evicting the least requested.
+FOLKRNN_INSTANCE_CACHE_BYTES = 1024 * 1024 * 1024
+
+# Models never evicted, e.g. ['thesession_with_repeats.pickle']
+FOLKRNN_INSTANCE_CACHE_PINNED = []
+
+# Pending tunes for the same model are generated together, up to this many at once, by composer.inference.FolkRNNBatch
+# whatever FOLKRNN_ENGINE. 1 generates each tune alone, with FOLKRNN_ENGINE. Check FolkRNNParityTest passes, i.e. with
+# the folk_rnn library installed, before raising it.
+FOLKRNN_BATCH_SIZE = 1
+
+# Tunes requested while a batch generates join it at the next step, with the batch looking for them at most every 
+# this many milliseconds. While a step takes longer than the target the batch doesn't grow, keeping tokens streaming.
+FOLKRNN_BATCH_ADMIT_MS = 100
+FOLKRNN_BATCH_STEP_TARGET_MS = 50
+
+# Generating one tune at a time, 'folk_rnn' uses the folk_rnn library, 'composer' the equivalent in composer.inference
+FOLKRNN_ENGINE = 'folk_rnn'
+
+# The composer engines cache the LSTM state having read a prime, up to this many per model, prewarmed 
+# with every meter and key combination on loading the model. 0 disables.
+FOLKRNN_PREFIX_CACHE_SIZE = 1024
+
+# Model weights are 'float32', 'float16' or 'int8', i.e. quantized per row, or 'full' as trained. 
+# Reduced precision is computed in float32 by the composer engines. See composer.precision and the
+# convertmodels and evaluateprecision management commands.
+FOLKRNN_PRECISION = 'float32'
+
+# A session has at most this many tunes generating, its others waiting their turn, see job_queue. 0 for no cap.
+FOLKRNN_SESSION_MAX_IN_FLIGHT = 4
+
+# Websockets waiting for a tune to start are sent its place in the queue, at most every this many milliseconds.
+FOLKRNN_QUEUE_STATUS_MS = 1000
+
+# Admission control. A compose request estimated to wait over this many seconds to start generating is deferred, 
+# i.e. generated after the requests within it, or with FOLKRNN_ADMISSION_REFUSE, refused. None admits every request.
+FOLKRNN_ADMISSION_MAX_WAIT = None
+FOLKRNN_ADMISSION_REFUSE = False
+
+# A worker looks for generations cancelled, i.e. nobody listening, at most every this many milliseconds.
+FOLKRNN_CANCEL_POLL_MS = 250
+
+# The most tunes a compose_many command may request, i.e. variations of one compose with different seeds
+FOLKRNN_COMPOSE_MANY_MAX = 16
+
+# A worker leases the tunes it generates, renewing the lease as it goes. A tune whose lease expires, i.e. its worker
+# died or hung, goes back in the queue, and after this many attempts fails. See job_queue.sweep
+FOLKRNN_LEASE_SECONDS = 60
+FOLKRNN_MAX_ATTEMPTS = 3
+
+# Idle workers pre-generate tunes for each model's default compose parameters, and the FOLKRNN_POOL_POPULAR parameters 
+# most requested over FOLKRNN_POOL_POPULAR_DAYS, so a compose with an auto seed is served at once. A parameter set's pool
+# below FOLKRNN_POOL_LOW tunes is refilled to FOLKRNN_POOL_HIGH, while no other tunes are waiting. See tune_pool
+FOLKRNN_POOL_LOW = 2
+FOLKRNN_POOL_HIGH = 8
+FOLKRNN_POOL_POPULAR = 3
+FOLKRNN_POOL_POPULAR_DAYS = 7
+
+# Identical requests attach to a generation in progress. Its worker looks for them every this many tokens.
+FOLKRNN_FOLLOWER_POLL_TOKENS = 32
+
+# A generating tune's abc updates are broadcast every this many tokens, after this many milliseconds,
+# or on a bar line, whichever comes first. Finishing a tune always flushes. 1 token broadcasts every token.
+FOLKRNN_FLUSH_TOKENS = 16
+FOLKRNN_FLUSH_MS = 250
+FOLKRNN_FLUSH_ON_BAR = True
+
+# The tunes' raw output and ABC are appended to segment files of about this many bytes. See tune_store
+FOLKRNN_TUNE_SEGMENT_BYTES = 64 * 1024 * 1024
+
+# Models with workers of their own, i.e. generation requests go to the model's channel, e.g. 'folk_rnn.swedish',
+# overflowing to the shared 'folk_rnn' channel when full. Workers for a model run `runworker folk_rnn.<model> folk_rnn`,
+# see tools/systemd/worker-folkrnn-model@.service. Other models' requests go to the shared channel.
+# e.g. ['thesession_with_repeats.pickle', 'thesession_without_repeats.pickle', 'swedish.pickle']
+FOLKRNN_MODEL_CHANNELS = []
 
 STORE_PATH = '/var/opt/folk_rnn_task'
 MODEL_PATH = os.path.join(STORE_PATH, 'models')
 TUNE_PATH = os.path.join(STORE_PATH, 'tunes')
+TUNE_STORE_PATH = os.path.join(STORE_PATH, 'tune_store')
+STREAM_PATH = os.path.join(STORE_PATH, 'streams')
 
 FOLKRNN_TUNE_TITLE = None
 FOLKRNN_TUNE_TITLE_CLIENT = 'Folk RNN Tune №'
@@ -27,18 +103,12 @@ try:
 except OSError:
     pass
 
-# import here as rnn_models imports above constants
-from .rnn_models import models_json
-static_path = os.path.join(os.path.dirname(__file__), 'static')
-with open(os.path.join(static_path, 'folk_rnn_models.js'), 'w') as f:
-    js =  '// Auto-generated by composer package \n'
-    js += '// See __init__.py, rnn_models.py \n'
-    js += ' \n'
-    js += 'if (typeof folkrnn == "undefined") \n'
-    js += '    folkrnn = {}; \n'
-    js += ' \n'
-    js += f'folkrnn.tuneTitle = "{FOLKRNN_TUNE_TITLE_CLIENT}"; \n'
-    js += f'folkrnn.maxSeed = {FOLKRNN_MAX_SEED}; \n'
-    js += 'folkrnn.models = ' + models_json() + '; \n'
-    f.write(js)
-    
\ No newline at end of file
+try:
+    os.makedirs(STREAM_PATH)
+except OSError:
+    pass
+
+try:
+    os.makedirs(TUNE_STORE_PATH)
+except OSError:
+    pass
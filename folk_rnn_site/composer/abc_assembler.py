@@ -0,0 +1,76 @@
+'''
+A tune's ABC, built from folk-rnn's tokens as they are generated. See ABCAssembler
+'''
+from composer import FOLKRNN_TUNE_TITLE
+
+# Info fields of the header, in the order they are written, the first two required
+HEADER_FIELDS = ['M:', 'K:', 'L:']
+REQUIRED_FIELDS = ['M:', 'K:']
+
+class ABCAssembler:
+    '''
+    Builds a tune's ABC a token at a time. Each token appended returns the ABC new since the
+    last, i.e. the delta to stream, `seq` being the length of the ABC streamed so far.
+
+    The ABC is kept as parts, joined only for a snapshot, i.e. appending is amortised O(1).
+    '''
+    def __init__(self, tune_id, title=FOLKRNN_TUNE_TITLE):
+        head = f'X:{tune_id}\n'
+        if title:
+            head += f'T:{title}{tune_id}\n'
+        self.parts = [head]
+        self.unsent = [head]
+        self.seq = 0
+        self.in_header = True
+        self.header = {} # field: its first token
+
+    def append(self, token):
+        '''
+        Add the token, returning the ABC new since the last token, i.e. '' if none.
+        '''
+        # Ensure valid ABC
+        # - In header, have M (req), K, (req), L (opt) info fields on new lines, in that order.
+        # - In body, any info field should be in square brackets, if it's not already.
+        # This code tries its best to cope with ill-formed ABC produced by folk-rnn, i.e. probablistic ordering.
+        # Further complicating things, info-fields have to be modelled as either header or in-line, and this hasn't been done consistently between models
+        if self.in_header:
+            field = token.strip('[]')
+            if field[0:2] in HEADER_FIELDS:
+                self.header.setdefault(field[0:2], field)
+            else:
+                self.in_header = False
+                for name in HEADER_FIELDS:
+                    if name in self.header:
+                        self.add(self.header[name] + '\n')
+                    elif name in REQUIRED_FIELDS:
+                        self.add(name + 'none\n')
+        if not self.in_header:
+            if token[0:2] in HEADER_FIELDS:
+                token = f'[{token}]'
+            self.add(token)
+        if not self.unsent:
+            return ''
+        delta = ''.join(self.unsent)
+        self.unsent = []
+        self.seq += len(delta)
+        return delta
+
+    def feed(self, token, on_delta):
+        '''
+        Add the token, calling on_delta with any new ABC and the sequence number, i.e. the length of the ABC so far.
+        '''
+        delta = self.append(token)
+        if delta:
+            on_delta(delta, self.seq)
+
+    def add(self, abc):
+        self.parts.append(abc)
+        self.unsent.append(abc)
+
+    def snapshot(self):
+        '''
+        The ABC so far.
+        '''
+        if len(self.parts) > 1:
+            self.parts = [''.join(self.parts)]
+        return self.parts[0]
@@ -1,17 +1,26 @@
-import os
 import subprocess
 import json
 import logging
+import re
+from random import randint
+from datetime import timedelta
+from time import monotonic
 from django.utils.timezone import now
 from channels.consumer import SyncConsumer
-from channels.exceptions import StopConsumer
+from channels.exceptions import StopConsumer, ChannelFull
 from channels.generic.websocket import JsonWebsocketConsumer
 from asgiref.sync import async_to_sync
 
-from composer.rnn_models import folk_rnn_cached
-from composer import ABC2ABC_PATH, TUNE_PATH, FOLKRNN_TUNE_TITLE
+from composer.rnn_models import folk_rnn_cached, folk_rnn_batch_cached
+from composer import ABC2ABC_PATH, FOLKRNN_BATCH_SIZE, FOLKRNN_BATCH_ADMIT_MS, FOLKRNN_BATCH_STEP_TARGET_MS, FOLKRNN_FOLLOWER_POLL_TOKENS, FOLKRNN_MODEL_CHANNELS
+from composer import FOLKRNN_QUEUE_STATUS_MS, FOLKRNN_ADMISSION_MAX_WAIT, FOLKRNN_ADMISSION_REFUSE, FOLKRNN_CANCEL_POLL_MS, FOLKRNN_LEASE_SECONDS
+from composer import FOLKRNN_MAX_SEED, FOLKRNN_COMPOSE_MANY_MAX
 from composer.models import RNNTune, Session
 from composer.forms import ComposeForm
+from composer import generation_cache, tune_stream, tune_store, worker_pool, job_queue, tune_pool
+from composer.publisher import Publisher, TuneBroadcast
+from composer.abc_assembler import ABCAssembler
+from composer.scheduler import BatchScheduler
 
 ABC2ABC_COMMAND = [
             ABC2ABC_PATH, 
@@ -24,116 +33,469 @@ ABC2ABC_COMMAND = [
 logger = logging.getLogger(__name__)
 logger_use = logging.getLogger('composer.use')
 
+# Recorded on a tune whose generation was cancelled, see job_queue.unsubscribe
+CANCELLED_ERROR = 'Cancelled, as nobody was listening'
+
+class GenerationCancelled(Exception):
+    pass
+
+def model_channel(rnn_model_name):
+    '''
+    The channel of the model's own workers. See FOLKRNN_MODEL_CHANNELS
+    '''
+    model_name = rnn_model_name.replace('.pickle', '')
+    return 'folk_rnn.' + re.sub(r'[^a-zA-Z0-9_\-]', '_', model_name)
+
+def queue_group(rnn_model_name):
+    '''
+    The group of websockets with tunes waiting in the model's queue. See ComposerConsumer.queue_changed
+    '''
+    return 'queue_' + model_channel(rnn_model_name)
+
+def request_generation(channel_layer, tune, tune_ids=None):
+    '''
+    Ask a worker to generate the tune, one of its model's own workers if it has them.
+    With tune_ids, i.e. tunes of the model requested together, the worker generates those together.
+    '''
+    message = {
+        'type': 'folkrnn.generate', 
+        'id': tune.id,
+        }
+    if tune_ids is not None:
+        message['ids'] = tune_ids
+    if tune.rnn_model_name in FOLKRNN_MODEL_CHANNELS:
+        try:
+            async_to_sync(channel_layer.send)(model_channel(tune.rnn_model_name), message)
+            return
+        except ChannelFull:
+            logger.info(f'Model channel full, tune {tune.id} overflows to folk_rnn')
+    async_to_sync(channel_layer.send)('folk_rnn', message)
+
+def claim_tunes(tune_id, count):
+    '''
+    Claim up to count pending tunes for the tune's model, in the queue's fair order, i.e. not 
+    necessarily the tune itself. Returns the claimed tunes, an empty list if there are none to claim,
+    i.e. they've been claimed by another worker, or their sessions have their maximum generating.
+    '''
+    try:
+        rnn_model_name = RNNTune.objects.values_list('rnn_model_name', flat=True).get(id=tune_id)
+    except RNNTune.DoesNotExist:
+        return []
+    return job_queue.claim(rnn_model_name, count)
+
+def requeue_expired(channel_layer):
+    '''
+    Requeue the tunes whose worker's lease has expired, i.e. the worker died or hung, failing those out of attempts.
+    A requeued tune generates again from the start, identically as per its seed, so websockets showing it carry on
+    from the ABC they have. Returns the requeued and failed tunes. See job_queue.sweep
+    '''
+    requeued, failed = job_queue.sweep()
+    for tune in requeued:
+        logger.warning(f'Lease on tune {tune.id} expired, requeued after {tune.rnn_attempts} attempts')
+        request_generation(channel_layer, tune)
+    for tune in failed:
+        logger.error(f'Lease on tune {tune.id} expired, failed: {tune.rnn_error}')
+        tune_stream.remove(tune.id)
+        async_to_sync(channel_layer.group_send)(f'tune_{tune.id}', status_message(tune, 'finish'))
+    return requeued, failed
+
+def refill_pool(channel_layer):
+    '''
+    Queue pre-generation of any pool tunes wanted. See tune_pool.refill
+    '''
+    for tune in tune_pool.refill():
+        request_generation(channel_layer, tune)
+
+def status_message(tune, status):
+    '''
+    The generation_status message for the tune, i.e. status 'start' or 'finish'.
+    '''
+    return {
+        'type': 'generation_status',
+        'status': status,
+        'tune': tune.plain_dict(),
+        }
+
+class Generation:
+    '''
+    A tune being generated, streaming its ABC to the tune's group, and to the groups 
+    of any identical requests attached to it. See generation_cache.attach
+    '''
+    def __init__(self, consumer, tune):
+        self.consumer = consumer
+        self.tune = tune
+        self.tokens = []
+        self.broadcast = TuneBroadcast(consumer.publisher, tune.id)
+        self.assembler = ABCAssembler(tune.id)
+        self.followers = []
+        self.cancelled = False
+        self.lost = False # the lease on the tune expired, i.e. another worker has it now
+        self.take_followers()
+    
+    def on_token(self, token):
+        self.tokens.append(token)
+        self.assembler.feed(token, self.broadcast.on_delta)
+        for follower, broadcast, assembler in self.followers:
+            assembler.feed(token, broadcast.on_delta)
+        if len(self.tokens) % FOLKRNN_FOLLOWER_POLL_TOKENS == 0:
+            self.take_followers()
+        self.consumer.poll_cancelled()
+        self.consumer.renew_leases()
+    
+    def close(self):
+        '''
+        Broadcast any pending ABC and close the streams, i.e. the tune has been generated.
+        '''
+        self.broadcast.close()
+        for follower, broadcast, assembler in self.followers:
+            broadcast.close()
+    
+    def abandon(self):
+        '''
+        Close the streams without broadcasting, i.e. the tunes are another worker's now.
+        '''
+        self.broadcast.stream.close()
+        for follower, broadcast, assembler in self.followers:
+            broadcast.stream.close()
+    
+    def take_followers(self):
+        '''
+        Start streaming to newly attached tunes.
+        '''
+        for follower in generation_cache.take_followers(self.tune):
+            self.follow(follower)
+    
+    def follow(self, follower):
+        '''
+        Stream to the follower, catching it up with the ABC so far.
+        '''
+        self.consumer.notify_start(follower)
+        broadcast = TuneBroadcast(self.consumer.publisher, follower.id)
+        assembler = ABCAssembler(follower.id)
+        for token in self.tokens:
+            assembler.append(token)
+        if self.tokens:
+            broadcast.on_delta(assembler.snapshot(), assembler.seq)
+            broadcast.flush()
+        self.followers.append((follower, broadcast, assembler))
+
 class FolkRNNConsumer(SyncConsumer):
 
     def folkrnn_generate(self, event):
+        if not worker_pool.start_job():
+            # Draining, i.e. this worker is about to exit, so leave the tunes for another
+            async_to_sync(self.channel_layer.send)(self.scope['channel'], event)
+            worker_pool.skip_job()
+            return
+        try:
+            self.sweep()
+            self.generate(event)
+        finally:
+            worker_pool.end_job()
+    
+    def generate(self, event):
         '''
-        Generate the tune, pulling parameters from the database, and writing back
-        the result. Will also notify consumers with group 'tune_x' of abc updates 
-        as the generation proceeds, and generation completion.
-        '''
-        tune = RNNTune.objects.get(id=event['id'])
+        Generate the tune, pulling parameters from the database, and handing the
+        result to post-processing. Will also notify consumers with group 'tune_x' 
+        of abc updates as the generation proceeds.
         
-        tune.rnn_started = now()
-        tune.save()
+        Pending tunes for the same model are generated alongside, up to 
+        FOLKRNN_BATCH_SIZE tunes advancing together, claimed in the queue's fair
+        order, i.e. not necessarily starting with this tune, see job_queue. Tunes requested while the batch
+        generates join it, and each tune is handed over as soon as it finishes, i.e.
+        continuous batching, see composer.scheduler. Their own generate messages will 
+        then find them already claimed, and return.
         
-        async_to_sync(self.channel_layer.group_send)(
-                                f'tune_{tune.id}',
-                                {
-                                    'type': 'generation_status',
-                                    'status': 'start',
-                                    'tune': tune.plain_dict(),
-                                })
+        Tunes requested together, i.e. by compose_many, are claimed together, any rows left
+        over being claimed as above.
+        '''
+        tunes = job_queue.claim_ids(event['ids']) if 'ids' in event else []
+        if len(tunes) < FOLKRNN_BATCH_SIZE:
+            tunes += claim_tunes(event['id'], FOLKRNN_BATCH_SIZE - len(tunes))
+        if not tunes:
+            return
+        self.notify_queue_changed(tunes[0].rnn_model_name)
         
-        # Machinery to build ABC incrementally, notifying consumers of abc updates.
-        abc = f'X:{tune.id}\n'
-        if FOLKRNN_TUNE_TITLE:
-            abc += f'T:{FOLKRNN_TUNE_TITLE}{tune.id}\n'
-        in_header = True
-        header_tokens = []
-        def on_token(token):
-            nonlocal abc, header_tokens, in_header
-            # Ensure valid ABC
-            # - In header, have M (req), K, (req), L (opt) info fields on new lines, in that order.
-            # - In body, any info field should be in square brackets, if it's not already.
-            # This code tries its best to cope with ill-formed ABC produced by folk-rnn, i.e. probablistic ordering.
-            # Further complicating things, info-fields have to be modelled as either header or in-line, and this hasn't been done consistently between models
-            if in_header:
-                if token.strip('[]')[0:2] in ['M:', 'K:', 'L:']:
-                    header_tokens.append(token.strip('[]'))
-                else:
-                    in_header = False
-                    for header in ['M:', 'K:', 'L:']:
-                        header_token_candidates = [x for x in header_tokens if x.startswith(header)]
-                        if header_token_candidates:
-                            abc += header_token_candidates[0] + '\n'
-                        elif header in ['M:', 'K:']:
-                            abc += header + 'none\n'
-            if not in_header:
-                if token[0:2] in ['M:', 'K:', 'L:']:
-                    token = f'[{ token }]'
-                abc += token
-            async_to_sync(self.channel_layer.group_send)(
-                                    f'tune_{tune.id}',
-                                    {
-                                        'type': 'generation_status',
-                                        'status': 'new_abc',
-                                        'tune_id': tune.id,
-                                        'abc': abc,
-                                    })
+        for tune in tunes:
+            self.notify_start(tune)
+        
+        generations = [Generation(self, tune) for tune in tunes]
+        self.generating = {x.tune.id: x for x in generations}
         
         # Do the generation
-        folk_rnn = folk_rnn_cached(tune.rnn_model_name)
-        folk_rnn.seed_tune(tune.prime_tokens if len(tune.prime_tokens) > 0 else None)
-        tune_tokens = folk_rnn.generate_tune(
-                                    random_number_generator_seed=tune.seed, 
-                                    temperature=tune.temp,
-                                    on_token_callback=on_token
-                                    )
+        rnn_model_name = tunes[0].rnn_model_name
+        if FOLKRNN_BATCH_SIZE == 1:
+            tune = tunes[0]
+            generation = generations[0]
+            def on_token(token):
+                generation.on_token(token)
+                if generation.cancelled:
+                    raise GenerationCancelled
+            folk_rnn = folk_rnn_cached(rnn_model_name)
+            folk_rnn.seed_tune(tune.prime_tokens if len(tune.prime_tokens) > 0 else None)
+            try:
+                tune_tokens = folk_rnn.generate_tune(
+                                            random_number_generator_seed=tune.seed, 
+                                            temperature=tune.temp,
+                                            on_token_callback=on_token
+                                            )
+            except GenerationCancelled:
+                tune_tokens = generation.tokens
+            self.finish(generation, tune_tokens)
+        else:
+            folk_rnn = folk_rnn_batch_cached(rnn_model_name)
+            self.scheduler.start(tunes)
+            def admit(active):
+                if worker_pool.draining:
+                    return []
+                new_tunes = self.scheduler.admit(active, lambda count: job_queue.claim(rnn_model_name, count))
+                if new_tunes:
+                    self.notify_queue_changed(rnn_model_name)
+                for tune in new_tunes:
+                    self.notify_start(tune)
+                new_generations = [Generation(self, x) for x in new_tunes]
+                self.generating.update((x.tune.id, x) for x in new_generations)
+                return [self.job(x) for x in new_generations]
+            folk_rnn.generate_tunes([self.job(x) for x in generations], admit)
+            logger.info(f'Batch of {rnn_model_name} finished. {self.scheduler.summary()}')
         
-        # Save out raw folk-rnn output
-        model_name = tune.rnn_model_name.replace('.pickle', '')
-        tune_path_raw = os.path.join(TUNE_PATH, f'{model_name}_{tune.id}_raw')
-        with open(tune_path_raw, 'w') as f:
-            f.write(' '.join(tune_tokens))
+        # Don't raise StopConsumer, as while this consumer is alive it will receive generation messages, and if enqueued they will be swallowed on consumer destroy.
+    
+    def job(self, generation):
+        '''
+        The generation as a FolkRNNBatch job.
+        '''
+        return {
+            'seed': generation.tune.seed,
+            'temperature': generation.tune.temp,
+            'prime_tokens': generation.tune.prime_tokens,
+            'on_token': generation.on_token,
+            'on_finish': lambda tune_tokens: self.finish(generation, tune_tokens),
+            'cancelled': lambda: generation.cancelled,
+            }
+    
+    def finish(self, generation, tune_tokens):
+        '''
+        Hand over to post-processing, after the broadcasts so far, the lease released, i.e. the tune is 
+        generated, however long post-processing takes. See FolkRNNPostConsumer
+        '''
+        self.generating.pop(generation.tune.id, None)
+        if generation.lost or generation.tune.id not in job_queue.release([generation.tune]):
+            generation.abandon()
+            logger.warning(f'Generation of tune {generation.tune.id} abandoned, its lease expired')
+            return
+        generation.close()
+        self.publisher.send('folk_rnn_post', {
+                                'type': 'folkrnn.finish',
+                                'id': generation.tune.id,
+                                'tokens': tune_tokens,
+                                'abc': generation.assembler.snapshot(),
+                                'followers': [x[0].id for x in generation.followers],
+                                'cancelled': generation.cancelled,
+                                })
+    
+    def poll_cancelled(self):
+        '''
+        Mark the generations nobody is listening to as cancelled, looking at most every FOLKRNN_CANCEL_POLL_MS.
+        Cancelled generations are aborted at the next token. See job_queue.unsubscribe
+        '''
+        at = monotonic()
+        if at - getattr(self, 'cancel_polled', float('-inf')) < FOLKRNN_CANCEL_POLL_MS / 1000:
+            return
+        self.cancel_polled = at
+        cancelled = RNNTune.objects.filter(id__in=list(self.generating), rnn_cancelled__isnull=False).values_list('id', flat=True)
+        for tune_id in cancelled:
+            self.generating[tune_id].cancelled = True
+    
+    def renew_leases(self):
+        '''
+        Renew the leases on the tunes generating, at most every third of FOLKRNN_LEASE_SECONDS.
+        A generation whose lease was lost, i.e. expired and requeued, is aborted at the next token. See job_queue.renew
+        '''
+        at = monotonic()
+        if at - getattr(self, 'lease_renewed', float('-inf')) < FOLKRNN_LEASE_SECONDS / 3:
+            return
+        self.lease_renewed = at
+        held = job_queue.renew([x.tune for x in self.generating.values()])
+        for tune_id, generation in self.generating.items():
+            if tune_id not in held:
+                generation.lost = generation.cancelled = True
+    
+    def sweep(self):
+        '''
+        Requeue the tunes of workers that have died, looking at most every FOLKRNN_LEASE_SECONDS. See requeue_expired
+        '''
+        at = monotonic()
+        if at - getattr(self, 'swept', float('-inf')) < FOLKRNN_LEASE_SECONDS:
+            return
+        self.swept = at
+        requeue_expired(self.channel_layer)
+    
+    @property
+    def scheduler(self):
+        '''
+        Admits pending tunes to this worker's batches, keeping occupancy and queue wait metrics.
+        '''
+        if not hasattr(self, '_scheduler'):
+            self._scheduler = BatchScheduler(FOLKRNN_BATCH_SIZE, FOLKRNN_BATCH_ADMIT_MS, FOLKRNN_BATCH_STEP_TARGET_MS)
+        return self._scheduler
+    
+    @property
+    def publisher(self):
+        '''
+        Sends this worker's notifications, so generation doesn't wait on the channel layer.
+        '''
+        if not hasattr(self, '_publisher'):
+            self._publisher = Publisher(self.channel_layer)
+        return self._publisher
+    
+    def notify_start(self, tune):
+        '''
+        Notify consumers generation has started.
+        '''
+        self.publisher.group_send(f'tune_{tune.id}', status_message(tune, 'start'))
+    
+    def notify_queue_changed(self, rnn_model_name):
+        '''
+        Notify websockets waiting in the model's queue that tunes have been claimed, at most every FOLKRNN_QUEUE_STATUS_MS.
+        '''
+        if not hasattr(self, 'queue_notified'):
+            self.queue_notified = {}
+        if monotonic() - self.queue_notified.get(rnn_model_name, float('-inf')) < FOLKRNN_QUEUE_STATUS_MS / 1000:
+            return
+        self.queue_notified[rnn_model_name] = monotonic()
+        self.publisher.group_send(queue_group(rnn_model_name), {
+                                'type': 'queue_changed',
+                                'rnn_model_name': rnn_model_name,
+                                })
+    
+    def stop(self, event):
+        if hasattr(self, '_publisher'):
+            self._publisher.join()
+        raise StopConsumer
+
+class FolkRNNPostConsumer(SyncConsumer):
+    '''
+    The post-processing stage of generation, i.e. formatting, file and database writes,
+    so the folk_rnn worker can get on with the next generation.
+    '''
+    
+    def folkrnn_finish(self, event):
+        '''
+        Finish the generated tune, and the tunes attached to it. 
+        Any failure is recorded on the tune, see fail_tune.
+        '''
+        try:
+            tune = RNNTune.objects.get(id=event['id'])
+        except RNNTune.DoesNotExist:
+            logger.warning(f"folkrnn_finish: tune {event['id']} does not exist")
+            return
+        if event.get('cancelled'):
+            self.finish_cancelled(tune, event)
+            return
+        tune_tokens = event['tokens']
+        finished = self.finish_tune(tune, tune_tokens, event['abc'])
+        tune_stream.remove(tune.id)
         
-        # Format the incrementally built ABC
+        # Followers attached up until the tune finished are ours to finish
+        followers = list(RNNTune.objects.filter(id__in=event['followers']))
+        for follower in generation_cache.take_followers(tune):
+            self.group_send(follower, status_message(follower, 'start'))
+            followers.append(follower)
+        for follower in followers:
+            if finished:
+                self.finish_follower(follower, tune, tune_tokens)
+            else:
+                self.fail_tune(follower, f'Leader tune {tune.id} failed')
+            tune_stream.remove(follower.id)
+        
+        self.request_next(tune)
+    
+    def finish_cancelled(self, tune, event):
+        '''
+        The tune's generation was aborted, as nobody was listening. It and its followers are recorded 
+        as cancelled, bar any shown again since, which go back in the queue. See job_queue.unsubscribe
+        '''
+        tunes = [tune] + list(RNNTune.objects.filter(id__in=event['followers'])) + generation_cache.take_followers(tune)
+        for x in tunes:
+            tune_stream.remove(x.id)
+            x.refresh_from_db()
+            if x.rnn_subscribers:
+                job_queue.requeue(x)
+                request_generation(self.channel_layer, x)
+            else:
+                self.fail_tune(x, CANCELLED_ERROR, event['abc'] if x is tune else '')
+                RNNTune.objects.filter(id=x.id, rnn_cancelled__isnull=True).update(rnn_cancelled=now())
+        logger.info(f"Generation of tune {tune.id} cancelled after {len(event['tokens'])} tokens")
+        self.request_next(tune)
+    
+    def finish_tune(self, tune, tune_tokens, abc):
+        '''
+        Save out the generated tune, formatted, and notify consumers generation has finished.
+        Returns True if the tune was finished, False if it failed.
+        '''
         try:
-            abc_bytes = abc.encode()
+            # Format the incrementally built ABC
             result = subprocess.run(
                         ABC2ABC_COMMAND,
-                        input=abc_bytes, 
+                        input=abc.encode(), 
                         stdout=subprocess.PIPE,
                         )
-            abc = result.stdout.decode()
-        except:
-            # do something, probably marking in DB
-            logger.warning(f'ABC2ABC failed in folk_rnn_task for id:{tune.id}')
-            return
-        
-        # Save the formatted, incrementally built ABC
-        tune_path = os.path.join(TUNE_PATH, f'{model_name}_{tune.id}')
-        with open(tune_path, 'w') as f:
-            f.write(abc)
+            self.save_abc(tune, tune_tokens, result.stdout.decode())
+        except Exception as e:
+            logger.exception(f'Post-processing failed for tune {tune.id}')
+            self.fail_tune(tune, f'{type(e).__name__}: {e}', abc)
+            return False
+        return True
+    
+    def finish_follower(self, tune, leader, tune_tokens):
+        '''
+        Finish a tune attached to the leader with the leader's output.
+        '''
+        try:
+            self.save_abc(tune, tune_tokens, generation_cache.abc_for(tune, leader))
+        except Exception as e:
+            logger.exception(f'Post-processing failed for tune {tune.id}')
+            self.fail_tune(tune, f'{type(e).__name__}: {e}')
+    
+    def save_abc(self, tune, tune_tokens, abc):
+        '''
+        Save the raw folk-rnn output and formatted ABC, and notify consumers generation has finished.
+        '''
+        # Save out raw folk-rnn output and the formatted, incrementally built ABC
+        tune_store.write(tune, tune_tokens, abc)
         
         # Save that ABC to the database
         tune.abc = abc
         tune.rnn_finished = now()
-        tune.save()
+        tune.save(update_fields=['abc', 'rnn_finished'])
         
         # Notify consumers generation has finished
-        async_to_sync(self.channel_layer.group_send)(
-                                f'tune_{tune.id}',
-                                {
-                                    'type': 'generation_status',
-                                    'status': 'finish',
-                                    'tune': tune.plain_dict(),
-                                })
-                                
-        # Don't raise StopConsumer, as while this consumer is alive it will receive generation messages, and if enqueued they will be swallowed on consumer destroy.
+        self.group_send(tune, status_message(tune, 'finish'))
     
-    def stop(self, event):
-        raise StopConsumer
+    def fail_tune(self, tune, error, abc=''):
+        '''
+        Record the failure on the tune, finishing it with whatever ABC there is, i.e. unformatted.
+        '''
+        tune.abc = abc
+        tune.rnn_error = error
+        tune.rnn_finished = now()
+        tune.save(update_fields=['abc', 'rnn_error', 'rnn_finished'])
+        self.group_send(tune, status_message(tune, 'finish'))
+    
+    def request_next(self, tune):
+        '''
+        The tune's session has one fewer generating, so any of its tunes waiting their turn can be claimed.
+        See job_queue
+        '''
+        if tune.session_id is None:
+            return
+        next_tune = job_queue.pending().filter(session=tune.session_id).order_by('-priority', 'requested').first()
+        if next_tune is not None:
+            request_generation(self.channel_layer, next_tune)
+    
+    def group_send(self, tune, message):
+        async_to_sync(self.channel_layer.group_send)(f'tune_{tune.id}', message)
 
 class ComposerConsumer(JsonWebsocketConsumer):
 
@@ -152,30 +514,53 @@ class ComposerConsumer(JsonWebsocketConsumer):
         
         self.log_use("Connect")
         
-        if hasattr(self, 'abc_sent'):
+        if hasattr(self, 'abc_seq'):
             print('Surprise! These are not created on connect!')
-        self.abc_sent = {}
+        self.abc_seq = {}
+        self.queued = {} # tune_id: rnn_model_name, of tunes waiting to start
+        self.subscribed = set() # tune_ids this websocket is showing, see job_queue.subscribe
     
     def generation_status(self, message):
         if message['status'] in ['start', 'finish']:
             self.log_use(f"Generate {message['status']} for tune {message['tune']['id']}")
+            self.unqueue(message['tune']['id'])
             
             message['command'] = message.pop('type')
             self.send_json(message)
         elif message['status'] == 'new_abc':
             '''
-            Send unsent tokens to the client, i.e. realtime update of generation.
-            A websocket will typically connect mid-generation, so broadcasting all 
-            the abc internally and then sending only what is new guarantees complete 
-            abc for the client with minimal network overhead or server complexity.
+            Send unsent abc to the client, i.e. realtime update of generation.
+            Each message has the abc new to the tune, and its sequence number, i.e. the 
+            length of the tune's abc so far. A websocket will typically register mid-generation,
+            having been sent the abc so far from the tune's stream, so only what is new to this
+            websocket is sent on, with any gap filled from the stream.
             '''
-            to_send = message['abc'].replace(self.abc_sent[message['tune_id']], '')
-            self.abc_sent[message['tune_id']] += to_send
-            self.send_json({
-                        'command': 'add_token',
-                        'token': to_send,
-                        'tune_id': message['tune_id']
-                        })
+            tune_id = message['tune_id']
+            if tune_id not in self.abc_seq:
+                return
+            seq = self.abc_seq[tune_id]
+            if message['seq'] <= seq:
+                return
+            start = message['seq'] - len(message['abc'])
+            if start <= seq:
+                to_send = message['abc'][seq - start:]
+            else:
+                to_send = tune_stream.read(tune_id, after=seq)
+            self.send_abc(tune_id, to_send)
+    
+    def send_abc(self, tune_id, abc):
+        '''
+        Send abc to the client, appending to what it has of the tune.
+        '''
+        if not abc:
+            return
+        self.abc_seq[tune_id] += len(abc)
+        self.send_json({
+                    'command': 'add_token',
+                    'token': abc,
+                    'tune_id': tune_id,
+                    'seq': self.abc_seq[tune_id],
+                    })
         
     def receive_json(self, content):
         logger.debug(f'{id(self)} – receive_json: {content}')
@@ -187,12 +572,29 @@ class ComposerConsumer(JsonWebsocketConsumer):
                 return
             
             self.log_use(f"Show tune {tune.id}")
-            self.abc_sent[tune.id] = ''
+            # The client may already have some of the tune's abc, i.e. resuming after a reconnect
+            try:
+                self.abc_seq[tune.id] = max(0, int(content.get('seq', 0)))
+            except (TypeError, ValueError):
+                self.abc_seq[tune.id] = 0
             async_to_sync(self.channel_layer.group_add)(
                                         f"tune_{tune.id}", 
                                         self.channel_name
                                         )
-            if (tune.rnn_finished is not None):
+            if tune.id not in self.subscribed:
+                self.subscribed.add(tune.id)
+                job_queue.subscribe(tune.id)
+            # Now in the group, what's in the database and stream is complete up to any broadcast to come
+            tune.refresh_from_db()
+            if tune.rnn_cancelled is not None and tune.rnn_finished is not None:
+                # Cancelled while nobody was listening, so generate it again
+                job_queue.requeue(tune)
+                request_generation(self.channel_layer, tune)
+            if (tune.rnn_finished is None):
+                self.send_abc(tune.id, tune_stream.read(tune.id, after=self.abc_seq[tune.id]))
+                if tune.rnn_started is None:
+                    self.queue_tune(tune)
+            else:
                 self.send_json({
                     'command': 'generation_status',
                     'status': 'finish',
@@ -201,13 +603,17 @@ class ComposerConsumer(JsonWebsocketConsumer):
         if content['command'] == 'unregister_for_tune':
             self.log_use(f"Hide tune {content['tune_id']}")
             try:
-                del self.abc_sent[content['tune_id']]
+                del self.abc_seq[content['tune_id']]
             except KeyError:
-                logger.warning(f"unregister_for_tune: tune {content['tune_id']} not in abc_sent")
+                logger.warning(f"unregister_for_tune: tune {content['tune_id']} not in abc_seq")
             async_to_sync(self.channel_layer.group_discard)(
                                         f"tune_{content['tune_id']}", 
                                         self.channel_name
                                         )
+            self.unqueue(content['tune_id'])
+            if content['tune_id'] in self.subscribed:
+                self.subscribed.remove(content['tune_id'])
+                job_queue.unsubscribe(content['tune_id'])
         if content['command'] == 'compose':
             form = ComposeForm(content['data'])
             if form.is_valid():
@@ -218,21 +624,42 @@ class ComposerConsumer(JsonWebsocketConsumer):
                 tune.meter = form.cleaned_data['meter']
                 tune.key = form.cleaned_data['key']
                 tune.start_abc = form.cleaned_data['start_abc']
+                tune.session_id = self.session
+                source = tune_pool.offer(tune) if form.cleaned_data['autoseed'] else None
+                if not self.admit(tune):
+                    return
+                if source is not None:
+                    tune_pool.take(source)
                 tune.save()
                 
                 self.log_use(f"Compose command. Tune {tune.id} created.")
                 
-                async_to_sync(self.channel_layer.send)('folk_rnn', {
-                                                        'type': 'folkrnn.generate', 
-                                                        'id': tune.id
-                                                        })
+                source, source_tokens = generation_cache.lookup(tune)
+                queued = source is None and generation_cache.attach(tune) is None
+                if queued:
+                    request_generation(self.channel_layer, tune)
                 self.send_json({
                     'command': 'add_tune',
                     'tune': tune.plain_dict(),
                     })
+                if source is not None:
+                    self.replay_tune(tune, source, source_tokens)
+                if queued:
+                    self.queue_tune(tune)
             else:
                 self.log_use(f"Compose command data had errors: {form.errors}")
                 logger.info(f'receive_json.compose: invalid form data\n{form.errors}')
+        if content['command'] == 'compose_many':
+            form = ComposeForm(content['data'])
+            try:
+                count = int(content['count'])
+            except (KeyError, TypeError, ValueError):
+                count = 0
+            if form.is_valid() and 0 < count <= FOLKRNN_COMPOSE_MANY_MAX:
+                self.compose_many(form, count)
+            else:
+                self.log_use(f"Compose many command data had errors: {form.errors}, count {content.get('count')}")
+                logger.info(f"receive_json.compose_many: invalid form data or count {content.get('count')}\n{form.errors}")
         if content['command'] == 'notification':
             if content['type'] == 'state_change':
                 # untrusted input
@@ -250,13 +677,146 @@ class ComposerConsumer(JsonWebsocketConsumer):
             else:
                 logger.warning('Unknown notification')
         
+    def compose_many(self, form, count):
+        '''
+        Compose count variations of the form's tune, i.e. with the form's seed, then random seeds.
+        Created in one go, and requested as batches of FOLKRNN_BATCH_SIZE, each generated together
+        by a worker, streaming to each tune's own group.
+        '''
+        parameters = {
+            'rnn_model_name': form.cleaned_data['model'],
+            'temp': form.cleaned_data['temp'],
+            'meter': form.cleaned_data['meter'],
+            'key': form.cleaned_data['key'],
+            'start_abc': form.cleaned_data['start_abc'],
+            'session_id': self.session,
+            }
+        seeds = [form.cleaned_data['seed']] + [randint(0, FOLKRNN_MAX_SEED) for _ in range(count - 1)]
+        first = RNNTune(**parameters, seed=seeds[0])
+        if not self.admit(first):
+            return
+        tunes = RNNTune.objects.bulk_create([RNNTune(**parameters, seed=x, priority=first.priority) for x in seeds])
+        self.log_use(f"Compose many command. Tunes {tunes[0].id} to {tunes[-1].id} created.")
+        
+        for x in range(0, count, FOLKRNN_BATCH_SIZE):
+            batch = tunes[x:x + FOLKRNN_BATCH_SIZE]
+            request_generation(self.channel_layer, batch[0], [t.id for t in batch])
+        for tune in tunes:
+            self.send_json({
+                'command': 'add_tune',
+                'tune': tune.plain_dict(),
+                })
+        for tune in tunes:
+            self.queue_tune(tune)
+    
+    def admit(self, tune):
+        '''
+        Admission control, i.e. defer or refuse the tune if it would wait over FOLKRNN_ADMISSION_MAX_WAIT to generate.
+        Tunes identical to one generated or generating add no load, so are always admitted.
+        Returns whether to go ahead with the tune.
+        '''
+        if FOLKRNN_ADMISSION_MAX_WAIT is None or generation_cache.identical(tune).filter(rnn_error='').exists():
+            return True
+        wait = job_queue.estimated_wait(tune.rnn_model_name, job_queue.position(tune))
+        if wait is None or wait <= FOLKRNN_ADMISSION_MAX_WAIT:
+            return True
+        if FOLKRNN_ADMISSION_REFUSE:
+            self.log_use(f"Compose command refused. Estimated wait {wait:.0f}s")
+            self.send_json({
+                'command': 'compose_refused',
+                'wait_seconds': wait,
+                })
+            return False
+        self.log_use(f"Compose command deferred. Estimated wait {wait:.0f}s")
+        tune.priority = RNNTune.PRIORITY_DEFERRED
+        return True
+    
+    def queue_tune(self, tune):
+        '''
+        Send the tune's place in the queue, and again as the queue moves, until it starts. See queue_changed
+        '''
+        if tune.rnn_model_name not in self.queued.values():
+            async_to_sync(self.channel_layer.group_add)(queue_group(tune.rnn_model_name), self.channel_name)
+        self.queued[tune.id] = tune.rnn_model_name
+        self.send_queue_status(tune)
+    
+    def unqueue(self, tune_id):
+        rnn_model_name = self.queued.pop(tune_id, None)
+        if rnn_model_name is not None and rnn_model_name not in self.queued.values():
+            async_to_sync(self.channel_layer.group_discard)(queue_group(rnn_model_name), self.channel_name)
+    
+    def queue_changed(self, message):
+        '''
+        Tunes in the model's queue have been claimed, so send the new places of this websocket's tunes.
+        '''
+        tune_ids = [k for k, v in self.queued.items() if v == message['rnn_model_name']]
+        for tune in RNNTune.objects.filter(id__in=tune_ids):
+            self.send_queue_status(tune)
+    
+    def send_queue_status(self, tune):
+        '''
+        Send the tune's place in the queue, and estimated wait to start, i.e. as per recent generation.
+        '''
+        position = job_queue.position(tune)
+        if position is None:
+            self.unqueue(tune.id)
+            return
+        wait = job_queue.estimated_wait(tune.rnn_model_name, position)
+        self.send_json({
+            'command': 'queue_status',
+            'tune_id': tune.id,
+            'position': position,
+            'wait_seconds': wait,
+            'estimated_start': (now() + timedelta(seconds=wait)).isoformat() if wait is not None else None,
+            'deferred': tune.priority < RNNTune.PRIORITY_INTERACTIVE,
+            })
+    
+    def replay_tune(self, tune, source, tokens):
+        '''
+        Finish the tune with the output of an identically generated tune, replaying it
+        to the client as per a folk_rnn generation. 
+        The finish status follows as per any finished tune, i.e. on register_for_tune.
+        '''
+        tune.rnn_started = now()
+        tune.save()
+        
+        self.abc_seq[tune.id] = 0
+        self.generation_status({
+                            'type': 'generation_status',
+                            'status': 'start',
+                            'tune': tune.plain_dict(),
+                            })
+        def on_delta(delta, seq):
+            self.generation_status({
+                            'type': 'generation_status',
+                            'status': 'new_abc',
+                            'tune_id': tune.id,
+                            'abc': delta,
+                            'seq': seq,
+                            })
+        assembler = ABCAssembler(tune.id)
+        for token in tokens:
+            assembler.feed(token, on_delta)
+        
+        tune.abc = generation_cache.abc_for(tune, source)
+        tune_store.write(tune, tokens, tune.abc)
+        tune.rnn_finished = now()
+        tune.save()
+    
     def disconnect(self, close_code):
         self.log_use("Disconnect")
-        for tune_id in self.abc_sent:
+        for tune_id in self.abc_seq:
             async_to_sync(self.channel_layer.group_discard)(
                                             f'tune_{tune_id}', 
                                             self.channel_name
                                             )
+        for rnn_model_name in set(self.queued.values()):
+            async_to_sync(self.channel_layer.group_discard)(
+                                            queue_group(rnn_model_name), 
+                                            self.channel_name
+                                            )
+        for tune_id in self.subscribed:
+            job_queue.unsubscribe(tune_id)
     
     def log_use(self, message):
         logger_use.info(message, extra={'session': self.session})
\ No newline at end of file
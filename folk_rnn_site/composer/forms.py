@@ -19,6 +19,7 @@ class ComposeForm(forms.Form):
     start_abc = forms.CharField(widget=forms.Textarea(),
                                error_messages={'invalid': 'Invalid ABC notation as per the RNN model'},
                                required=False)
+    autoseed = forms.BooleanField(required=False) # any seed will do, i.e. a pre-generated tune's, see tune_pool
 
     # Validate whole form as validation (might) depend on particular model
     def clean(self):
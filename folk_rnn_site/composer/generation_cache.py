@@ -0,0 +1,104 @@
+import logging
+from collections import Counter
+from django.utils.timezone import now
+
+from composer import FOLKRNN_TUNE_TITLE
+from composer.models import RNNTune
+from composer import tune_store
+
+logger = logging.getLogger(__name__)
+
+# Hit, miss and coalesced counts for this process
+counters = Counter()
+
+def identical(tune):
+    '''
+    Tunes requested with the same parameters as the tune.
+    '''
+    return RNNTune.objects.filter(
+                            rnn_model_name=tune.rnn_model_name,
+                            seed=tune.seed,
+                            temp=tune.temp,
+                            meter=tune.meter,
+                            key=tune.key,
+                            start_abc=tune.start_abc,
+                            ).exclude(id=tune.id)
+
+def lookup(tune):
+    '''
+    Find a finished tune generated with the same parameters as the tune.
+    Generation is deterministic on model, seed, temperature and prime tokens, so its
+    output stands in for running folk-rnn again.
+    Returns the finished tune and its raw folk-rnn tokens, or (None, None).
+    '''
+    sources = identical(tune)\
+                        .filter(rnn_finished__isnull=False, rnn_error='')\
+                        .exclude(abc='')\
+                        .order_by('id')
+    for source in sources[:1]:
+        record = tune_store.read(source)
+        if record is None or not record[0]:
+            logger.warning(f'Generation cache: raw output missing for tune {source.id}')
+            break
+        tokens = record[0].split(' ')
+        counters['hit'] += 1
+        logger.info(f"Generation cache hit for tune {tune.id} from tune {source.id}. Hits: {counters['hit']}, misses: {counters['miss']}")
+        return source, tokens
+    counters['miss'] += 1
+    logger.info(f"Generation cache miss for tune {tune.id}. Hits: {counters['hit']}, misses: {counters['miss']}")
+    return None, None
+
+def abc_for(tune, source):
+    '''
+    The source tune's formatted ABC, with the tune's own reference number (and title).
+    '''
+    copy = RNNTune(id=tune.id, abc=source.abc)
+    copy.header_x = tune.id
+    if FOLKRNN_TUNE_TITLE:
+        copy.title = f'{FOLKRNN_TUNE_TITLE}{tune.id}'
+    return copy.abc
+
+def attach(tune):
+    '''
+    Attach the tune to an identical generation in progress (or pending), if any.
+    Its worker will stream the generation to this tune's group too, and finish this tune from its output.
+    Returns the leader tune, or None.
+    '''
+    leader = identical(tune)\
+                .filter(rnn_finished__isnull=True, rnn_leader__isnull=True, rnn_cancelled__isnull=True)\
+                .order_by('id')\
+                .first()
+    if leader is None:
+        return None
+    tune.rnn_leader = leader
+    tune.save()
+    # The leader may have finished before this tune was attached, i.e. its worker will not take it
+    leader.refresh_from_db()
+    if leader.rnn_finished is not None and detach(tune):
+        return None
+    counters['coalesced'] += 1
+    logger.info(f"Generation coalesced for tune {tune.id} with tune {leader.id}. Coalesced: {counters['coalesced']}")
+    return leader
+
+def detach(tune):
+    '''
+    Detach the tune from its leader, unless the leader's worker has already taken it.
+    Returns True if detached.
+    '''
+    if RNNTune.objects.filter(id=tune.id, rnn_started__isnull=True).update(rnn_leader=None):
+        tune.rnn_leader = None
+        return True
+    return False
+
+def take_followers(leader):
+    '''
+    Claim the tunes attached to the leader that have not yet been taken, marking them started.
+    For the leader's worker, who streams to and finishes them.
+    '''
+    taken = []
+    for follower in RNNTune.objects.filter(rnn_leader=leader, rnn_started__isnull=True):
+        started = now()
+        if RNNTune.objects.filter(id=follower.id, rnn_leader=leader, rnn_started__isnull=True).update(rnn_started=started):
+            follower.rnn_started = started
+            taken.append(follower)
+    return taken
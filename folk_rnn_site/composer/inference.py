@@ -0,0 +1,407 @@
+import threading
+from collections import OrderedDict, Counter
+import numpy as np
+
+from composer import precision
+
+# As per folk_rnn, a runaway tune is cut off at this length
+MAX_TUNE_LENGTH = 1000
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+class FolkRNNModel:
+    '''
+    A folk_rnn model's weights, as per the job spec.
+
+    Also caches the LSTM state having read a tune's prime tokens, up to the
+    prefix_cache_size most recently used, as most tunes start the same way, 
+    i.e. with meter and key.
+    '''
+    def __init__(self, token2idx, param_values, num_layers, wildcard_token=None, prefix_cache_size=0):
+        self.token2idx = token2idx
+        self.idx2token = {v: k for k, v in token2idx.items()}
+        self.vocab_size = len(token2idx)
+        self.start_idx = token2idx['<s>']
+        self.end_idx = token2idx['</s>']
+        self.wildcard_token = wildcard_token
+        self.num_layers = num_layers
+
+        # Reduced precision weights are widened once, here, rather than every step
+        param_values = precision.widen(param_values)
+
+        # param_values layout as per folk_rnn, i.e. 14 parameters per LSTM layer then the dense output layer
+        self.layers = []
+        for jj in range(num_layers):
+            offset = 1 + jj * 14
+            self.layers.append({
+                'Wxi': param_values[offset + 0],
+                'Whi': param_values[offset + 1],
+                'bi': param_values[offset + 2],
+                'Wxf': param_values[offset + 3],
+                'Whf': param_values[offset + 4],
+                'bf': param_values[offset + 5],
+                'Wxc': param_values[offset + 6],
+                'Whc': param_values[offset + 7],
+                'bc': param_values[offset + 8],
+                'Wxo': param_values[offset + 9],
+                'Who': param_values[offset + 10],
+                'bo': param_values[offset + 11],
+            })
+        self.output_W = param_values[1 + num_layers * 14]
+        self.output_b = param_values[2 + num_layers * 14]
+        self.hidden_size = self.layers[0]['Whi'].shape[0]
+        # Computed at the biases' precision, i.e. float32 for reduced precision models
+        self.dtype = self.output_b.dtype
+
+        self.prefix_cache_size = prefix_cache_size
+        self.prefix_states = OrderedDict()
+        self.prefix_counters = Counter()
+        self.prefix_lock = threading.Lock()
+
+    def prime_indexes(self, prime_tokens):
+        '''
+        Token indexes to prime the tune with, None where a wildcard asks for sampling.
+        '''
+        if not prime_tokens:
+            return []
+        return [None if x == self.wildcard_token else self.token2idx[x] for x in prime_tokens.split(' ')]
+
+    def tokens(self, sequence):
+        '''
+        The tune's tokens, i.e. without its start and end.
+        '''
+        return [self.idx2token[x] for x in sequence[1:] if x != self.end_idx]
+
+    def primed_state(self, prime):
+        '''
+        The prime's prefix up to any wildcard, and the LSTM state ready to read its last token,
+        i.e. having read the start token and the rest of the prefix. As per generation, the 
+        prime tokens being read rather than sampled.
+        Returns the prefix, and the per-layer h and c vectors, or None for no prefix.
+        '''
+        prefix = []
+        for idx in prime:
+            if idx is None:
+                break
+            prefix.append(idx)
+        prefix = tuple(prefix)
+        if not prefix or not self.prefix_cache_size:
+            return (), None
+        with self.prefix_lock:
+            state = self.prefix_states.get(prefix)
+            if state is not None:
+                self.prefix_states.move_to_end(prefix)
+                self.prefix_counters['hit'] += 1
+                return prefix, state
+        self.prefix_counters['miss'] += 1
+        state = self.read_prefix((self.start_idx,) + prefix[:-1])
+        with self.prefix_lock:
+            self.prefix_states[prefix] = state
+            while len(self.prefix_states) > self.prefix_cache_size:
+                self.prefix_states.popitem(last=False)
+        return prefix, state
+
+    def prewarm(self, primes_tokens):
+        '''
+        Cache the primed state of each prime, i.e. space separated tokens. Any not of this model are skipped.
+        '''
+        for prime_tokens in primes_tokens:
+            try:
+                prime = self.prime_indexes(prime_tokens)
+            except KeyError:
+                continue
+            self.primed_state(prime)
+
+class FolkRNNBatch(FolkRNNModel):
+    '''
+    A NumPy implementation of the folk_rnn LSTM sampler that advances many tunes
+    together, i.e. one matrix-batched LSTM step per token across the batch.
+
+    Each tune keeps its own random number generator, temperature and prime tokens,
+    so a tune's output is as per `Folk_RNN.generate_tune` for the same parameters.
+    '''
+
+    def step(self, idxs, h, c):
+        '''
+        Advance the LSTM stack one token for each row of the batch.
+        idxs are the input token indexes, h and c the per-layer (batch, hidden) states, updated in place.
+        Returns the output layer activations, i.e. (batch, vocab) logits.
+        '''
+        x = None
+        for jj, layer in enumerate(self.layers):
+            # The first layer's input is one-hot, so its dot product is a row lookup
+            if jj == 0:
+                xi, xf, xc, xo = (layer[k][idxs] for k in ('Wxi', 'Wxf', 'Wxc', 'Wxo'))
+            else:
+                xi, xf, xc, xo = (np.dot(x, layer[k]) for k in ('Wxi', 'Wxf', 'Wxc', 'Wxo'))
+            it = sigmoid(xi + np.dot(h[jj], layer['Whi']) + layer['bi'])
+            ft = sigmoid(xf + np.dot(h[jj], layer['Whf']) + layer['bf'])
+            ct = np.multiply(ft, c[jj]) + np.multiply(it, np.tanh(xc + np.dot(h[jj], layer['Whc']) + layer['bc']))
+            ot = sigmoid(xo + np.dot(h[jj], layer['Who']) + layer['bo'])
+            ht = np.multiply(ot, np.tanh(ct))
+            c[jj] = ct
+            h[jj] = ht
+            x = ht
+        return np.dot(x, self.output_W) + self.output_b
+
+    def read_prefix(self, idxs):
+        '''
+        The LSTM state having read the tokens, i.e. per-layer h and c vectors.
+        '''
+        dtype = self.dtype
+        h = [np.zeros((1, self.hidden_size), dtype=dtype) for x in range(self.num_layers)]
+        c = [np.zeros((1, self.hidden_size), dtype=dtype) for x in range(self.num_layers)]
+        for idx in idxs:
+            self.step(np.array([idx]), h, c)
+        return [x[0] for x in h], [x[0] for x in c]
+
+    def sample(self, rng, logits, temperature):
+        '''
+        Draw a token index from the softmax of the logits at the given temperature.
+        '''
+        expx = np.exp(logits / temperature)
+        sumexpx = np.sum(expx)
+        if sumexpx == 0:
+            p = np.zeros(logits.shape, dtype=logits.dtype)
+            p[logits.argmax()] = 1
+        else:
+            p = expx / sumexpx
+        return rng.choice(self.vocab_size, p=p)
+
+    def generate_tunes(self, jobs, admit=None):
+        '''
+        Generate a tune for each job, advancing all unfinished tunes together.
+        A job is a dict with keys `seed`, `temperature`, `prime_tokens` and optionally `on_token`,
+        a callback called with each token of that tune as it is generated, and `on_finish`, 
+        called with the tune's tokens as soon as it is finished, i.e. while others generate.
+        
+        admit, if given, is called at each step boundary with the number of tunes generating, 
+        and returns any further jobs, which join the batch from the next step. A job may also 
+        have `cancelled`, returning True to have the tune leave the batch at the step boundary,
+        on_finish being called with its tokens so far.
+        Returns a list of token lists, in job order, including any admitted.
+        '''
+        jobs = list(jobs)
+        rngs, temperatures, primes, sequences = [], [], [], []
+        h = [np.zeros((0, self.hidden_size), dtype=self.dtype) for x in range(self.num_layers)]
+        c = [np.zeros((0, self.hidden_size), dtype=self.dtype) for x in range(self.num_layers)]
+        # Rows of the batch state still generating, mapped to their job
+        active = []
+
+        def start(new_jobs):
+            nonlocal h, c
+            new_h = [np.zeros((len(new_jobs), self.hidden_size), dtype=self.dtype) for x in range(self.num_layers)]
+            new_c = [np.zeros((len(new_jobs), self.hidden_size), dtype=self.dtype) for x in range(self.num_layers)]
+            for row, job in enumerate(new_jobs):
+                rngs.append(np.random.RandomState(job['seed']))
+                temperatures.append(job['temperature'])
+                primes.append(self.prime_indexes(job['prime_tokens']))
+                sequences.append([self.start_idx])
+                active.append(len(sequences) - 1)
+                # Start from the state having read the prime, as far as cached
+                prefix, state = self.primed_state(primes[-1])
+                if state is None:
+                    continue
+                for jj in range(self.num_layers):
+                    new_h[jj][row] = state[0][jj]
+                    new_c[jj][row] = state[1][jj]
+                sequences[-1] += prefix
+                if job.get('on_token'):
+                    for idx in prefix:
+                        job['on_token'](self.idx2token[idx])
+            h = [np.concatenate((x, y)) for x, y in zip(h, new_h)]
+            c = [np.concatenate((x, y)) for x, y in zip(c, new_c)]
+
+        start(jobs)
+        while True:
+            if admit:
+                new_jobs = admit(len(active))
+                if new_jobs:
+                    jobs += new_jobs
+                    start(new_jobs)
+            cancelled = [row for row, job in enumerate(active) if jobs[job].get('cancelled') and jobs[job]['cancelled']()]
+            if cancelled:
+                for row in cancelled:
+                    if jobs[active[row]].get('on_finish'):
+                        jobs[active[row]]['on_finish'](self.tokens(sequences[active[row]]))
+                rows = [x for x in range(len(active)) if x not in cancelled]
+                h = [x[rows] for x in h]
+                c = [x[rows] for x in c]
+                active = [active[x] for x in rows]
+            if not active:
+                break
+
+            idxs = np.array([sequences[x][-1] for x in active])
+            logits = self.step(idxs, h, c)
+
+            still_active = []
+            for row, job in enumerate(active):
+                sequence = sequences[job]
+                prime = primes[job]
+                position = len(sequence) - 1
+                if position < len(prime) and prime[position] is not None:
+                    next_idx = prime[position]
+                else:
+                    next_idx = self.sample(rngs[job], logits[row], temperatures[job])
+                sequence.append(next_idx)
+                if next_idx != self.end_idx:
+                    if jobs[job].get('on_token'):
+                        jobs[job]['on_token'](self.idx2token[next_idx])
+                    if len(sequence) <= MAX_TUNE_LENGTH:
+                        still_active.append((row, job))
+                        continue
+                if jobs[job].get('on_finish'):
+                    jobs[job]['on_finish'](self.tokens(sequence))
+
+            # Compact the batch state to the rows still generating
+            if len(still_active) < len(active):
+                rows = [x[0] for x in still_active]
+                h = [x[rows] for x in h]
+                c = [x[rows] for x in c]
+            active = [x[1] for x in still_active]
+
+        return [self.tokens(x) for x in sequences]
+
+class FolkRNN(FolkRNNModel):
+    '''
+    A NumPy implementation of the folk_rnn LSTM sampler for one tune at a time, 
+    a drop-in for `Folk_RNN`, i.e. `seed_tune` then `generate_tune`.
+
+    The working arrays are allocated once, with each step computed in place, in the 
+    same order of operations as folk_rnn, so the output is identical for the same seed.
+    '''
+    def __init__(self, token2idx, param_values, num_layers, wildcard_token=None, prefix_cache_size=0):
+        super().__init__(token2idx, param_values, num_layers, wildcard_token, prefix_cache_size)
+        dtype = self.dtype
+        self.h = [np.zeros(self.hidden_size, dtype=dtype) for x in range(num_layers)]
+        self.c = [np.zeros(self.hidden_size, dtype=dtype) for x in range(num_layers)]
+        self.gates = {k: np.empty(self.hidden_size, dtype=dtype) for k in ('i', 'f', 'c', 'o')}
+        self.x = np.empty(self.hidden_size, dtype=dtype)
+        self.logits = np.empty(self.vocab_size, dtype=dtype)
+        self.p = np.empty(self.vocab_size, dtype=dtype)
+        self.cdf = np.empty(self.vocab_size, dtype=np.float64)
+        self.prime = []
+
+    def seed_tune(self, prime_tokens=None):
+        self.prime = self.prime_indexes(prime_tokens)
+
+    def gate(self, out, x, Wx, h, Wh, b, idx):
+        '''
+        x·Wx + h·Wh + b into out, x being the token index idx for the first layer.
+        '''
+        np.dot(h, Wh, out=out)
+        if x is None:
+            np.add(Wx[idx], out, out=out)
+        else:
+            np.dot(x, Wx, out=self.x)
+            np.add(self.x, out, out=out)
+        np.add(out, b, out=out)
+
+    def sigmoid(self, x):
+        np.negative(x, out=x)
+        np.exp(x, out=x)
+        np.add(1, x, out=x)
+        np.divide(1, x, out=x)
+
+    def step(self, idx):
+        '''
+        Advance the LSTM stack one token, leaving the output layer activations in self.logits.
+        '''
+        x = None
+        it, ft, gt, ot = (self.gates[k] for k in ('i', 'f', 'c', 'o'))
+        for layer, h, c in zip(self.layers, self.h, self.c):
+            self.gate(it, x, layer['Wxi'], h, layer['Whi'], layer['bi'], idx)
+            self.sigmoid(it)
+            self.gate(ft, x, layer['Wxf'], h, layer['Whf'], layer['bf'], idx)
+            self.sigmoid(ft)
+            self.gate(gt, x, layer['Wxc'], h, layer['Whc'], layer['bc'], idx)
+            np.tanh(gt, out=gt)
+            self.gate(ot, x, layer['Wxo'], h, layer['Who'], layer['bo'], idx)
+            self.sigmoid(ot)
+            # c = f*c + i*g, h = o*tanh(c)
+            np.multiply(ft, c, out=c)
+            np.multiply(it, gt, out=gt)
+            np.add(c, gt, out=c)
+            np.tanh(c, out=h)
+            np.multiply(ot, h, out=h)
+            x = h
+        np.dot(x, self.output_W, out=self.logits)
+        np.add(self.logits, self.output_b, out=self.logits)
+
+    def sample(self, rng, temperature):
+        '''
+        Draw a token index from the softmax of the logits at the given temperature.
+        As per `rng.choice(vocab_size, p=p)`, without its allocations.
+        '''
+        p = self.p
+        np.divide(self.logits, temperature, out=p)
+        np.exp(p, out=p)
+        sump = np.sum(p)
+        if sump == 0:
+            p[:] = 0
+            p[self.logits.argmax()] = 1
+        else:
+            np.divide(p, sump, out=p)
+        np.cumsum(p, dtype=np.float64, out=self.cdf)
+        self.cdf /= self.cdf[-1]
+        return int(self.cdf.searchsorted(rng.random_sample(), side='right'))
+
+    def read_prefix(self, idxs):
+        '''
+        The LSTM state having read the tokens, i.e. per-layer h and c vectors.
+        '''
+        for x in self.h + self.c:
+            x[:] = 0
+        for idx in idxs:
+            self.step(idx)
+        return [x.copy() for x in self.h], [x.copy() for x in self.c]
+
+    def generate_tune(self, random_number_generator_seed=42, temperature=1.0, on_token_callback=None):
+        '''
+        Generate a tune, primed as per seed_tune. Returns its tokens.
+        '''
+        rng = np.random.RandomState(random_number_generator_seed)
+        sequence = [self.start_idx]
+        # Start from the state having read the prime, as far as cached
+        prefix, state = self.primed_state(self.prime)
+        if state is None:
+            for x in self.h + self.c:
+                x[:] = 0
+        else:
+            for x, y in zip(self.h + self.c, state[0] + state[1]):
+                np.copyto(x, y)
+            sequence += prefix
+            if on_token_callback:
+                for idx in prefix:
+                    on_token_callback(self.idx2token[idx])
+        while True:
+            self.step(sequence[-1])
+            position = len(sequence) - 1
+            if position < len(self.prime) and self.prime[position] is not None:
+                next_idx = self.prime[position]
+            else:
+                next_idx = self.sample(rng, temperature)
+            sequence.append(next_idx)
+            if next_idx == self.end_idx:
+                break
+            if on_token_callback:
+                on_token_callback(self.idx2token[next_idx])
+            if len(sequence) > MAX_TUNE_LENGTH:
+                break
+        return self.tokens(sequence)
+
+    def log_likelihood(self, tokens):
+        '''
+        The natural log-likelihood of the tune's tokens then its end, at temperature 1.
+        '''
+        for x in self.h + self.c:
+            x[:] = 0
+        sequence = [self.start_idx] + [self.token2idx[x] for x in tokens] + [self.end_idx]
+        total = 0.0
+        for idx, next_idx in zip(sequence, sequence[1:]):
+            self.step(idx)
+            logits = self.logits.astype(np.float64)
+            top = logits.max()
+            total += logits[next_idx] - top - np.log(np.sum(np.exp(logits - top)))
+        return total
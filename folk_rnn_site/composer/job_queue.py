@@ -0,0 +1,319 @@
+'''
+The queue of tunes to generate, i.e. the pending tunes in the database.
+
+A worker claims a model's pending tunes highest priority first, and within a
+priority round-robin across sessions, the sessions with fewest tunes generating
+first. A session has up to FOLKRNN_SESSION_MAX_IN_FLIGHT tunes generating, its
+others waiting until one finishes. Tunes without a session, e.g. bulk generation,
+are a session of their own, and not capped.
+
+The generate messages are wake-ups for the tune's model, so which tunes a worker
+claims is decided here rather than by the order of the channel.
+
+A worker holds a lease on each tune it claims, renewing it as it generates. If the
+worker dies the lease expires, and sweep puts the tune back in the queue, up to
+FOLKRNN_MAX_ATTEMPTS generations, after which it is failed.
+
+Each tune counts the websockets showing it. When nobody is left showing a tune, or
+any tune attached to it, a pending tune is deprioritised and a generating tune is
+cancelled, its worker aborting it, see FolkRNNConsumer.poll_cancelled
+'''
+from collections import Counter
+from datetime import timedelta
+from functools import reduce
+from operator import or_
+from time import monotonic
+from django.db import transaction
+from django.db.models import Count, Min, Avg, F, Q, DurationField
+from django.utils.timezone import now
+
+from composer import FOLKRNN_SESSION_MAX_IN_FLIGHT, FOLKRNN_LEASE_SECONDS, FOLKRNN_MAX_ATTEMPTS
+from composer.models import RNNTune
+
+# Generation throughput is as per the tunes finished over this long, recomputed at most every THROUGHPUT_TTL seconds
+THROUGHPUT_WINDOW = timedelta(minutes=5)
+THROUGHPUT_TTL = 5
+throughputs = {} # rnn_model_name: (tunes per second, monotonic time)
+
+def pending(rnn_model_name=None):
+    '''
+    Tunes waiting to be generated, i.e. not started, nor attached to an identical generation.
+    '''
+    tunes = RNNTune.objects.filter(rnn_started__isnull=True, rnn_leader__isnull=True)
+    if rnn_model_name is not None:
+        tunes = tunes.filter(rnn_model_name=rnn_model_name)
+    return tunes
+
+def in_flight(sessions):
+    '''
+    The number of tunes generating for each of the sessions.
+    '''
+    return Counter(dict(RNNTune.objects.filter(
+                                    session__in=sessions,
+                                    rnn_leader__isnull=True,
+                                    rnn_finished__isnull=True,
+                                    rnn_lease_expires__gt=now(),
+                                    ).values_list('session').annotate(Count('id'))))
+
+def allocate(groups, in_flight, count, cap):
+    '''
+    How many tunes to claim from each group of pending tunes, i.e. a dict with `session`, `priority`,
+    `pending` count and `oldest` requested. Priorities are taken in turn, highest first,
+    and within a priority one tune per session per round, fewest in flight then longest waiting first.
+    Returns a Counter keyed by (session, priority).
+    '''
+    allocation = Counter()
+    taken = Counter()
+    for priority in sorted({x['priority'] for x in groups}, reverse=True):
+        level = sorted((x for x in groups if x['priority'] == priority), key=lambda x: (in_flight[x['session']], x['oldest']))
+        progressed = True
+        while count and progressed:
+            progressed = False
+            for group in level:
+                session = group['session']
+                if not count or allocation[(session, priority)] >= group['pending']:
+                    continue
+                if session is not None and cap and in_flight[session] + taken[session] >= cap:
+                    continue
+                allocation[(session, priority)] += 1
+                taken[session] += 1
+                count -= 1
+                progressed = True
+    return allocation
+
+def claim(rnn_model_name, count):
+    '''
+    Mark up to count of the model's pending tunes as started, in the fair order. Returns the claimed tunes.
+    Tunes another worker is claiming are skipped, so under contention a session may briefly exceed its cap.
+    '''
+    groups = list(pending(rnn_model_name).values('session', 'priority').annotate(pending=Count('id'), oldest=Min('requested')))
+    if not groups:
+        return []
+    counts = in_flight({x['session'] for x in groups if x['session'] is not None})
+    allocation = allocate(groups, counts, count, FOLKRNN_SESSION_MAX_IN_FLIGHT)
+    tunes = []
+    with transaction.atomic():
+        for (session, priority), n in allocation.items():
+            tunes += pending(rnn_model_name).select_for_update(skip_locked=True)\
+                                            .filter(session=session, priority=priority)\
+                                            .order_by('requested')[:n]
+        start(tunes)
+    return tunes
+
+def claim_ids(tune_ids):
+    '''
+    Mark the tunes still pending of those given as started, i.e. requested together to generate together,
+    whatever their place in the fair order. See ComposerConsumer.compose_many. Returns the claimed tunes.
+    '''
+    with transaction.atomic():
+        tunes = list(pending().select_for_update(skip_locked=True).filter(id__in=tune_ids).order_by('id'))
+        start(tunes)
+    return tunes
+
+def start(tunes):
+    '''
+    Mark the tunes as started, leased to this worker.
+    '''
+    started = now()
+    RNNTune.objects.filter(id__in=[x.id for x in tunes]).update(
+                                rnn_started=started,
+                                rnn_lease_expires=started + timedelta(seconds=FOLKRNN_LEASE_SECONDS),
+                                rnn_attempts=F('rnn_attempts') + 1,
+                                )
+    for tune in tunes:
+        tune.rnn_started = started
+        tune.rnn_attempts += 1
+
+def renew(tunes):
+    '''
+    Extend the worker's lease on the tunes it claimed, i.e. it is still generating them.
+    Returns the ids of the tunes it still holds, i.e. not expired since, nor claimed again, as per their attempt.
+    '''
+    return set_lease(tunes, now() + timedelta(seconds=FOLKRNN_LEASE_SECONDS))
+
+def release(tunes):
+    '''
+    End the worker's lease on the tunes it generated, i.e. handed to post-processing, so however long
+    that takes they aren't expired and generated again. Returns the ids of the tunes it still held, as per renew.
+    '''
+    return set_lease(tunes, None)
+
+def set_lease(tunes, expires):
+    '''
+    Set the lease on the tunes the worker still holds, i.e. not expired since, nor claimed again, as per their attempt.
+    Returns the ids of those tunes.
+    '''
+    if not tunes:
+        return set()
+    claimed = reduce(or_, (Q(id=x.id, rnn_attempts=x.rnn_attempts) for x in tunes))
+    with transaction.atomic():
+        held = set(RNNTune.objects.select_for_update()
+                                .filter(claimed, rnn_finished__isnull=True, rnn_lease_expires__isnull=False)
+                                .values_list('id', flat=True))
+        RNNTune.objects.filter(id__in=held).update(rnn_lease_expires=expires)
+    return held
+
+def expire(tunes):
+    '''
+    Take the tunes, i.e. generations lost with their worker, back from their worker. Those with attempts 
+    left go back in the queue, with any attached tunes, the rest fail. Returns the requeued and failed tunes.
+    '''
+    requeued, failed = [], []
+    with transaction.atomic():
+        for tune in tunes.select_for_update(skip_locked=True).filter(rnn_finished__isnull=True, rnn_leader__isnull=True):
+            followers = RNNTune.objects.filter(rnn_leader=tune, rnn_finished__isnull=True)
+            if tune.rnn_attempts < FOLKRNN_MAX_ATTEMPTS:
+                RNNTune.objects.filter(id=tune.id).update(abc='', rnn_started=None, rnn_lease_expires=None)
+                # Still attached, so the next worker takes them
+                followers.update(rnn_started=None)
+                requeued.append(tune)
+            else:
+                failed += [tune] + list(followers)
+                RNNTune.objects.filter(id__in=[x.id for x in failed]).update(
+                                        rnn_error=f'Generation failed, {tune.rnn_attempts} attempts',
+                                        rnn_finished=now(),
+                                        rnn_lease_expires=None,
+                                        )
+    for tune in requeued + failed:
+        tune.refresh_from_db()
+    return requeued, failed
+
+def sweep():
+    '''
+    Expire the tunes whose worker's lease has run out. See expire
+    '''
+    return expire(RNNTune.objects.filter(rnn_lease_expires__lt=now()))
+
+def orphans(max_age, window):
+    '''
+    Tunes that aren't going to finish without help, i.e. for the repairtunes command, by kind:
+    `expired` leases, `unleased` tunes started over max_age ago without a lease, e.g. their worker died
+    before taking it, or their post-processing was lost, see release, `followers` of finished tunes,
+    and `pending` tunes waiting over max_age, e.g. their generate message was lost.
+    Only tunes requested within the window are worth generating still. Those requested before it
+    and unfinished without a lease, e.g. from before leasing, are `abandoned`.
+    '''
+    before = now() - max_age
+    oldest = now() - window
+    unfinished = RNNTune.objects.filter(rnn_finished__isnull=True)
+    recent = unfinished.filter(requested__gte=oldest)
+    return {
+        'expired': unfinished.filter(rnn_leader__isnull=True, rnn_lease_expires__lt=now()),
+        'unleased': recent.filter(rnn_leader__isnull=True, rnn_lease_expires__isnull=True, rnn_started__lt=before),
+        'followers': recent.filter(rnn_leader__rnn_finished__isnull=False),
+        'pending': pending().filter(requested__lt=before, requested__gte=oldest),
+        'abandoned': unfinished.filter(rnn_lease_expires__isnull=True, requested__lt=oldest)\
+                               .exclude(priority=RNNTune.PRIORITY_SPECULATIVE), # i.e. the tune pool's, waiting for idle workers
+    }
+
+def abandon(tunes):
+    '''
+    Fail the tunes, i.e. too old to be worth generating. See orphans
+    '''
+    return tunes.update(rnn_error='Generation abandoned, unfinished too long', rnn_finished=now())
+
+def position(tune):
+    '''
+    How many of its model's pending tunes are ahead of the tune, or None if it isn't pending.
+    An estimate, as per the fair order now, i.e. later tunes of higher priority or other sessions may come ahead.
+    '''
+    if tune.rnn_started is not None or tune.rnn_leader_id is not None:
+        return None
+    requested = tune.requested or now() # i.e. if the tune were requested now
+    tunes = pending(tune.rnn_model_name)
+    ahead = tunes.filter(priority__gt=tune.priority).count()
+    tunes = tunes.filter(priority=tune.priority)
+    # Each round takes one of this session's tunes, and one of each other session's, longest waiting first
+    own = tunes.filter(session=tune.session_id)
+    rank = own.filter(requested__lt=requested).count()
+    oldest = own.aggregate(oldest=Min('requested'))['oldest'] or requested
+    others = tunes.exclude(session=tune.session_id) if tune.session_id is not None else tunes.filter(session__isnull=False)
+    for session, count, other_oldest in others.values_list('session').annotate(Count('id'), Min('requested')):
+        ahead += min(count, rank + 1 if other_oldest < oldest else rank)
+    return ahead + rank
+
+def throughput(rnn_model_name):
+    '''
+    Tunes of the model generated per second, i.e. the number generating over their recent mean duration.
+    None if there's no recent generation to go by. Bulk tunes, e.g. generatecorpus's, aren't gone by,
+    as not generated by the workers.
+    '''
+    rate, at = throughputs.get(rnn_model_name, (None, None))
+    if at is not None and monotonic() - at < THROUGHPUT_TTL:
+        return rate
+    duration = RNNTune.objects.filter(
+                            rnn_model_name=rnn_model_name,
+                            rnn_leader__isnull=True,
+                            rnn_error='',
+                            rnn_finished__gt=now() - THROUGHPUT_WINDOW,
+                            ).exclude(priority=RNNTune.PRIORITY_BULK, session__isnull=True)\
+                            .aggregate(duration=Avg(F('rnn_finished') - F('rnn_started'), output_field=DurationField()))['duration']
+    generating = RNNTune.objects.filter(
+                            rnn_model_name=rnn_model_name,
+                            rnn_leader__isnull=True,
+                            rnn_finished__isnull=True,
+                            rnn_lease_expires__gt=now(),
+                            ).count()
+    rate = max(generating, 1) / duration.total_seconds() if duration else None
+    throughputs[rnn_model_name] = (rate, monotonic())
+    return rate
+
+def estimated_wait(rnn_model_name, position):
+    '''
+    Seconds until a tune with position tunes ahead of it starts generating, or None if unknown.
+    '''
+    if position == 0:
+        return 0
+    rate = throughput(rnn_model_name)
+    return position / rate if rate else None
+
+def subscribe(tune_id):
+    '''
+    A websocket is showing the tune, so its generation is wanted, undoing any deprioritising or cancellation.
+    '''
+    RNNTune.objects.filter(id=tune_id).update(rnn_subscribers=F('rnn_subscribers') + 1)
+    leader_id = RNNTune.objects.filter(id=tune_id).values_list('rnn_leader', flat=True).first() or tune_id
+    RNNTune.objects.filter(id=leader_id, rnn_started__isnull=True, priority=RNNTune.PRIORITY_UNWATCHED)\
+                    .update(priority=RNNTune.PRIORITY_INTERACTIVE)
+    # Nor is a pre-generated tune in the pool any more, see tune_pool
+    RNNTune.objects.filter(id=leader_id, priority=RNNTune.PRIORITY_SPECULATIVE).update(priority=RNNTune.PRIORITY_INTERACTIVE)
+    RNNTune.objects.filter(id=leader_id, rnn_finished__isnull=True).update(rnn_cancelled=None)
+
+def unsubscribe(tune_id):
+    '''
+    A websocket has stopped showing the tune. If nobody is showing the generation, i.e. the tune 
+    or any tune attached to it, a pending generation is deprioritised, and one in progress cancelled.
+    '''
+    RNNTune.objects.filter(id=tune_id, rnn_subscribers__gt=0).update(rnn_subscribers=F('rnn_subscribers') - 1)
+    tune = RNNTune.objects.filter(id=tune_id).first()
+    if tune is None or tune.rnn_finished is not None or tune.rnn_subscribers:
+        return
+    leader_id = tune.rnn_leader_id or tune.id
+    if RNNTune.objects.filter(Q(id=leader_id) | Q(rnn_leader=leader_id), rnn_subscribers__gt=0).exists():
+        return
+    RNNTune.objects.filter(id=leader_id, rnn_started__isnull=True).update(priority=RNNTune.PRIORITY_UNWATCHED)
+    RNNTune.objects.filter(id=leader_id, rnn_started__isnull=False, rnn_finished__isnull=True).update(rnn_cancelled=now())
+
+def requeue(tune):
+    '''
+    Put the tune back in the queue, i.e. pending as when requested. For a cancelled generation wanted again.
+    '''
+    RNNTune.objects.filter(id=tune.id).update(
+                            abc='',
+                            rnn_started=None,
+                            rnn_lease_expires=None,
+                            rnn_attempts=0,
+                            rnn_finished=None,
+                            rnn_error='',
+                            rnn_leader=None,
+                            rnn_cancelled=None,
+                            priority=RNNTune.PRIORITY_INTERACTIVE,
+                            )
+    tune.refresh_from_db()
+
+def depth():
+    '''
+    The number of pending tunes, per model and priority.
+    '''
+    return {(x['rnn_model_name'], x['priority']): x['pending']
+            for x in pending().values('rnn_model_name', 'priority').annotate(pending=Count('id'))}
@@ -0,0 +1,130 @@
+import json
+from time import perf_counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from composer.abc_assembler import ABCAssembler, HEADER_FIELDS, REQUIRED_FIELDS
+from composer.rnn_models import folk_rnn_batch_cached
+
+def concatenating_builder(tune_id, title, on_delta):
+    '''
+    ABC built by string concatenation, as before ABCAssembler, i.e. the baseline.
+    Returns the on_token callback and a function returning the ABC built.
+    '''
+    abc = f'X:{tune_id}\n'
+    if title:
+        abc += f'T:{title}{tune_id}\n'
+    seq = 0
+    in_header = True
+    header_tokens = []
+    def on_token(token):
+        nonlocal abc, seq, in_header
+        if in_header:
+            if token.strip('[]')[0:2] in HEADER_FIELDS:
+                header_tokens.append(token.strip('[]'))
+            else:
+                in_header = False
+                for header in HEADER_FIELDS:
+                    header_token_candidates = [x for x in header_tokens if x.startswith(header)]
+                    if header_token_candidates:
+                        abc += header_token_candidates[0] + '\n'
+                    elif header in REQUIRED_FIELDS:
+                        abc += header + 'none\n'
+        if not in_header:
+            if token[0:2] in HEADER_FIELDS:
+                token = f'[{ token }]'
+            abc += token
+        if len(abc) > seq:
+            delta = abc[seq:]
+            seq = len(abc)
+            on_delta(delta, seq)
+    def get_abc():
+        return abc
+    return on_token, get_abc
+
+class Command(BaseCommand):
+    '''
+    Benchmarks building tunes' ABC from their tokens, i.e.
+        python3.6 manage.py benchmarkabc thesession_with_repeats.pickle --tunes 64
+        python3.6 manage.py benchmarkabc --corpus corpus.jsonl --repeat 20
+
+    The token streams are generated, or read from the output of generatecorpus. Each is fed
+    a token at a time, taking each delta, as the worker does, with a snapshot every
+    --snapshot tokens, as a follower catching up does. Reports the time per token for
+    ABCAssembler and the string concatenation it replaced, checking their ABC is the same.
+    --repeat lengthens each tune by repeating its body, as the concatenation is worst for long tunes.
+    '''
+    help = 'Benchmark ABCAssembler against string concatenation over real token streams.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', nargs='?', help='model filename, as per RNNTune.rnn_model_name')
+        parser.add_argument('--corpus', help='JSON lines file of tunes, as per generatecorpus, rather than generating')
+        parser.add_argument('--tunes', type=int, default=64, help='number of tunes to generate, or read')
+        parser.add_argument('--repeat', type=int, default=1, help='times to repeat each tune body')
+        parser.add_argument('--snapshot', type=int, default=0, help='tokens between snapshots, default none')
+        parser.add_argument('--rounds', type=int, default=5, help='rounds to time, the best being reported')
+
+    def handle(self, *args, **options):
+        tunes_tokens = self.token_streams(options)
+        if options['repeat'] > 1:
+            tunes_tokens = [self.lengthen(x, options['repeat']) for x in tunes_tokens]
+        token_count = sum(len(x) for x in tunes_tokens)
+        snapshot = options['snapshot']
+
+        def run_concatenating():
+            abcs = []
+            for tune_tokens in tunes_tokens:
+                on_token, get_abc = concatenating_builder(1, 'Tune', lambda delta, seq: None)
+                for count, token in enumerate(tune_tokens, 1):
+                    on_token(token)
+                    if snapshot and count % snapshot == 0:
+                        get_abc()
+                abcs.append(get_abc())
+            return abcs
+
+        def run_assembler():
+            abcs = []
+            for tune_tokens in tunes_tokens:
+                assembler = ABCAssembler(1, title='Tune')
+                for count, token in enumerate(tune_tokens, 1):
+                    assembler.append(token)
+                    if snapshot and count % snapshot == 0:
+                        assembler.snapshot()
+                abcs.append(assembler.snapshot())
+            return abcs
+
+        if run_concatenating() != run_assembler():
+            raise CommandError('ABCAssembler and concatenation differ')
+
+        self.stdout.write(f'{len(tunes_tokens)} tunes, {token_count} tokens, longest {max(len(x) for x in tunes_tokens)}')
+        for name, run in [('concatenating', run_concatenating), ('ABCAssembler', run_assembler)]:
+            best = float('inf')
+            for _ in range(options['rounds']):
+                start = perf_counter()
+                run()
+                best = min(best, perf_counter() - start)
+            self.stdout.write(f'{name}: {best:.4f}s, {best / token_count * 1e9:.0f}ns per token')
+
+    def token_streams(self, options):
+        '''
+        Each tune's tokens, from the corpus if given, else generated with seeds from 0.
+        '''
+        if options['corpus']:
+            tunes_tokens = []
+            with open(options['corpus']) as f:
+                for line in f:
+                    if len(tunes_tokens) == options['tunes']:
+                        break
+                    tunes_tokens.append(json.loads(line)['tokens'].split(' '))
+            return tunes_tokens
+        if not options['model']:
+            raise CommandError('Give a model, or a corpus')
+        jobs = [{'seed': x, 'temperature': 1.0, 'prime_tokens': ''} for x in range(options['tunes'])]
+        return folk_rnn_batch_cached(options['model']).generate_tunes(jobs)
+
+    def lengthen(self, tune_tokens, repeat):
+        '''
+        The tune with its body repeated, i.e. after the header tokens.
+        '''
+        header_length = next((i for i, x in enumerate(tune_tokens) if x.strip('[]')[0:2] not in HEADER_FIELDS), len(tune_tokens))
+        return tune_tokens[:header_length] + tune_tokens[header_length:] * repeat
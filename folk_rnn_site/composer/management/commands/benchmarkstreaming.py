@@ -0,0 +1,60 @@
+from time import monotonic
+from types import SimpleNamespace
+from functools import partial
+
+from django.core.management.base import BaseCommand
+from channels.layers import get_channel_layer, InMemoryChannelLayer
+
+from composer import FOLKRNN_FLUSH_TOKENS, FOLKRNN_FLUSH_MS, FOLKRNN_FLUSH_ON_BAR
+from composer.abc_assembler import ABCAssembler
+from composer.publisher import Publisher, TuneBroadcast
+from composer import tune_stream
+from composer.rnn_models import folk_rnn_batch_cached
+
+class Command(BaseCommand):
+    '''
+    Benchmarks broadcasting a generation's abc updates, i.e. 
+        python3.6 manage.py benchmarkstreaming thesession_with_repeats.pickle
+    
+    Generates the same tunes twice, broadcasting every token from the generation 
+    loop, as the worker did, and then coalesced as per the flush policy from the 
+    publisher thread. Reports generation wall time, the time until all messages 
+    were sent, and the message count for each.
+    '''
+    help = 'Benchmark per-token versus coalesced broadcast of tune generation.'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='model filename, as per RNNTune.rnn_model_name')
+        parser.add_argument('--tunes', type=int, default=4, help='number of tunes to generate')
+        parser.add_argument('--in-memory', action='store_true', help='use an in-memory channel layer, rather than the configured one')
+    
+    def handle(self, *args, **options):
+        channel_layer = InMemoryChannelLayer() if options['in_memory'] else get_channel_layer()
+        folk_rnn = folk_rnn_batch_cached(options['model'])
+        
+        runs = [
+            ('per token', Publisher(channel_layer, blocking=True), {'flush_tokens': 1, 'flush_ms': 0, 'flush_on_bar': False}),
+            ('coalesced', Publisher(channel_layer), {'flush_tokens': FOLKRNN_FLUSH_TOKENS, 'flush_ms': FOLKRNN_FLUSH_MS, 'flush_on_bar': FOLKRNN_FLUSH_ON_BAR}),
+            ]
+        for name, publisher, policy in runs:
+            broadcasts = []
+            jobs = []
+            for seed in range(options['tunes']):
+                tune = SimpleNamespace(id=f'benchmark_{seed}')
+                broadcast = TuneBroadcast(publisher, tune.id, **policy)
+                on_token = partial(ABCAssembler(tune.id).feed, on_delta=broadcast.on_delta)
+                broadcasts.append(broadcast)
+                jobs.append({'seed': seed, 'temperature': 1.0, 'prime_tokens': '', 'on_token': on_token})
+            
+            start = monotonic()
+            tunes_tokens = folk_rnn.generate_tunes(jobs)
+            for broadcast in broadcasts:
+                broadcast.close()
+            generated = monotonic() - start
+            publisher.join()
+            sent = monotonic() - start
+            for broadcast in broadcasts:
+                tune_stream.remove(broadcast.tune_id)
+            
+            token_count = sum(len(x) for x in tunes_tokens)
+            self.stdout.write(f'{name}: {len(jobs)} tunes, {token_count} tokens, {publisher.sent} messages. Generation {generated:.3f}s, all sent {sent:.3f}s')
@@ -0,0 +1,64 @@
+import os
+import pickle
+from time import monotonic
+import numpy as np
+
+from django.core.management.base import BaseCommand
+
+from composer import MODEL_PATH, FOLKRNN_PRECISION
+from composer import model_format
+from composer import precision as model_precision
+from composer.precision import QuantizedWeights
+
+def weights(param):
+    '''
+    The param as arrays, i.e. an int8 matrix and its scales, for comparison.
+    '''
+    if isinstance(param, QuantizedWeights):
+        return [param.q, param.scale]
+    return [param]
+
+class Command(BaseCommand):
+    '''
+    Converts model pickles to the memory-mappable format, i.e.
+        python3.6 manage.py convertmodels
+        python3.6 manage.py convertmodels --precision int8 thesession_with_repeats.pickle
+
+    Each model's directory is written beside its pickle, which is left in place.
+    The models are then loaded from the directory, see rnn_models.load_job_spec
+    Converting to FOLKRNN_PRECISION saves the workers converting on loading the model.
+    '''
+    help = 'Convert model pickles to the memory-mappable model format.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', help='model filenames, default all .pickle files in MODEL_PATH')
+        parser.add_argument('--precision', choices=model_precision.PRECISIONS, default=FOLKRNN_PRECISION, help=f'weight precision, default {FOLKRNN_PRECISION}')
+
+    def handle(self, *args, **options):
+        filenames = options['models'] or sorted(x for x in os.listdir(MODEL_PATH) if x.endswith('.pickle'))
+        for filename in filenames:
+            pickle_path = os.path.join(MODEL_PATH, filename)
+            mmap_path = model_format.mmap_path(pickle_path)
+
+            start = monotonic()
+            with open(pickle_path, 'rb') as f:
+                job_spec = pickle.load(f)
+            pickle_load = monotonic() - start
+
+            param_values = model_precision.convert(job_spec['param_values'], options['precision'])
+            model_format.save(dict(job_spec, param_values=param_values), mmap_path, options['precision'])
+
+            start = monotonic()
+            converted = model_format.load(mmap_path)
+            mmap_load = monotonic() - start
+
+            if not all(np.array_equal(a, b) for x, y in zip(param_values, converted['param_values']) for a, b in zip(weights(x), weights(y))):
+                self.stderr.write(f'{filename}: converted weights differ, removing {mmap_path}')
+                model_format.remove(mmap_path)
+                continue
+            error = max(np.abs(np.asarray(x, dtype=np.float64) - np.asarray(y, dtype=np.float64)).max() 
+                        for x, y in zip(job_spec['param_values'], model_precision.convert(param_values, 'full')))
+            original_bytes = sum(x.nbytes for x in job_spec['param_values'])
+            converted_bytes = sum(x.nbytes for x in param_values)
+            self.stdout.write(f"{filename}: converted to {mmap_path} at {options['precision']}. Load {pickle_load:.3f}s as pickle, {mmap_load:.3f}s memory-mapped. "
+                              f"Weights {original_bytes} bytes, now {converted_bytes}, max error {error:.3g}")
@@ -0,0 +1,69 @@
+import numpy as np
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+
+from composer import FOLKRNN_PRECISION
+from composer import precision as model_precision
+from composer.inference import FolkRNN
+from composer.rnn_models import load_job_spec, model_names
+
+class Command(BaseCommand):
+    '''
+    Compares a model at reduced precision against the model as trained, i.e.
+        python3.6 manage.py evaluateprecision --precision int8 --seeds 100 thesession_with_repeats.pickle
+
+    For each seed a tune is generated at both precisions. Reported are how many tunes
+    are identical, and where the others first diverge. The log-likelihood of each
+    as-trained tune is also scored at both precisions, reporting the drift per token.
+    The weights' bytes are reported as stored and as computed with, i.e. widened, see
+    precision.widen, with the generation time per token at each precision.
+
+    The reduced precision model is as the workers would load it, i.e. converted
+    by convertmodels if so, otherwise converted on loading.
+    '''
+    help = 'Report the token divergence and log-likelihood drift of reduced precision inference.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('models', nargs='*', help='model filenames, default all models in MODEL_PATH')
+        parser.add_argument('--precision', choices=model_precision.PRECISIONS, default=FOLKRNN_PRECISION, help=f'default {FOLKRNN_PRECISION}')
+        parser.add_argument('--seeds', type=int, default=100, help='tunes to generate, i.e. seeds 0 to this')
+        parser.add_argument('--temperature', type=float, default=1.0)
+        parser.add_argument('--prime', default='', help='prime tokens, e.g. "M:4/4 K:Cmaj"')
+
+    def handle(self, *args, **options):
+        for name in options['models'] or model_names():
+            reference_spec = load_job_spec(name, 'full', original=True)
+            reduced_spec = load_job_spec(name, options['precision'])
+            reference, reduced = (FolkRNN(x['token2idx'], x['param_values'], x['num_layers'], '*') for x in (reference_spec, reduced_spec))
+
+            identical = 0
+            divergences = []
+            drifts = []
+            seconds = [0, 0]
+            tokens = [0, 0]
+            for seed in range(options['seeds']):
+                tunes = []
+                for x, folk_rnn in enumerate((reference, reduced)):
+                    folk_rnn.seed_tune(options['prime'])
+                    start = perf_counter()
+                    tunes.append(folk_rnn.generate_tune(random_number_generator_seed=seed, temperature=options['temperature']))
+                    seconds[x] += perf_counter() - start
+                    tokens[x] += len(tunes[-1]) + 1
+                if tunes[0] == tunes[1]:
+                    identical += 1
+                else:
+                    divergences.append(next((x for x, (a, b) in enumerate(zip(*tunes)) if a != b), min(len(x) for x in tunes)))
+                drift = reduced.log_likelihood(tunes[0]) - reference.log_likelihood(tunes[0])
+                drifts.append(drift / (len(tunes[0]) + 1))
+
+            reference_bytes = sum(x.nbytes for x in reference_spec['param_values'])
+            reduced_bytes = sum(x.nbytes for x in reduced_spec['param_values'])
+            widened_bytes = model_precision.widened_nbytes(reduced_spec['param_values'])
+            self.stdout.write(f"{name} at {options['precision']}: weights {reduced_bytes} bytes stored, {widened_bytes} computed with, as trained {reference_bytes}")
+            self.stdout.write(f'  Time per token: {seconds[1] / tokens[1] * 1e6:.0f}us, as trained {seconds[0] / tokens[0] * 1e6:.0f}us')
+            self.stdout.write(f"  Identical tunes: {identical}/{options['seeds']}")
+            if divergences:
+                self.stdout.write(f'  First divergence, token: median {np.median(divergences):.0f}, min {min(divergences)}')
+            drifts = np.abs(drifts)
+            self.stdout.write(f'  Log-likelihood drift per token: mean {drifts.mean():.3g}, max {drifts.max():.3g}')
@@ -0,0 +1,211 @@
+import os
+import json
+from time import perf_counter
+from datetime import timedelta
+import logging
+import subprocess
+import multiprocessing
+from itertools import product
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.db.models import Case, When, Value, TextField
+from django.utils.timezone import now
+
+from composer import FOLKRNN_BATCH_SIZE
+from composer import tune_store
+from composer.abc_assembler import ABCAssembler
+from composer.consumers import ABC2ABC_COMMAND
+from composer.generation_cache import abc_for
+from composer.models import RNNTune
+from composer.rnn_models import model_names, models, folk_rnn_cached, folk_rnn_batch_cached, validate_meter, validate_key
+
+logger = logging.getLogger(__name__)
+
+def seed_range(value):
+    '''
+    A seed, or range of seeds, e.g. 42 or 0-9999, inclusive.
+    '''
+    start, _, stop = value.partition('-')
+    return range(int(start), int(stop or start) + 1)
+
+def folk_rnn_get():
+    '''
+    The model getter as per the worker, i.e. the batched engine only if FOLKRNN_BATCH_SIZE batches.
+    '''
+    return folk_rnn_cached if FOLKRNN_BATCH_SIZE == 1 else folk_rnn_batch_cached
+
+def generate_chunk(chunk):
+    '''
+    Generate and format a chunk's tunes, i.e. in a pool process, with the engine the worker would use,
+    as the tunes are served to identical compose requests, see generation_cache. The ABC has reference 
+    number 0, set on saving, see Command.save_chunk. 
+    Returns the chunk, and each tune's tokens, ABC and generation time in seconds.
+    '''
+    rnn_model_name, temp, meter, key, prime_tokens, seeds = chunk
+    folk_rnn = folk_rnn_get()(rnn_model_name)
+    tunes_tokens = []
+    durations = []
+    for x in range(0, len(seeds), FOLKRNN_BATCH_SIZE):
+        start = perf_counter()
+        if FOLKRNN_BATCH_SIZE == 1:
+            folk_rnn.seed_tune(prime_tokens if prime_tokens else None)
+            tunes_tokens.append(folk_rnn.generate_tune(random_number_generator_seed=seeds[x], temperature=temp))
+        else:
+            tunes_tokens += folk_rnn.generate_tunes({'seed': seed, 'temperature': temp, 'prime_tokens': prime_tokens}
+                                                    for seed in seeds[x:x + FOLKRNN_BATCH_SIZE])
+        # A batch's tunes generate together, each taking the batch's time
+        durations += [perf_counter() - start] * (len(tunes_tokens) - len(durations))
+    abcs = []
+    for tune_tokens in tunes_tokens:
+        assembler = ABCAssembler(0)
+        for token in tune_tokens:
+            assembler.append(token)
+        result = subprocess.run(ABC2ABC_COMMAND, input=assembler.snapshot().encode(), stdout=subprocess.PIPE)
+        abcs.append(result.stdout.decode())
+    return chunk, tunes_tokens, abcs, durations
+
+class Command(BaseCommand):
+    '''
+    Generates a corpus of tunes offline, i.e. rather than through the composer, e.g.
+        python3.6 manage.py generatecorpus corpus.jsonl --models thesession_with_repeats.pickle --temps 0.5 1 --seeds 0-9999
+        python3.6 manage.py generatecorpus corpus.jsonl --meters M:4/4 M:6/8 --keys K:Cmaj K:Cdor --seeds 0-999 --processes 8
+
+    Every combination of models, temperatures, meters, keys and seeds is generated, the meters
+    and keys defaulting to each model's default. The grid is split into chunks of --chunk seeds
+    of one parameter set, generated across a pool of processes sharing the loaded models.
+
+    Each chunk's tunes are saved as RNNTune rows at PRIORITY_BULK with one bulk insert, to the
+    tune store, see tune_store, and appended to the output, one JSON line per tune.
+    Finished chunks are recorded in the checkpoint, so running the same command again resumes.
+    '''
+    help = 'Generate a grid of tunes across a process pool, saving them in bulk, resumably.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='JSON lines file the tunes are appended to')
+        parser.add_argument('--models', nargs='+', help='default all models')
+        parser.add_argument('--temps', nargs='+', type=float, default=[1.0])
+        parser.add_argument('--meters', nargs='+', help="e.g. M:4/4, default each model's default meter")
+        parser.add_argument('--keys', nargs='+', help="e.g. K:Cmaj, default each model's default mode")
+        parser.add_argument('--seeds', nargs='+', type=seed_range, default=[range(100)], help='seeds or ranges, e.g. 0-9999, default 0-99')
+        parser.add_argument('--chunk', type=int, default=64, help='seeds per chunk, i.e. per process task and bulk insert')
+        parser.add_argument('--processes', type=int, default=os.cpu_count(), help='default the CPU count')
+        parser.add_argument('--checkpoint', help='default the output path with .checkpoint')
+
+    def handle(self, *args, **options):
+        chunks = self.chunks(options)
+        checkpoint_path = options['checkpoint'] or options['output'] + '.checkpoint'
+        done, offset = self.resume(checkpoint_path)
+        todo = [x for x in chunks if self.chunk_key(x) not in done]
+        self.stdout.write(f'{sum(len(x[-1]) for x in chunks)} tunes in {len(chunks)} chunks, {len(chunks) - len(todo)} done')
+        if not todo:
+            return
+
+        # Load the models before forking, so the processes share them, and leave them no database connections
+        for rnn_model_name in {x[0] for x in todo}:
+            folk_rnn_get()(rnn_model_name)
+        connections.close_all()
+
+        with open(options['output'], 'a+b') as output, open(checkpoint_path, 'a') as checkpoint:
+            # Drop anything written after the last finished chunk
+            output.truncate(offset)
+            output.seek(offset)
+            with multiprocessing.get_context('fork').Pool(options['processes']) as pool:
+                for count, (chunk, tunes_tokens, abcs, durations) in enumerate(pool.imap_unordered(generate_chunk, todo), 1):
+                    for tune in self.save_chunk(chunk, tunes_tokens, abcs, durations):
+                        output.write((json.dumps(tune) + '\n').encode())
+                    output.flush()
+                    checkpoint.write(json.dumps({'chunk': self.chunk_key(chunk), 'offset': output.tell()}) + '\n')
+                    checkpoint.flush()
+                    logger.info(f'generatecorpus: chunk {count} of {len(todo)} saved')
+        self.stdout.write(f'{sum(len(x[-1]) for x in todo)} tunes generated')
+
+    def chunks(self, options):
+        '''
+        The parameter grid, as (model, temperature, meter, key, prime tokens, seeds) of at most --chunk seeds.
+        '''
+        seeds = sorted({seed for x in options['seeds'] for seed in x})
+        chunks = []
+        for rnn_model_name in options['models'] or model_names():
+            if rnn_model_name not in models():
+                raise CommandError(f'Unknown model {rnn_model_name}')
+            model = models()[rnn_model_name]
+            meters = options['meters'] or [f"M:{model['default_meter']}"]
+            keys = options['keys'] or [f"K:{model['default_mode']}"]
+            for meter, key in product(meters, keys):
+                if not validate_meter(meter, rnn_model_name) or not validate_key(key, rnn_model_name):
+                    raise CommandError(f'{meter} {key} is not valid for {rnn_model_name}')
+            for temp, meter, key in product(options['temps'], meters, keys):
+                prime_tokens = RNNTune(rnn_model_name=rnn_model_name, meter=meter, key=key).prime_tokens
+                for x in range(0, len(seeds), options['chunk']):
+                    chunks.append((rnn_model_name, temp, meter, key, prime_tokens, seeds[x:x + options['chunk']]))
+        return chunks
+
+    def chunk_key(self, chunk):
+        rnn_model_name, temp, meter, key, prime_tokens, seeds = chunk
+        return f'{rnn_model_name} {temp} {meter} {key} {seeds[0]}-{seeds[-1]}'
+
+    def resume(self, checkpoint_path):
+        '''
+        The chunks finished, and the length of the output up to then.
+        Any partly written last entry is dropped from the checkpoint.
+        '''
+        done, offset, length = set(), 0, 0
+        try:
+            with open(checkpoint_path, 'rb') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line.decode())
+                    except ValueError:
+                        break
+                    if not line.endswith(b'\n'):
+                        break
+                    done.add(entry['chunk'])
+                    offset = entry['offset']
+                    length += len(line)
+            os.truncate(checkpoint_path, length)
+        except FileNotFoundError:
+            pass
+        return done, offset
+
+    def save_chunk(self, chunk, tunes_tokens, abcs, durations):
+        '''
+        Save the chunk's tunes in bulk, reusing any saved before an interruption. Returns the tunes as output.
+        Each is recorded as started its generation time before saving.
+        '''
+        rnn_model_name, temp, meter, key, prime_tokens, seeds = chunk
+        parameters = {'rnn_model_name': rnn_model_name, 'temp': temp, 'meter': meter, 'key': key, 'start_abc': ''}
+        with transaction.atomic():
+            tunes = {x.seed: x for x in RNNTune.objects.filter(**parameters,
+                                                               seed__in=seeds,
+                                                               session__isnull=True,
+                                                               priority=RNNTune.PRIORITY_BULK,
+                                                               rnn_finished__isnull=False,
+                                                               rnn_error='')}
+            finished = now()
+            created = RNNTune.objects.bulk_create(RNNTune(**parameters,
+                                                          seed=x,
+                                                          priority=RNNTune.PRIORITY_BULK,
+                                                          rnn_started=finished - timedelta(seconds=duration),
+                                                          rnn_finished=finished,
+                                                          ) for x, duration in zip(seeds, durations) if x not in tunes)
+            # The ABC needs the ids, so is set after, in one update
+            abcs = dict(zip(seeds, abcs))
+            for tune in created:
+                tune.abc = abc_for(tune, RNNTune(abc=abcs[tune.seed]))
+            if created:
+                RNNTune.objects.filter(id__in=[x.id for x in created])\
+                                .update(abc=Case(*[When(id=x.id, then=Value(x.abc)) for x in created], output_field=TextField()))
+            tunes.update((x.seed, x) for x in created)
+        for seed, tune_tokens in zip(seeds, tunes_tokens):
+            tune_store.write(tunes[seed], tune_tokens, tunes[seed].abc)
+        return [{
+            'id': tunes[seed].id,
+            'rnn_model_name': rnn_model_name,
+            'seed': seed,
+            'temp': temp,
+            'meter': meter,
+            'key': key,
+            'tokens': ' '.join(tune_tokens),
+            'abc': tunes[seed].abc,
+            } for seed, tune_tokens in zip(seeds, tunes_tokens)]
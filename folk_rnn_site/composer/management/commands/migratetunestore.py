@@ -0,0 +1,60 @@
+import os
+import re
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+
+from composer import TUNE_PATH
+from composer.tune_store import store
+
+TUNE_FILENAME_REGEX = re.compile(r'^.+_(\d+)(_raw)?$') # i.e. RNNTune.path, RNNTune.path_raw
+
+class Command(BaseCommand):
+    '''
+    Moves the tunes' files in TUNE_PATH into the tune store, i.e.
+        python3.6 manage.py migratetunestore
+        python3.6 manage.py migratetunestore --delete
+        python3.6 manage.py migratetunestore --rebuild-index
+
+    Tunes already in the store are skipped, so the command can be run again, e.g. if interrupted.
+    With --delete each tune's files are removed once stored. --rebuild-index writes the
+    store's index afresh from its segments, e.g. having restored them from a backup.
+    See composer.tune_store
+    '''
+    help = 'Move the per tune files into the tune store, or rebuild its index.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--delete', action='store_true', help='remove the files once stored')
+        parser.add_argument('--rebuild-index', action='store_true', help='rebuild the index from the segments, and do nothing else')
+
+    def handle(self, *args, **options):
+        if options['rebuild_index']:
+            count = store.rebuild_index()
+            self.stdout.write(f'Index rebuilt, {count} records')
+            return
+
+        files = defaultdict(dict) # tune_id: {'raw': path, 'abc': path}
+        for entry in os.scandir(TUNE_PATH):
+            match = TUNE_FILENAME_REGEX.match(entry.name)
+            if match and entry.is_file():
+                files[int(match.group(1))]['raw' if match.group(2) else 'abc'] = entry.path
+
+        migrated = skipped = 0
+        for tune_id in sorted(files):
+            paths = files[tune_id]
+            if tune_id in store:
+                skipped += 1
+            else:
+                contents = {}
+                for kind in ['raw', 'abc']:
+                    try:
+                        with open(paths[kind]) as f:
+                            contents[kind] = f.read()
+                    except (KeyError, OSError):
+                        contents[kind] = ''
+                store.write(tune_id, contents['raw'].split(' '), contents['abc'])
+                migrated += 1
+            if options['delete']:
+                for path in paths.values():
+                    os.remove(path)
+        self.stdout.write(f'Tunes stored: {migrated}, already stored: {skipped}')
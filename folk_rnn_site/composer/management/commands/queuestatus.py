@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from composer import job_queue
+from composer.models import RNNTune
+
+class Command(BaseCommand):
+    '''
+    Reports the generation queue, i.e.
+        python3.6 manage.py queuestatus
+        python3.6 manage.py queuestatus --tune 1234
+
+    The pending tunes per model and priority, the sessions with most pending,
+    and for any given tunes their place in the queue. See composer.job_queue
+    '''
+    help = 'Report generation queue depth, and tunes\' places in the queue.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tune', type=int, action='append', default=[], help='tune id to report the place of')
+        parser.add_argument('--sessions', type=int, default=10, help='sessions to list, most pending first')
+
+    def handle(self, *args, **options):
+        depth = job_queue.depth()
+        self.stdout.write(f'Pending: {sum(depth.values())}')
+        for (rnn_model_name, priority), count in sorted(depth.items()):
+            self.stdout.write(f'  {rnn_model_name}, priority {priority}: {count}')
+
+        sessions = job_queue.pending().values_list('session').annotate(pending=Count('id')).order_by('-pending')[:options['sessions']]
+        in_flight = job_queue.in_flight([x[0] for x in sessions if x[0] is not None])
+        for session, pending in sessions:
+            self.stdout.write(f'  Session {session}: {pending} pending, {in_flight[session]} generating')
+
+        for tune in RNNTune.objects.filter(id__in=options['tune']):
+            position = job_queue.position(tune)
+            self.stdout.write(f'Tune {tune.id}: ' + (f'{position} ahead' if position is not None else 'not pending'))
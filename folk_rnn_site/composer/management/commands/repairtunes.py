@@ -0,0 +1,55 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from channels.layers import get_channel_layer
+
+from composer import job_queue
+from composer.consumers import request_generation, requeue_expired
+
+class Command(BaseCommand):
+    '''
+    Lists the tunes stuck generating, and with --repair sets them going again, i.e.
+        python3.6 manage.py repairtunes
+        python3.6 manage.py repairtunes --repair --max-age 30
+
+    Tunes whose worker's lease has expired are requeued, or failed if out of attempts, as the
+    pool would. Tunes started without a lease, e.g. their worker died before taking it, or their
+    post-processing was lost, are expired likewise. Tunes attached to a finished tune are failed,
+    and tunes pending over --max-age minutes are asked for again, e.g. their generate message was lost.
+    Only tunes requested within the last --window hours are generated again. Older unfinished tunes,
+    e.g. from before leasing, are failed instead, as nobody is waiting for them. See job_queue.orphans
+    '''
+    help = 'List and repair tunes stuck generating.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true', help='requeue or fail the tunes listed')
+        parser.add_argument('--max-age', type=int, default=10, help='minutes a tune may be started without a lease, or pending, default 10')
+        parser.add_argument('--window', type=int, default=24, help='hours since requested that a tune is still generated, default 24')
+
+    def handle(self, *args, **options):
+        orphans = job_queue.orphans(timedelta(minutes=options['max_age']), timedelta(hours=options['window']))
+        for kind, tunes in orphans.items():
+            tunes = list(tunes.order_by('id'))
+            self.stdout.write(f'{kind.capitalize()}: {len(tunes)}')
+            for tune in tunes:
+                self.stdout.write(f'  Tune {tune.id}, {tune.rnn_model_name}, requested {tune.requested:%Y-%m-%d %H:%M}, attempts {tune.rnn_attempts}')
+        if not options['repair']:
+            return
+
+        pending = list(orphans['pending'])
+        channel_layer = get_channel_layer()
+        requeued, failed = requeue_expired(channel_layer)
+        unleased_requeued, unleased_failed = job_queue.expire(orphans['unleased'])
+        for tune in unleased_requeued:
+            request_generation(channel_layer, tune)
+        followers = list(orphans['followers'])
+        for tune in followers:
+            tune.abc = ''
+            tune.rnn_error = f'Leader tune {tune.rnn_leader_id} finished without it'
+            tune.rnn_finished = tune.rnn_leader.rnn_finished
+            tune.save(update_fields=['abc', 'rnn_error', 'rnn_finished'])
+        for tune in pending:
+            request_generation(channel_layer, tune)
+        abandoned = job_queue.abandon(orphans['abandoned'])
+        self.stdout.write(f'Requeued {len(requeued) + len(unleased_requeued)}, failed {len(failed) + len(unleased_failed) + len(followers)}, '
+                          f'requested again {len(pending)}, abandoned {abandoned}')
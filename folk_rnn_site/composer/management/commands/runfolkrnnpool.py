@@ -0,0 +1,60 @@
+import os
+import logging
+
+from django.core.management.base import BaseCommand
+from channels.layers import get_channel_layer, channel_layers, DEFAULT_CHANNEL_LAYER
+from channels.routing import get_default_application
+
+from composer import STORE_PATH, FOLKRNN_BATCH_SIZE
+from composer.consumers import requeue_expired, refill_pool
+from composer.rnn_models import model_names, folk_rnn_cached, folk_rnn_batch_cached
+from composer.worker_pool import Pool, PoolWorker
+
+logger = logging.getLogger(__name__)
+
+# The pool's housekeeping, i.e. requeuing expired leases and refilling the tune pool, runs every this many seconds
+HOUSEKEEPING_SECONDS = 10
+
+class Command(BaseCommand):
+    '''
+    Runs a pool of folk_rnn workers, i.e. as per `runworker` but with the models 
+    loaded once and shared, e.g.
+        python3.6 manage.py runfolkrnnpool folk_rnn --processes 4
+    
+    The workers' busy/idle state is written to the status file. See worker_pool.py
+    The pool requeues the tunes of any worker that dies mid-generation, see requeue_expired,
+    and tops up the pre-generated tunes, see tune_pool
+    '''
+    help = 'Run a pre-fork pool of workers for the given channels, sharing the loaded models.'
+    
+    def add_arguments(self, parser):
+        parser.add_argument('channels', nargs='+', help='channels to listen on, e.g. folk_rnn')
+        parser.add_argument('--processes', type=int, default=os.cpu_count(), help='number of workers, default the CPU count')
+        parser.add_argument('--models', nargs='*', help='models to load before forking, default all')
+        parser.add_argument('--status-path', default=os.path.join(STORE_PATH, 'pool_status.json'), help='where to write the workers\' state')
+        parser.add_argument('--drain-timeout', type=int, default=120, help='seconds to wait for workers to finish on SIGTERM')
+    
+    def handle(self, *args, **options):
+        folk_rnn_get = folk_rnn_cached if FOLKRNN_BATCH_SIZE == 1 else folk_rnn_batch_cached
+        for rnn_model_name in options['models'] or model_names():
+            folk_rnn_get(rnn_model_name)
+        
+        def run_worker():
+            # As per runworker, in the forked process
+            worker = PoolWorker(
+                        application=get_default_application(),
+                        channels=options['channels'],
+                        channel_layer=get_channel_layer(),
+                        )
+            worker.run()
+        
+        def housekeeping():
+            # The pool's own channel layer, i.e. not the instance the workers inherit
+            if not hasattr(housekeeping, 'channel_layer'):
+                housekeeping.channel_layer = channel_layers.make_backend(DEFAULT_CHANNEL_LAYER)
+            requeue_expired(housekeeping.channel_layer)
+            refill_pool(housekeeping.channel_layer)
+        
+        logger.info(f"Pool of {options['processes']} workers for {', '.join(options['channels'])}")
+        Pool(options['processes'], run_worker, options['status_path'], options['drain_timeout'],
+             housekeeping, HOUSEKEEPING_SECONDS).run()
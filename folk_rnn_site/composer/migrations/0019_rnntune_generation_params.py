@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.16 on 2026-10-18 09:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('composer', '0018_auto_20181126_2130'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='rnntune',
+            index=models.Index(fields=['rnn_model_name', 'seed', 'temp', 'meter', 'key'], name='rnntune_generation_params'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.16 on 2026-10-18 10:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('composer', '0019_rnntune_generation_params'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rnntune',
+            name='rnn_leader',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='followers', to='composer.RNNTune'),
+        ),
+    ]
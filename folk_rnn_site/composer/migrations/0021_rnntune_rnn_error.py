@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.16 on 2026-10-18 11:14
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('composer', '0020_rnntune_rnn_leader'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rnntune',
+            name='rnn_error',
+            field=models.TextField(default=''),
+        ),
+    ]
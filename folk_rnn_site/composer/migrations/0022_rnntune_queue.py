@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.16 on 2026-10-18 14:37
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('composer', '0021_rnntune_rnn_error'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rnntune',
+            name='priority',
+            field=models.SmallIntegerField(default=10),
+        ),
+        migrations.AddField(
+            model_name='rnntune',
+            name='session',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='tunes', to='composer.Session'),
+        ),
+        migrations.AddIndex(
+            model_name='rnntune',
+            index=models.Index(fields=['rnn_model_name', 'rnn_started', 'priority', 'session'], name='rnntune_queue'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.16 on 2026-10-18 16:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('composer', '0022_rnntune_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rnntune',
+            name='rnn_cancelled',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='rnntune',
+            name='rnn_subscribers',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
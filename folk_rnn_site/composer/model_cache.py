@@ -0,0 +1,98 @@
+import logging
+import threading
+from collections import Counter
+from time import monotonic
+
+from composer.precision import widened_nbytes
+
+logger = logging.getLogger(__name__)
+
+class ModelCache:
+    '''
+    Model instances, cached up to a budget of bytes of weights rather than a count,
+    the weights being counted as widened for computing, see precision.widen
+
+    When a model doesn't fit, the instances least requested of late are evicted,
+    i.e. by request count decaying with the half-life in seconds. Pinned models are
+    never evicted. Usage is remembered across evictions, so a model in steady demand
+    displaces one requested once.
+    '''
+    def __init__(self, load_job_spec, max_bytes, pinned=(), half_life=600):
+        self.load_job_spec = load_job_spec
+        self.max_bytes = max_bytes
+        self.pinned = set(pinned)
+        self.half_life = half_life
+        self.entries = {} # (rnn_model_name, create): (instance, bytes)
+        self.usage = {} # (rnn_model_name, create): (score, time)
+        self.counters = Counter()
+        self.load_seconds = Counter()
+        self.lock = threading.Lock()
+
+    def usage_score(self, key, at):
+        score, last = self.usage.get(key, (0, at))
+        return score * 0.5 ** ((at - last) / self.half_life)
+
+    def get(self, rnn_model_name, create):
+        '''
+        The instance create returns for the model's job spec, cached.
+        '''
+        key = (rnn_model_name, create)
+        with self.lock:
+            at = monotonic()
+            self.usage[key] = (self.usage_score(key, at) + 1, at)
+            if key in self.entries:
+                self.counters['hit'] += 1
+                return self.entries[key][0]
+
+            self.counters['miss'] += 1
+            start = monotonic()
+            job_spec = self.load_job_spec(rnn_model_name)
+            size = widened_nbytes(job_spec['param_values'])
+            self.evict(size, at)
+            instance = create(job_spec)
+            self.load_seconds[key] += monotonic() - start
+            self.entries[key] = (instance, size)
+            logger.info(f'Model cache loaded {rnn_model_name} ({create.__name__}) in {monotonic() - start:.3f}s. {self.summary()}')
+            return instance
+
+    def evict(self, size, at):
+        '''
+        Make room for size bytes, evicting the least requested unpinned instances.
+        A model larger than the budget is still loaded, alone but for any pinned.
+        '''
+        while self.entries and self.resident_bytes() + size > self.max_bytes:
+            candidates = [x for x in self.entries if x[0] not in self.pinned]
+            if not candidates:
+                break
+            key = min(candidates, key=lambda x: self.usage_score(x, at))
+            del self.entries[key]
+            self.counters['eviction'] += 1
+            logger.info(f'Model cache evicted {key[0]} ({key[1].__name__})')
+
+    def resident_bytes(self):
+        return sum(x[1] for x in self.entries.values())
+
+    def summary(self):
+        return f"Hits: {self.counters['hit']}, misses: {self.counters['miss']}, evictions: {self.counters['eviction']}, resident: {self.resident_bytes()}/{self.max_bytes} bytes"
+
+    def stats(self):
+        '''
+        Cache statistics, with resident bytes, load time and usage per model instance.
+        '''
+        with self.lock:
+            at = monotonic()
+            return {
+                'hits': self.counters['hit'],
+                'misses': self.counters['miss'],
+                'evictions': self.counters['eviction'],
+                'max_bytes': self.max_bytes,
+                'resident_bytes': self.resident_bytes(),
+                'models': {
+                    f'{name} ({create.__name__})': {
+                        'resident_bytes': self.entries[(name, create)][1] if (name, create) in self.entries else 0,
+                        'load_seconds': self.load_seconds[(name, create)],
+                        'usage': self.usage_score((name, create), at),
+                        'pinned': name in self.pinned,
+                    } for name, create in self.usage
+                },
+            }
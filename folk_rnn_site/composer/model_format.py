@@ -0,0 +1,85 @@
+'''
+The memory-mappable model format.
+
+A model is a directory holding each of the job spec's param_values arrays as a
+.npy file, and the rest of the job spec as meta.json. The weights are loaded
+memory-mapped, read-only, so loading is near instant, and the worker processes
+on a machine share the one copy of each model, i.e. in the page cache.
+
+A model converted to reduced precision, see composer.precision, has its precision
+in meta.json, and each int8 weight matrix's row scales in a .npy file of their own.
+
+The directory sits beside the model's pickle, named as per the pickle with the
+MMAP_SUFFIX, e.g. thesession_with_repeats.mmap. See rnn_models.load_job_spec
+'''
+import os
+import json
+import shutil
+import numpy as np
+
+from composer.precision import QuantizedWeights
+
+MMAP_SUFFIX = '.mmap'
+META_FILENAME = 'meta.json'
+
+def param_filename(idx):
+    return f'param_{idx:03}.npy'
+
+def scale_filename(idx):
+    return f'param_{idx:03}_scale.npy'
+
+def mmap_path(pickle_path):
+    '''
+    Path of the memory-mappable form of the model pickle.
+    '''
+    return os.path.splitext(pickle_path)[0] + MMAP_SUFFIX
+
+def save(job_spec, path, precision='full'):
+    '''
+    Write the job spec in the memory-mappable format, its param_values being at the precision.
+    Written alongside then moved into place, so a loader never sees a partial model.
+    '''
+    meta = {k: v for k, v in job_spec.items() if k != 'param_values'}
+    meta['token2idx'] = {k: int(v) for k, v in meta['token2idx'].items()}
+    meta['param_count'] = len(job_spec['param_values'])
+    meta['precision'] = precision
+    meta['quantized'] = [idx for idx, x in enumerate(job_spec['param_values']) if isinstance(x, QuantizedWeights)]
+
+    tmp_path = path + '.tmp'
+    remove(tmp_path)
+    os.makedirs(tmp_path)
+    for idx, param in enumerate(job_spec['param_values']):
+        if isinstance(param, QuantizedWeights):
+            np.save(os.path.join(tmp_path, scale_filename(idx)), np.ascontiguousarray(param.scale))
+            param = param.q
+        np.save(os.path.join(tmp_path, param_filename(idx)), np.ascontiguousarray(param))
+    with open(os.path.join(tmp_path, META_FILENAME), 'w') as f:
+        json.dump(meta, f, default=lambda x: x.item()) # i.e. NumPy scalars
+
+    remove(path)
+    os.rename(tmp_path, path)
+
+def load_meta(path):
+    '''
+    Read a job spec in the memory-mappable format without its weights, i.e. no param_values.
+    '''
+    with open(os.path.join(path, META_FILENAME)) as f:
+        return json.load(f)
+
+def load(path):
+    '''
+    Read a job spec in the memory-mappable format, the weights mapped read-only.
+    '''
+    job_spec = load_meta(path)
+    param_count = job_spec.pop('param_count')
+    quantized = set(job_spec.pop('quantized', []))
+    def load_param(idx):
+        param = np.load(os.path.join(path, param_filename(idx)), mmap_mode='r')
+        if idx in quantized:
+            return QuantizedWeights(param, np.load(os.path.join(path, scale_filename(idx)), mmap_mode='r'))
+        return param
+    job_spec['param_values'] = [load_param(x) for x in range(param_count)]
+    return job_spec
+
+def remove(path):
+    shutil.rmtree(path, ignore_errors=True)
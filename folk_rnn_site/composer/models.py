@@ -1,10 +1,19 @@
+import os
 from django.db import models
 from folk_rnn_site.models import ABCModel
 from django_hosts.resolvers import reverse
 
+from composer import TUNE_PATH
 from composer.rnn_models import token_for_info_field
 
 class RNNTune(ABCModel):
+    # Generation priority, higher first, see job_queue
+    PRIORITY_SPECULATIVE = -20 # i.e. pre-generated, see tune_pool
+    PRIORITY_UNWATCHED = -10 # i.e. nobody is waiting for it
+    PRIORITY_BULK = 0
+    PRIORITY_DEFERRED = 5 # i.e. by admission control
+    PRIORITY_INTERACTIVE = 10
+    
     def __str__(self):
         return f'RNNTune {self.id}'
         
@@ -17,6 +26,21 @@ class RNNTune(ABCModel):
                             )
         return ' '.join(x for x in prime_token_items if x)
     
+    @property
+    def path(self):
+        '''
+        File path of the formatted ABC, for tunes from before the tune store, see tune_store
+        '''
+        model_name = self.rnn_model_name.replace('.pickle', '')
+        return os.path.join(TUNE_PATH, f'{model_name}_{self.id}')
+    
+    @property
+    def path_raw(self):
+        '''
+        File path of the raw folk-rnn output, i.e. space separated tokens
+        '''
+        return self.path + '_raw'
+    
     @property
     def url(self):
         return reverse('tune', host='composer', kwargs={'tune_id': self.id})
@@ -37,6 +61,7 @@ class RNNTune(ABCModel):
             'requested': self.requested.isoformat(),
             'rnn_started': self.rnn_started.isoformat() if self.rnn_started else None,
             'rnn_finished': self.rnn_finished.isoformat() if self.rnn_finished else None,
+            'rnn_error': self.rnn_error,
             'abc': self.abc,
             'title': self.title,
             'id': self.id,
@@ -53,6 +78,22 @@ class RNNTune(ABCModel):
     requested = models.DateTimeField(auto_now_add=True)
     rnn_started = models.DateTimeField(null=True)
     rnn_finished = models.DateTimeField(null=True)
+    rnn_leader = models.ForeignKey('self', null=True, on_delete=models.SET_NULL, related_name='followers') # an identical generation this tune is finished from
+    rnn_error = models.TextField(default='') # why post-processing failed, if it did
+    session = models.ForeignKey('Session', null=True, on_delete=models.SET_NULL, related_name='tunes')
+    priority = models.SmallIntegerField(default=PRIORITY_INTERACTIVE)
+    rnn_subscribers = models.PositiveIntegerField(default=0) # websockets showing the tune
+    rnn_cancelled = models.DateTimeField(null=True) # generation cancelled, as nobody was listening
+    rnn_lease_expires = models.DateTimeField(null=True) # until when the generating worker holds the tune
+    rnn_attempts = models.PositiveSmallIntegerField(default=0) # generations started, see job_queue.sweep
+    
+    class Meta:
+        indexes = [
+            # Generation is deterministic on these (and start_abc), see generation_cache
+            models.Index(fields=['rnn_model_name', 'seed', 'temp', 'meter', 'key'], name='rnntune_generation_params'),
+            # The queue, see job_queue
+            models.Index(fields=['rnn_model_name', 'rnn_started', 'priority', 'session'], name='rnntune_queue'),
+        ]
     
 class Session(models.Model):
     started = models.DateTimeField(auto_now_add=True)
@@ -0,0 +1,81 @@
+'''
+Reduced precision model weights, see FOLKRNN_PRECISION.
+
+'full' is the weights as trained, 'float32' casts them to float32. 'float16' stores
+the weight matrices as float16, and 'int8' quantizes each weight matrix row to int8
+with a float32 scale. Vectors, i.e. biases, are kept as float32.
+
+The reduced precisions shrink the stored model, i.e. on disk and memory-mapped. The composer
+engines compute in float32, the weights being widened once, on creating the model, as NumPy has
+no int8 or float16 matrix product near as fast as float32's, see widen.
+'''
+import numpy as np
+
+PRECISIONS = ['full', 'float32', 'float16', 'int8']
+
+class QuantizedWeights:
+    '''
+    A weight matrix quantized per row, i.e. row i is q[i] * scale[i].
+    '''
+    def __init__(self, q, scale):
+        self.q = q
+        self.scale = scale
+
+    @classmethod
+    def quantize(cls, weights):
+        weights = np.asarray(weights, dtype=np.float32)
+        scale = np.abs(weights).max(axis=1) / 127
+        scale[scale == 0] = 1
+        q = np.clip(np.rint(weights / scale[:, None]), -127, 127).astype(np.int8)
+        return cls(q, scale.astype(np.float32))
+
+    @property
+    def shape(self):
+        return self.q.shape
+
+    @property
+    def nbytes(self):
+        return self.q.nbytes + self.scale.nbytes
+
+    def dequantize(self):
+        return self.q * self.scale[:, None]
+
+def is_reduced(param):
+    return isinstance(param, QuantizedWeights) or param.dtype == np.float16
+
+def widen(param_values):
+    '''
+    The param_values as the engines compute with them, i.e. reduced precision weights as float32, others as is.
+    '''
+    return [param.dequantize() if isinstance(param, QuantizedWeights)
+            else param.astype(np.float32) if is_reduced(param)
+            else param for param in param_values]
+
+def widened_nbytes(param_values):
+    '''
+    The bytes of the param_values once widened, i.e. the memory a model instance's weights take.
+    '''
+    return sum(int(np.prod(x.shape)) * 4 if is_reduced(x) else x.nbytes for x in param_values)
+
+def convert(param_values, precision):
+    '''
+    The param_values at the precision. Arrays already at that precision are used as is, i.e. not copied.
+    '''
+    if precision not in PRECISIONS:
+        raise ValueError(f'Unknown precision {precision}')
+    converted = []
+    for param in param_values:
+        if isinstance(param, QuantizedWeights):
+            if precision == 'int8':
+                converted.append(param)
+                continue
+            param = param.dequantize()
+        if precision == 'full':
+            converted.append(param)
+        elif np.ndim(param) < 2 or precision == 'float32':
+            converted.append(np.asarray(param).astype(np.float32, copy=False))
+        elif precision == 'float16':
+            converted.append(np.asarray(param).astype(np.float16, copy=False))
+        else:
+            converted.append(QuantizedWeights.quantize(param))
+    return converted
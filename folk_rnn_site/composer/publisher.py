@@ -0,0 +1,120 @@
+'''
+Broadcasting generation updates from the folk_rnn worker.
+
+Sending to the channel layer is a network round-trip, so the worker hands its
+messages to a publisher thread rather than sending them itself, and a tune's abc
+updates are coalesced, i.e. flushed every FOLKRNN_FLUSH_TOKENS tokens,
+FOLKRNN_FLUSH_MS milliseconds, or bar line, rather than sent token by token.
+'''
+import logging
+import queue
+import threading
+import weakref
+from time import monotonic
+from asgiref.sync import async_to_sync
+
+from composer import FOLKRNN_FLUSH_TOKENS, FOLKRNN_FLUSH_MS, FOLKRNN_FLUSH_ON_BAR
+from composer.tune_stream import StreamWriter
+
+logger = logging.getLogger(__name__)
+
+# This process's publishers, i.e. to let their messages go out before exiting
+publishers = weakref.WeakSet()
+
+class Publisher:
+    '''
+    Sends messages to the channel layer in order, from a background thread.
+    With blocking, sends them there and then, i.e. as the worker did before.
+    '''
+    def __init__(self, channel_layer, blocking=False):
+        self.channel_layer = channel_layer
+        self.blocking = blocking
+        self.sent = 0
+        publishers.add(self)
+        if not blocking:
+            self.queue = queue.Queue()
+            self.thread = threading.Thread(target=self.run, name='folk_rnn publisher', daemon=True)
+            self.thread.start()
+
+    def group_send(self, group, message):
+        self.publish('group_send', group, message)
+
+    def send(self, channel, message):
+        self.publish('send', channel, message)
+
+    def publish(self, method, target, message):
+        if self.blocking:
+            self.channel_layer_call(method, target, message)
+        else:
+            self.queue.put((method, target, message))
+
+    def channel_layer_call(self, method, target, message):
+        try:
+            async_to_sync(getattr(self.channel_layer, method))(target, message)
+        except Exception:
+            logger.exception(f'Publisher failed to {method} to {target}')
+        self.sent += 1
+
+    def run(self):
+        while True:
+            self.channel_layer_call(*self.queue.get())
+            self.queue.task_done()
+
+    def join(self):
+        '''
+        Wait until everything published has been sent.
+        '''
+        if not self.blocking:
+            self.queue.join()
+
+class TuneBroadcast:
+    '''
+    A tune's abc updates, coalesced as per the flush policy.
+    Flushing writes the stream before publishing, for consumers joining late. See tune_stream
+    '''
+    def __init__(self, publisher, tune_id, flush_tokens=FOLKRNN_FLUSH_TOKENS, flush_ms=FOLKRNN_FLUSH_MS, flush_on_bar=FOLKRNN_FLUSH_ON_BAR):
+        self.publisher = publisher
+        self.tune_id = tune_id
+        self.flush_tokens = flush_tokens
+        self.flush_ms = flush_ms
+        self.flush_on_bar = flush_on_bar
+        self.stream = StreamWriter(tune_id)
+        self.pending = []
+        self.seq = 0
+        self.flushed = monotonic()
+
+    def on_delta(self, delta, seq):
+        '''
+        The ABCAssembler.feed callback, flushing as per the policy.
+        '''
+        self.pending.append(delta)
+        self.seq = seq
+        if (len(self.pending) >= self.flush_tokens
+                or (self.flush_on_bar and '|' in delta)
+                or (monotonic() - self.flushed) * 1000 >= self.flush_ms):
+            self.flush()
+
+    def flush(self):
+        self.flushed = monotonic()
+        if not self.pending:
+            return
+        delta = ''.join(self.pending)
+        self.pending = []
+        self.stream.write(delta)
+        self.publisher.group_send(
+                                f'tune_{self.tune_id}',
+                                {
+                                    'type': 'generation_status',
+                                    'status': 'new_abc',
+                                    'tune_id': self.tune_id,
+                                    'abc': delta,
+                                    'seq': self.seq,
+                                })
+
+    def close(self):
+        '''
+        Flush anything pending and close the stream, i.e. the tune has been generated.
+        The stream is removed once the tune is finished, see FolkRNNPostConsumer
+        '''
+        self.flush()
+        self.stream.close()
@@ -4,54 +4,179 @@ import functools
 import json
 import logging
 import re
+import hashlib
 from collections import OrderedDict
 
-from composer import MODEL_PATH, FOLKRNN_INSTANCE_CACHE_COUNT
-from folk_rnn import Folk_RNN
+from composer import MODEL_PATH, FOLKRNN_ENGINE, FOLKRNN_PRECISION, FOLKRNN_PREFIX_CACHE_SIZE, FOLKRNN_INSTANCE_CACHE_BYTES, FOLKRNN_INSTANCE_CACHE_PINNED, FOLKRNN_MAX_SEED, FOLKRNN_TUNE_TITLE_CLIENT
+from composer.inference import FolkRNN, FolkRNNBatch
+from composer import model_format
+from composer import precision as model_precision
+from composer.model_cache import ModelCache
 
 logger = logging.getLogger(__name__)
 
 header_m_regex = re.compile(r"M:(\d+)/(\d+)")
 header_k_regex = re.compile(r"K:[A-G][b#]?[A-Za-z]{3}")
 
-@functools.lru_cache(maxsize=FOLKRNN_INSTANCE_CACHE_COUNT)
-def folk_rnn_cached(rnn_model_name):
+def load_job_spec(rnn_model_name, precision=FOLKRNN_PRECISION, original=False):
+    '''
+    The model's job spec, from its memory-mappable form if converted, otherwise its pickle.
+    Models are named by their pickle filename, as per RNNTune.rnn_model_name, whichever form is present.
+    The weights are at the precision, converted on loading unless already, see composer.precision.
+    original reads the pickle regardless, e.g. as the reference for a converted model.
+    '''
     model_path = os.path.join(MODEL_PATH, rnn_model_name)
-    with open(model_path, "rb") as f:
-        job_spec = pickle.load(f)
+    if not original and os.path.isdir(model_format.mmap_path(model_path)):
+        job_spec = model_format.load(model_format.mmap_path(model_path))
+    else:
+        with open(model_path, "rb") as f:
+            job_spec = pickle.load(f)
+    job_spec['param_values'] = model_precision.convert(job_spec['param_values'], precision)
+    return job_spec
+
+def model_names():
+    '''
+    The models in MODEL_PATH, in either form.
+    '''
+    names = set()
+    for filename in os.listdir(MODEL_PATH):
+        if filename.endswith(model_format.MMAP_SUFFIX):
+            names.add(filename[:-len(model_format.MMAP_SUFFIX)] + '.pickle')
+        elif filename.endswith('.pickle'):
+            names.add(filename)
+    return sorted(names)
+
+def header_primes(job_spec):
+    '''
+    The prime tokens of every meter and key combination, i.e. as per RNNTune.prime_tokens without start_abc.
+    '''
+    model = model_metadata(job_spec)
+    meters = [x for x in model['header_m_tokens'] if x != '*'] + ['']
+    keys = [x for x in model['header_k_tokens'] if x != '*'] + ['']
+    def token(x):
+        # Info fields can form the header or be in-line, a model will have one or the other.
+        return x if x in model['tokens'] or not x else f'[{x}]'
+    return [' '.join(token(x) for x in (meter, key) if x) for meter in meters for key in keys]
+
+def create_folk_rnn(job_spec):
+    if FOLKRNN_ENGINE == 'composer':
+        folk_rnn = FolkRNN(
+            job_spec['token2idx'],
+            job_spec['param_values'], 
+            job_spec['num_layers'],
+            '*',
+            FOLKRNN_PREFIX_CACHE_SIZE,
+            )
+        folk_rnn.prewarm(header_primes(job_spec))
+        return folk_rnn
+    # Imported here, so only processes that generate load folk_rnn
+    from folk_rnn import Folk_RNN
+    # folk_rnn takes arrays, not int8 weights
     return Folk_RNN(
         job_spec['token2idx'],
-        job_spec['param_values'], 
+        model_precision.widen(job_spec['param_values']), 
         job_spec['num_layers'],
         '*' 
         )
 
+def create_folk_rnn_batch(job_spec):
+    folk_rnn = FolkRNNBatch(
+        job_spec['token2idx'],
+        job_spec['param_values'], 
+        job_spec['num_layers'],
+        '*',
+        FOLKRNN_PREFIX_CACHE_SIZE,
+        )
+    folk_rnn.prewarm(header_primes(job_spec))
+    return folk_rnn
+
+model_cache = ModelCache(load_job_spec, FOLKRNN_INSTANCE_CACHE_BYTES, pinned=FOLKRNN_INSTANCE_CACHE_PINNED)
+
+def folk_rnn_cached(rnn_model_name):
+    return model_cache.get(rnn_model_name, create_folk_rnn)
+
+def folk_rnn_batch_cached(rnn_model_name):
+    return model_cache.get(rnn_model_name, create_folk_rnn_batch)
+
+# Model metadata, keyed by model file modification, so models() needn't load the models' weights
+MODEL_INDEX_PATH = os.path.join(MODEL_PATH, 'index.json')
+
+def model_metadata(job_spec):
+    '''
+    What the composer needs to know of a model, i.e. its tokens, header tokens and defaults.
+    '''
+    model = {}
+    model['tokens'] = set(job_spec['token2idx'].keys())
+    model['tokens'].add('*')
+    model['display_name'] = job_spec['name']
+    model['display_order'] = job_spec['order']
+    model['header_m_tokens'] = sorted(
+            {header_m_regex.search(x).group(0) for x in model['tokens'] if header_m_regex.search(x)}, 
+            key=lambda x: int(header_m_regex.search(x).group(2)*100) + int(header_m_regex.search(x).group(1))
+                                    ) + ['*']
+    model['header_k_tokens'] = sorted(
+            {header_k_regex.search(x).group(0) for x in model['tokens'] if header_k_regex.search(x)}
+                                    ) + ['*']
+    model['default_meter'] = job_spec['default_meter']
+    model['default_mode'] = job_spec['default_mode']
+    model['default_tempo'] = job_spec['default_tempo']
+    return model
+
+def model_file_key(rnn_model_name):
+    '''
+    Identifies the current model file, i.e. changes if the model is replaced or converted.
+    '''
+    model_path = os.path.join(MODEL_PATH, rnn_model_name)
+    if os.path.isdir(model_format.mmap_path(model_path)):
+        model_path = os.path.join(model_format.mmap_path(model_path), model_format.META_FILENAME)
+    stat = os.stat(model_path)
+    return [model_path, stat.st_mtime_ns, stat.st_size]
+
+def load_model_metadata(rnn_model_name):
+    model_path = os.path.join(MODEL_PATH, rnn_model_name)
+    if os.path.isdir(model_format.mmap_path(model_path)):
+        return model_metadata(model_format.load_meta(model_format.mmap_path(model_path)))
+    return model_metadata(load_job_spec(rnn_model_name))
+
 @functools.lru_cache(maxsize=1)
 def models():
+    '''
+    The models' metadata, in display order. Read from the index, with any model 
+    new or changed since loaded and the index rewritten.
+    '''
+    try:
+        with open(MODEL_INDEX_PATH) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    
     models = {}
-    for filename in os.listdir(MODEL_PATH):
+    changed = False
+    for filename in model_names():
         try:
-            with open(os.path.join(MODEL_PATH, filename), "rb") as f:
-                job_spec = pickle.load(f)
-            model = {}
-            model['tokens'] = set(job_spec['token2idx'].keys())
-            model['tokens'].add('*')
-            model['display_name'] = job_spec['name']
-            model['display_order'] = job_spec['order']
-            model['header_m_tokens'] = sorted(
-                    {header_m_regex.search(x).group(0) for x in model['tokens'] if header_m_regex.search(x)}, 
-                    key=lambda x: int(header_m_regex.search(x).group(2)*100) + int(header_m_regex.search(x).group(1))
-                                            ) + ['*']
-            model['header_k_tokens'] = sorted(
-                    {header_k_regex.search(x).group(0) for x in model['tokens'] if header_k_regex.search(x)}
-                                            ) + ['*']
-            model['default_meter'] = job_spec['default_meter']
-            model['default_mode'] = job_spec['default_mode']
-            model['default_tempo'] = job_spec['default_tempo']
+            key = model_file_key(filename)
+            entry = index.get(filename)
+            if entry is None or entry['key'] != key:
+                model = load_model_metadata(filename)
+                index[filename] = {'key': key, 'model': dict(model, tokens=sorted(model['tokens']))}
+                changed = True
+            else:
+                model = dict(entry['model'], tokens=set(entry['model']['tokens']))
             models[filename] = model
         except:
             logger.warning(f'Error parsing {filename}')
             pass
+    
+    if changed or set(index) != set(models):
+        index = {k: v for k, v in index.items() if k in models}
+        tmp_path = f'{MODEL_INDEX_PATH}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp_path, MODEL_INDEX_PATH)
+        except OSError:
+            logger.warning(f'Could not write model index {MODEL_INDEX_PATH}')
+    
     return OrderedDict(sorted(models.items(), key=lambda x: x[1]['display_order']))
 
 def models_json():
@@ -62,6 +187,22 @@ def models_json():
             raise TypeError
     return json.dumps(models(), default=set_encoder)
 
+@functools.lru_cache(maxsize=1)
+def models_manifest():
+    '''
+    The client's model manifest, i.e. the folkrnn.models script, and a hash of its content to fingerprint its URL.
+    '''
+    js =  '// Auto-generated by composer package \n'
+    js += '// See rnn_models.py \n'
+    js += ' \n'
+    js += 'if (typeof folkrnn == "undefined") \n'
+    js += '    folkrnn = {}; \n'
+    js += ' \n'
+    js += f'folkrnn.tuneTitle = "{FOLKRNN_TUNE_TITLE_CLIENT}"; \n'
+    js += f'folkrnn.maxSeed = {FOLKRNN_MAX_SEED}; \n'
+    js += 'folkrnn.models = ' + models_json() + '; \n'
+    return js, hashlib.sha1(js.encode()).hexdigest()[:16]
+
 def choices():
     return ((x, models()[x]['display_name']) for x in models())
 
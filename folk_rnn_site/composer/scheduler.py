@@ -0,0 +1,95 @@
+'''
+Continuous batching of generation, see FolkRNNConsumer.generate.
+
+A model's tunes generate together, one batched LSTM step per token. At step
+boundaries the model's pending tunes join the batch, up to its maximum size,
+and a finished tune leaves the batch there and then.
+'''
+from collections import Counter
+from time import monotonic
+
+class BatchScheduler:
+    '''
+    Decides when a batch admits pending tunes, keeping batch occupancy and queue wait metrics.
+
+    Pending tunes are looked for at most every admit_ms, so the database isn't queried
+    every step. While a step takes longer than step_target_ms the batch doesn't grow,
+    i.e. tokens keep streaming at a steady pace rather than the batch always filling.
+    '''
+    def __init__(self, max_batch_size, admit_ms, step_target_ms):
+        self.max_batch_size = max_batch_size
+        self.admit_seconds = admit_ms / 1000
+        self.step_target_seconds = step_target_ms / 1000
+        self.counters = Counter()
+        self.step_seconds = 0.0
+        self.queue_wait_seconds = 0.0
+        self.queue_wait_max = 0.0
+        self.last_step = None
+        self.last_active = 0
+        self.last_admit = 0.0
+
+    def start(self, tunes):
+        '''
+        A batch is starting with the tunes.
+        '''
+        self.last_step = None
+        self.last_admit = monotonic()
+        self.record_queue_wait(tunes)
+
+    def admit(self, active, claim):
+        '''
+        At a step boundary with active tunes generating, claim any pending tunes to join the batch.
+        claim is called with the number of free rows, returning the tunes claimed.
+        '''
+        at = monotonic()
+        step = None
+        if self.last_step is not None:
+            step = at - self.last_step
+            self.counters['steps'] += 1
+            self.counters['rows'] += self.last_active
+            self.step_seconds += step
+        self.last_step = at
+        self.last_active = active
+
+        free = self.max_batch_size - active
+        if free <= 0 or at - self.last_admit < self.admit_seconds:
+            return []
+        if active and step is not None and step > self.step_target_seconds:
+            self.counters['held'] += 1
+            return []
+        self.last_admit = at
+        tunes = claim(free)
+        self.counters['admitted'] += len(tunes)
+        self.record_queue_wait(tunes)
+        self.last_active += len(tunes)
+        return tunes
+
+    def record_queue_wait(self, tunes):
+        for tune in tunes:
+            wait = (tune.rnn_started - tune.requested).total_seconds()
+            self.counters['tunes'] += 1
+            self.queue_wait_seconds += wait
+            self.queue_wait_max = max(self.queue_wait_max, wait)
+
+    def stats(self):
+        '''
+        Batch occupancy, i.e. the mean fraction of the maximum batch size generating each step,
+        and queue wait, i.e. from a tune's request to its generation starting, in seconds.
+        '''
+        steps = self.counters['steps']
+        tunes = self.counters['tunes']
+        return {
+            'steps': steps,
+            'mean_step_seconds': self.step_seconds / steps if steps else 0,
+            'occupancy': self.counters['rows'] / steps / self.max_batch_size if steps else 0,
+            'tunes': tunes,
+            'admitted': self.counters['admitted'],
+            'held': self.counters['held'],
+            'mean_queue_wait_seconds': self.queue_wait_seconds / tunes if tunes else 0,
+            'max_queue_wait_seconds': self.queue_wait_max,
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return (f"Steps: {stats['steps']}, {stats['mean_step_seconds'] * 1000:.1f}ms mean, occupancy {stats['occupancy']:.0%}. "
+                f"Tunes: {stats['tunes']}, admitted mid-batch {stats['admitted']}, queue wait {stats['mean_queue_wait_seconds']:.2f}s mean, {stats['max_queue_wait_seconds']:.2f}s max")
@@ -290,6 +290,7 @@ folkrnn.generateRequest = function () {
         formData.key = folkrnn.fieldKey.value;
         formData.meter = folkrnn.fieldMeter.value;
         formData.start_abc = folkrnn.parseABC(folkrnn.fieldStartABC.value).tokens.join(' ');
+        formData.autoseed = Boolean(folkrnn.fieldSeed.dataset.autoseed);
         
         folkrnn.websocketSend({
                     'command': 'compose',
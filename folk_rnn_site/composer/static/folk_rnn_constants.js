@@ -4,4 +4,5 @@
 if (typeof folkrnn == 'undefined')
     folkrnn = {};
     
-folkrnn.waitingABC = 'Waiting for folk-rnn...';
\ No newline at end of file
+folkrnn.waitingABC = 'Waiting for folk-rnn...';
+folkrnn.composeRefused = 'folk-rnn is busy right now, please try again in a while.';
@@ -20,8 +20,21 @@ folkrnn.websocketSend = function(json) {
         folkrnn.socket.listen(folkrnn.websocketReceive);
         
         // Empty queue once connected
+        // On reconnecting, the server has a new consumer, so register again for unfinished tunes, resuming from the abc we have.
         folkrnn.socket.socket.addEventListener('open', function() {
             console.log("Connected to WebSocket");
+            if (folkrnn.websocketSend.connected) {
+                for (const tune_id of Object.keys(folkrnn.tuneManager.tunes)) {
+                    if ('abcjs' in folkrnn.tuneManager.tunes[tune_id])
+                        continue;
+                    folkrnn.websocketSend.queue.unshift({
+                        command: "register_for_tune",
+                        tune_id: tune_id,
+                        seq: folkrnn.tuneManager.tunes[tune_id].seq || 0,
+                    });
+                }
+            }
+            folkrnn.websocketSend.connected = true;
             folkrnn.websocketSend();
         });
     }
@@ -61,10 +74,30 @@ folkrnn.websocketReceive = function(action, stream) {
             folkrnn.tuneManager.enableABCJS(action.tune.id);
         }
     }
+    if (action.command == "queue_status") {
+        // The tune's place in the queue while it waits to be generated
+        const el_abc = document.getElementById("abc-" + action.tune_id);
+        if (el_abc && el_abc.value.startsWith(folkrnn.waitingABC)) {
+            let status = folkrnn.waitingABC + "\n" + action.position + " ahead";
+            if (action.wait_seconds !== null)
+                status += ", starting in about " + Math.ceil(action.wait_seconds) + "s";
+            if (action.deferred)
+                status += " (deferred, the composer is busy)";
+            el_abc.value = status;
+        }
+    }
+    if (action.command == "compose_refused") {
+        window.alert(folkrnn.composeRefused);
+    }
     if (action.command == "add_token") {
+        // The token is the abc new since the previous, with seq the length of abc received
+        const tune = folkrnn.tuneManager.tunes[action.tune_id];
+        if (action.seq <= (tune.seq || 0))
+            return;
+        tune.seq = action.seq;
         const el_tune = folkrnn.tuneManager.tuneDiv(action.tune_id);
         const el_abc = el_tune.querySelector('#abc-'+action.tune_id);
-        if (el_abc.value == folkrnn.waitingABC)
+        if (el_abc.value.startsWith(folkrnn.waitingABC))
             el_abc.value = "";
         el_abc.value += action.token;
         if (action.token.includes("|")) 
@@ -2,13 +2,33 @@ from django.test import TestCase
 from django.utils.timezone import now
 from datetime import timedelta
 from time import sleep
+import os
+import json
+import tempfile
+import numpy as np
+from unittest import mock, skipUnless
+from collections import Counter
 
-from folk_rnn_site.tests import ABC_TITLE, ABC_BODY, mint_abc
-from composer.models import RNNTune
+from folk_rnn_site.tests import ABC_TITLE, ABC_BODY, mint_abc, FOLKRNN_IN, FOLKRNN_OUT_RAW, FOLKRNN_OUT
+from composer.models import RNNTune, Session
+from composer.rnn_models import folk_rnn_cached, folk_rnn_batch_cached, load_job_spec
+from composer.inference import FolkRNN, FolkRNNBatch
+from composer import model_format, rnn_models, precision
+from composer.model_cache import ModelCache
+from composer.consumers import model_channel
+from composer import generation_cache, tune_stream, tune_store, job_queue, tune_pool
+from composer import FOLKRNN_MAX_ATTEMPTS, FOLKRNN_POOL_HIGH
+from composer.publisher import TuneBroadcast
+from composer.abc_assembler import ABCAssembler
+from composer.scheduler import BatchScheduler
 from archiver.models import Tune
+try:
+    from folk_rnn import Folk_RNN
+except ImportError:
+    Folk_RNN = None
 
-def folk_rnn_create_tune(seed=123, temp=0.1, prime_tokens='a b c'):
-    return RNNTune.objects.create(rnn_model_name='with_repeats.pickle', seed=seed, temp=temp, meter='M:4/4', key='K:Cmaj', start_abc=prime_tokens)
+def folk_rnn_create_tune(seed=123, temp=0.1, prime_tokens='a b c', **kwargs):
+    return RNNTune.objects.create(rnn_model_name='with_repeats.pickle', seed=seed, temp=temp, meter='M:4/4', key='K:Cmaj', start_abc=prime_tokens, **kwargs)
 
 def folk_rnn_task_start_mock():
     tune = RNNTune.objects.first()
@@ -62,6 +82,21 @@ class ViewsTest(TestCase):
         response = self.client.post(f'/tune/{RNNTune.objects.last().id}/archive', {'title':'A new title'})
         self.assertEqual(response.status_code, 302)
         self.assertEqual(response['location'], archive_url) # Not a new tune
+    
+    def test_models_js_is_fingerprinted_and_cacheable(self):
+        js, digest = rnn_models.models_manifest()
+        response = self.client.get('/')
+        self.assertContains(response, f'/models/{digest}.js')
+        
+        response = self.client.get(f'/models/{digest}.js')
+        self.assertEqual(response.content.decode(), js)
+        self.assertIn('folkrnn.models = ', js)
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+        self.assertIn('immutable', response['Cache-Control'])
+        
+        response = self.client.get('/models/0123456789abcdef.js')
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['location'].endswith(f'/models/{digest}.js'))
 
 class RNNTuneModelTest(TestCase):
     
@@ -110,4 +145,491 @@ class RNNTuneModelTest(TestCase):
         self.assertEqual(tune.prime_tokens, 'M:4/4 a b c')
         
         tune = RNNTune(meter='M:4/4', key='K:Cmaj', start_abc='a b c')
-        self.assertEqual(tune.prime_tokens, 'M:4/4 K:Cmaj a b c')     
\ No newline at end of file
+        self.assertEqual(tune.prime_tokens, 'M:4/4 K:Cmaj a b c')     
+
+class FolkRNNBatchTest(TestCase):
+    
+    def test_batch_matches_single(self):
+        rnn_model_name = FOLKRNN_IN['rnn_model_name']
+        jobs = [
+            {'seed': 42, 'temperature': 1, 'prime_tokens': ''},
+            {'seed': 123, 'temperature': 0.5, 'prime_tokens': 'M:4/4 K:Cmaj a b c'},
+            {'seed': 42, 'temperature': 1, 'prime_tokens': ''},
+            {'seed': 7, 'temperature': 2, 'prime_tokens': 'M:4/4 * a b c'},
+        ]
+        tunes_tokens = folk_rnn_batch_cached(rnn_model_name).generate_tunes(jobs)
+        self.assertEqual(' '.join(tunes_tokens[0]), FOLKRNN_OUT_RAW)
+        self.assertEqual(tunes_tokens[0], tunes_tokens[2])
+        
+        folk_rnn = folk_rnn_cached(rnn_model_name)
+        for job, tune_tokens in zip(jobs, tunes_tokens):
+            folk_rnn.seed_tune(job['prime_tokens'] if job['prime_tokens'] else None)
+            self.assertEqual(tune_tokens, folk_rnn.generate_tune(
+                                            random_number_generator_seed=job['seed'],
+                                            temperature=job['temperature'],
+                                            ))
+
+    def test_jobs_join_and_leave(self):
+        folk_rnn = folk_rnn_batch_cached(FOLKRNN_IN['rnn_model_name'])
+        jobs = [{'seed': x, 'temperature': 1, 'prime_tokens': 'M:4/4 K:Cmaj' if x % 2 else ''} for x in range(6)]
+        finished = {}
+        for job in jobs:
+            job['on_finish'] = lambda tune_tokens, seed=job['seed']: finished.setdefault(seed, tune_tokens)
+        pending = jobs[2:]
+        def admit(active):
+            # A job joins whenever fewer than three generate
+            return [pending.pop(0)] if pending and active < 3 else []
+        tunes_tokens = folk_rnn.generate_tunes(jobs[:2], admit)
+        
+        self.assertEqual(tunes_tokens, folk_rnn.generate_tunes(jobs))
+        self.assertEqual([finished[x['seed']] for x in jobs], tunes_tokens)
+
+class BatchSchedulerTest(TestCase):
+    
+    def test_admits_up_to_batch_size(self):
+        scheduler = BatchScheduler(4, admit_ms=0, step_target_ms=1000)
+        tune = RNNTune(requested=now() - timedelta(seconds=2), rnn_started=now())
+        scheduler.start([tune])
+        self.assertEqual(scheduler.admit(1, lambda count: [tune] * count), [tune] * 3)
+        self.assertEqual(scheduler.admit(4, lambda count: self.fail('Batch is full')), [])
+        
+        stats = scheduler.stats()
+        self.assertEqual(stats['tunes'], 4)
+        self.assertEqual(stats['admitted'], 3)
+        self.assertEqual(stats['steps'], 1)
+        self.assertEqual(stats['occupancy'], 1)
+        self.assertAlmostEqual(stats['mean_queue_wait_seconds'], 2, places=1)
+    
+    def test_holds_while_steps_are_slow(self):
+        scheduler = BatchScheduler(4, admit_ms=0, step_target_ms=0)
+        scheduler.start([])
+        scheduler.admit(1, lambda count: [])
+        sleep(0.01)
+        self.assertEqual(scheduler.admit(1, lambda count: self.fail('Step is slow')), [])
+        self.assertEqual(scheduler.stats()['held'], 1)
+
+class FolkRNNTest(TestCase):
+    
+    def test_matches_folk_rnn(self):
+        job_spec = load_job_spec(FOLKRNN_IN['rnn_model_name'])
+        folk_rnn = FolkRNN(job_spec['token2idx'], job_spec['param_values'], job_spec['num_layers'], '*')
+        folk_rnn.seed_tune(None)
+        tokens = []
+        tune_tokens = folk_rnn.generate_tune(random_number_generator_seed=FOLKRNN_IN['seed'], temperature=FOLKRNN_IN['temp'], on_token_callback=tokens.append)
+        self.assertEqual(' '.join(tune_tokens), FOLKRNN_OUT_RAW)
+        self.assertEqual(tokens, tune_tokens)
+        
+        reference = folk_rnn_cached(FOLKRNN_IN['rnn_model_name'])
+        for seed, temperature, prime_tokens in [(123, 0.5, 'M:4/4 K:Cmaj a b c'), (7, 2, 'M:4/4 * a b c'), (42, 1, None)]:
+            folk_rnn.seed_tune(prime_tokens)
+            reference.seed_tune(prime_tokens)
+            self.assertEqual(
+                folk_rnn.generate_tune(random_number_generator_seed=seed, temperature=temperature),
+                reference.generate_tune(random_number_generator_seed=seed, temperature=temperature),
+                )
+
+@skipUnless(Folk_RNN, 'needs the folk_rnn library')
+class FolkRNNParityTest(TestCase):
+    '''
+    The composer engines against folk_rnn itself, i.e. not only its output for one seed, FOLKRNN_OUT_RAW.
+    '''
+    def test_engines_match_folk_rnn(self):
+        job_spec = load_job_spec(FOLKRNN_IN['rnn_model_name'])
+        args = (job_spec['token2idx'], job_spec['param_values'], job_spec['num_layers'], '*')
+        reference = Folk_RNN(*args)
+        folk_rnn = FolkRNN(*args)
+        jobs = []
+        expected = []
+        for seed, temperature, prime_tokens in [(42, 1, None), (123, 0.5, 'M:4/4 K:Cmaj a b c'), (7, 2, 'M:4/4 * a b c'), (999, 1, '* * c'), (0, 0.1, 'M:6/8')]:
+            reference.seed_tune(prime_tokens)
+            expected.append(reference.generate_tune(random_number_generator_seed=seed, temperature=temperature))
+            folk_rnn.seed_tune(prime_tokens)
+            self.assertEqual(folk_rnn.generate_tune(random_number_generator_seed=seed, temperature=temperature), expected[-1])
+            jobs.append({'seed': seed, 'temperature': temperature, 'prime_tokens': prime_tokens or ''})
+        self.assertEqual(FolkRNNBatch(*args).generate_tunes(jobs), expected)
+
+class PrefixCacheTest(TestCase):
+    
+    def test_primed_state_matches_reading_prime(self):
+        job_spec = load_job_spec(FOLKRNN_IN['rnn_model_name'])
+        args = (job_spec['token2idx'], job_spec['param_values'], job_spec['num_layers'], '*')
+        primes = ['M:4/4 K:Cmaj', 'M:4/4 K:Cmaj a b c', 'M:4/4 * a b c', '']
+        jobs = [{'seed': 123, 'temperature': 0.5, 'prime_tokens': x} for x in primes]
+        
+        uncached = FolkRNN(*args)
+        cached = FolkRNN(*args, prefix_cache_size=8)
+        cached.prewarm(rnn_models.header_primes(job_spec))
+        self.assertEqual(len(cached.prefix_states), 8) # the most recent header primes
+        for prime_tokens in primes:
+            uncached.seed_tune(prime_tokens)
+            cached.seed_tune(prime_tokens)
+            tokens = []
+            self.assertEqual(
+                cached.generate_tune(random_number_generator_seed=123, temperature=0.5, on_token_callback=tokens.append),
+                uncached.generate_tune(random_number_generator_seed=123, temperature=0.5),
+                )
+            if prime_tokens and '*' not in prime_tokens:
+                self.assertEqual(tokens[:len(prime_tokens.split(' '))], prime_tokens.split(' '))
+        
+        batch = FolkRNNBatch(*args, prefix_cache_size=8)
+        self.assertEqual(batch.generate_tunes(jobs), FolkRNNBatch(*args).generate_tunes(jobs))
+        self.assertEqual(batch.generate_tunes(jobs), FolkRNNBatch(*args).generate_tunes(jobs))
+        self.assertEqual(batch.prefix_counters, {'miss': 3, 'hit': 3})
+
+class ModelFormatTest(TestCase):
+    
+    def test_mmap_matches_pickle(self):
+        job_spec = load_job_spec(FOLKRNN_IN['rnn_model_name'])
+        with tempfile.TemporaryDirectory() as tmp:
+            path = model_format.mmap_path(os.path.join(tmp, FOLKRNN_IN['rnn_model_name']))
+            model_format.save(job_spec, path)
+            converted = model_format.load(path)
+            
+            self.assertEqual(converted['token2idx'], job_spec['token2idx'])
+            self.assertEqual(converted['num_layers'], job_spec['num_layers'])
+            for x, y in zip(converted['param_values'], job_spec['param_values']):
+                self.assertIsInstance(x, np.memmap)
+                self.assertTrue(np.array_equal(x, y))
+            
+            folk_rnn = FolkRNNBatch(converted['token2idx'], converted['param_values'], converted['num_layers'], '*')
+            tunes_tokens = folk_rnn.generate_tunes([{'seed': 42, 'temperature': 1, 'prime_tokens': ''}])
+            self.assertEqual(' '.join(tunes_tokens[0]), FOLKRNN_OUT_RAW)
+
+class PrecisionTest(TestCase):
+    
+    def test_int8_is_within_half_a_step_per_row(self):
+        weights = np.random.RandomState(0).randn(20, 30).astype(np.float32)
+        quantized = precision.QuantizedWeights.quantize(weights)
+        self.assertEqual(quantized.q.dtype, np.int8)
+        self.assertTrue(np.all(np.abs(quantized.dequantize() - weights) <= quantized.scale[:, None] * 0.5001))
+    
+    def test_widened_once_as_float32(self):
+        weights = np.random.RandomState(0).randn(20, 30).astype(np.float32)
+        quantized = precision.QuantizedWeights.quantize(weights)
+        bias = np.zeros(30, dtype=np.float32)
+        widened = precision.widen([quantized, weights.astype(np.float16), bias])
+        self.assertTrue(all(x.dtype == np.float32 for x in widened))
+        self.assertTrue(np.array_equal(widened[0], quantized.dequantize()))
+        self.assertIs(widened[2], bias)
+        self.assertEqual(precision.widened_nbytes([quantized, weights.astype(np.float16), bias]), sum(x.nbytes for x in widened))
+    
+    def test_reduced_precision_generates(self):
+        job_spec = load_job_spec(FOLKRNN_IN['rnn_model_name'], 'full')
+        full_bytes = sum(x.nbytes for x in job_spec['param_values'])
+        for name in ['float16', 'int8']:
+            param_values = precision.convert(job_spec['param_values'], name)
+            self.assertLess(sum(x.nbytes for x in param_values), full_bytes)
+            with tempfile.TemporaryDirectory() as tmp:
+                path = model_format.mmap_path(os.path.join(tmp, FOLKRNN_IN['rnn_model_name']))
+                model_format.save(dict(job_spec, param_values=param_values), path, name)
+                converted = model_format.load(path)
+                self.assertEqual(converted['precision'], name)
+                
+                folk_rnn = FolkRNN(job_spec['token2idx'], param_values, job_spec['num_layers'], '*')
+                folk_rnn_converted = FolkRNN(converted['token2idx'], converted['param_values'], converted['num_layers'], '*')
+                tune_tokens = folk_rnn.generate_tune(random_number_generator_seed=42)
+                self.assertEqual(folk_rnn_converted.generate_tune(random_number_generator_seed=42), tune_tokens)
+            folk_rnn_batch = FolkRNNBatch(job_spec['token2idx'], param_values, job_spec['num_layers'], '*')
+            self.assertEqual(folk_rnn_batch.generate_tunes([{'seed': 42, 'temperature': 1, 'prime_tokens': ''}])[0], tune_tokens)
+            self.assertLess(folk_rnn.log_likelihood(tune_tokens), 0)
+
+class ModelCacheTest(TestCase):
+    
+    def test_budget_eviction_and_pinning(self):
+        job_spec = lambda name: {'param_values': [np.zeros(100, dtype='float32')]} # 400 bytes
+        create = lambda job_spec: object()
+        cache = ModelCache(job_spec, max_bytes=1200, pinned=['pinned'])
+        
+        pinned = cache.get('pinned', create)
+        a = cache.get('a', create)
+        self.assertIs(cache.get('a', create), a)
+        b = cache.get('b', create)
+        self.assertEqual(cache.resident_bytes(), 1200)
+        
+        # c doesn't fit. b has been requested less than a, so is evicted, and pinned never is.
+        cache.get('c', create)
+        self.assertEqual(cache.resident_bytes(), 1200)
+        self.assertIs(cache.get('a', create), a)
+        self.assertIs(cache.get('pinned', create), pinned)
+        self.assertIsNot(cache.get('b', create), b)
+        
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 3)
+        self.assertEqual(stats['misses'], 5)
+        self.assertEqual(stats['evictions'], 2)
+        self.assertEqual(stats['resident_bytes'], 1200)
+        self.assertEqual(stats['models']['pinned (<lambda>)']['resident_bytes'], 400)
+        self.assertTrue(stats['models']['pinned (<lambda>)']['pinned'])
+
+class ModelIndexTest(TestCase):
+    
+    def test_models_from_index(self):
+        rnn_models.models.cache_clear()
+        built = rnn_models.models()
+        with open(rnn_models.MODEL_INDEX_PATH) as f:
+            index = json.load(f)
+        self.assertEqual(set(index), set(built))
+        self.assertEqual(index[FOLKRNN_IN['rnn_model_name']]['key'], rnn_models.model_file_key(FOLKRNN_IN['rnn_model_name']))
+        
+        rnn_models.models.cache_clear()
+        self.assertEqual(rnn_models.models(), built)
+        self.assertIsInstance(rnn_models.models()[FOLKRNN_IN['rnn_model_name']]['tokens'], set)
+
+class ModelChannelTest(TestCase):
+    
+    def test_model_channel(self):
+        self.assertEqual(model_channel('thesession_with_repeats.pickle'), 'folk_rnn.thesession_with_repeats')
+        self.assertEqual(model_channel('folkwiki.se (v2).pickle'), 'folk_rnn.folkwiki_se__v2_')
+
+class GenerationCacheTest(TestCase):
+    
+    def test_attach_to_generation_in_progress(self):
+        leader = folk_rnn_create_tune()
+        follower = folk_rnn_create_tune()
+        other = folk_rnn_create_tune(seed=321)
+        
+        self.assertEqual(generation_cache.attach(follower), leader)
+        self.assertEqual(generation_cache.attach(other), None)
+        
+        taken = generation_cache.take_followers(leader)
+        self.assertEqual(taken, [follower])
+        self.assertIsNotNone(taken[0].rnn_started)
+        self.assertEqual(generation_cache.take_followers(leader), [])
+        self.assertFalse(generation_cache.detach(follower))
+    
+    def test_no_attach_to_finished_generation(self):
+        leader = folk_rnn_create_tune()
+        leader.rnn_started = now()
+        leader.rnn_finished = now()
+        leader.save()
+        follower = folk_rnn_create_tune()
+        
+        self.assertEqual(generation_cache.attach(follower), None)
+        self.assertEqual(RNNTune.objects.get(id=follower.id).rnn_leader, None)
+
+class JobQueueTest(TestCase):
+    
+    def test_allocate_round_robin_by_priority(self):
+        groups = [
+            {'session': 1, 'priority': RNNTune.PRIORITY_INTERACTIVE, 'pending': 50, 'oldest': 1},
+            {'session': 2, 'priority': RNNTune.PRIORITY_INTERACTIVE, 'pending': 1, 'oldest': 2},
+            {'session': 3, 'priority': RNNTune.PRIORITY_INTERACTIVE, 'pending': 3, 'oldest': 3},
+            {'session': None, 'priority': RNNTune.PRIORITY_BULK, 'pending': 10, 'oldest': 0},
+        ]
+        allocation = job_queue.allocate(groups, Counter({3: 1}), 8, 3)
+        self.assertEqual(allocation, {(1, RNNTune.PRIORITY_INTERACTIVE): 3, (2, RNNTune.PRIORITY_INTERACTIVE): 1, (3, RNNTune.PRIORITY_INTERACTIVE): 2, (None, RNNTune.PRIORITY_BULK): 2})
+    
+    def test_claim_is_fair(self):
+        session_a, session_b = Session.objects.create(), Session.objects.create()
+        tunes_a = [folk_rnn_create_tune(seed=x, session=session_a) for x in range(5)]
+        tune_b = folk_rnn_create_tune(session=session_b)
+        bulk = folk_rnn_create_tune(priority=RNNTune.PRIORITY_BULK)
+        
+        self.assertEqual(job_queue.position(tunes_a[0]), 0)
+        self.assertEqual(job_queue.position(tune_b), 1)
+        self.assertEqual(job_queue.position(tunes_a[2]), 3)
+        self.assertEqual(job_queue.position(bulk), 6)
+        self.assertEqual(job_queue.depth(), {('with_repeats.pickle', RNNTune.PRIORITY_INTERACTIVE): 6, ('with_repeats.pickle', RNNTune.PRIORITY_BULK): 1})
+        
+        claimed = job_queue.claim('with_repeats.pickle', 3)
+        self.assertCountEqual(claimed, [tunes_a[0], tune_b, tunes_a[1]])
+        self.assertIsNone(job_queue.position(tune_b))
+        self.assertEqual(job_queue.in_flight([session_a.id]), {session_a.id: 2})
+
+    def test_unwatched_generation_is_cancelled(self):
+        tune = folk_rnn_create_tune()
+        job_queue.subscribe(tune.id)
+        job_queue.unsubscribe(tune.id)
+        self.assertEqual(RNNTune.objects.get(id=tune.id).priority, RNNTune.PRIORITY_UNWATCHED)
+        job_queue.subscribe(tune.id)
+        self.assertEqual(RNNTune.objects.get(id=tune.id).priority, RNNTune.PRIORITY_INTERACTIVE)
+        
+        leader = folk_rnn_create_tune(seed=1, rnn_started=now())
+        follower = folk_rnn_create_tune(seed=1, rnn_leader=leader)
+        job_queue.subscribe(leader.id)
+        job_queue.subscribe(follower.id)
+        job_queue.unsubscribe(leader.id)
+        self.assertIsNone(RNNTune.objects.get(id=leader.id).rnn_cancelled)
+        job_queue.unsubscribe(follower.id)
+        self.assertIsNotNone(RNNTune.objects.get(id=leader.id).rnn_cancelled)
+        job_queue.subscribe(follower.id)
+        self.assertIsNone(RNNTune.objects.get(id=leader.id).rnn_cancelled)
+
+    def test_expired_lease_is_requeued_then_failed(self):
+        leader = folk_rnn_create_tune()
+        follower = folk_rnn_create_tune(rnn_leader=leader, rnn_started=now())
+        for attempt in range(1, FOLKRNN_MAX_ATTEMPTS + 1):
+            [claimed] = job_queue.claim('with_repeats.pickle', 1)
+            self.assertEqual(claimed.rnn_attempts, attempt)
+            self.assertEqual(job_queue.renew([claimed]), {leader.id})
+            self.assertEqual(job_queue.sweep(), ([], []))
+
+            RNNTune.objects.filter(id=leader.id).update(rnn_lease_expires=now() - timedelta(seconds=1))
+            requeued, failed = job_queue.sweep()
+            self.assertEqual(job_queue.renew([claimed]), set())
+            if attempt < FOLKRNN_MAX_ATTEMPTS:
+                self.assertEqual(requeued, [leader])
+                self.assertIsNone(requeued[0].rnn_started)
+                self.assertIsNone(RNNTune.objects.get(id=follower.id).rnn_started)
+        self.assertEqual(requeued, [])
+        self.assertCountEqual(failed, [leader, follower])
+        self.assertTrue(all(x.rnn_finished and x.rnn_error for x in failed))
+
+    def test_released_lease_is_not_requeued(self):
+        tune = folk_rnn_create_tune()
+        [claimed] = job_queue.claim('with_repeats.pickle', 1)
+        self.assertEqual(job_queue.release([claimed]), {tune.id})
+        self.assertIsNone(RNNTune.objects.get(id=tune.id).rnn_lease_expires)
+        self.assertEqual(job_queue.sweep(), ([], []))
+        self.assertEqual(job_queue.release([claimed]), set())
+        self.assertEqual(job_queue.renew([claimed]), set())
+
+    def test_orphans_before_window_are_abandoned(self):
+        old = folk_rnn_create_tune(rnn_started=now() - timedelta(days=400))
+        recent = folk_rnn_create_tune(seed=1, rnn_started=now() - timedelta(minutes=20))
+        RNNTune.objects.filter(id=old.id).update(requested=now() - timedelta(days=400))
+        orphans = job_queue.orphans(timedelta(minutes=10), timedelta(days=1))
+        self.assertEqual(list(orphans['unleased']), [recent])
+        self.assertEqual(list(orphans['abandoned']), [old])
+        
+        self.assertEqual(job_queue.abandon(orphans['abandoned']), 1)
+        old.refresh_from_db()
+        self.assertIsNotNone(old.rnn_finished)
+        self.assertNotEqual(old.rnn_error, '')
+        self.assertEqual(list(job_queue.orphans(timedelta(minutes=10), timedelta(days=1))['abandoned']), [])
+
+class TunePoolTest(TestCase):
+    
+    def test_refill_and_take(self):
+        waiting = folk_rnn_create_tune()
+        self.assertEqual(tune_pool.refill(), [])
+        waiting.delete()
+        
+        queued = tune_pool.refill()
+        self.assertEqual(len(queued), FOLKRNN_POOL_HIGH * len(rnn_models.models()))
+        self.assertTrue(all(x.priority == RNNTune.PRIORITY_SPECULATIVE for x in queued))
+        self.assertEqual(tune_pool.refill(), [])
+        
+        rnn_model_name = FOLKRNN_IN['rnn_model_name']
+        model = rnn_models.models()[rnn_model_name]
+        tune = RNNTune(rnn_model_name=rnn_model_name, temp=1, meter=f"M:{model['default_meter']}", key=f"K:{model['default_mode']}", seed=1)
+        self.assertIsNone(tune_pool.offer(tune)) # none generated yet
+        
+        source = tune_pool.pooled(tune_pool.parameters(tune)).first()
+        RNNTune.objects.filter(id=source.id).update(rnn_started=now(), rnn_finished=now())
+        self.assertEqual(tune_pool.offer(tune), source)
+        self.assertEqual(tune.seed, source.seed)
+        self.assertEqual(tune_pool.offer(tune), source) # i.e. not taken until admitted
+        self.assertTrue(tune_pool.take(source))
+        self.assertFalse(tune_pool.take(source))
+        self.assertIsNone(tune_pool.offer(tune))
+        self.assertEqual(tune_pool.pooled(tune_pool.parameters(tune)).count(), FOLKRNN_POOL_HIGH - 1)
+
+class TuneStreamTest(TestCase):
+    
+    def test_read_after_seq(self):
+        tune = folk_rnn_create_tune()
+        self.assertEqual(tune_stream.read(tune.id), '')
+        
+        stream = tune_stream.StreamWriter(tune.id)
+        self.assertEqual(stream.write('X:1\nM:4/4\nK:Cmaj\n'), 18)
+        self.assertEqual(stream.write('a'), 19)
+        self.assertEqual(stream.write(' b'), 21)
+        self.assertEqual(tune_stream.read(tune.id), 'X:1\nM:4/4\nK:Cmaj\na b')
+        self.assertEqual(tune_stream.read(tune.id, after=18), 'a b')
+        self.assertEqual(tune_stream.read(tune.id, after=21), '')
+        
+        stream.remove()
+        self.assertEqual(tune_stream.read(tune.id), '')
+
+class TuneStoreTest(TestCase):
+    
+    def test_write_read_rotate(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = tune_store.TuneStore(tmp, segment_bytes=100)
+            for tune_id in range(1, 11):
+                store.write(tune_id, ['a', 'b', str(tune_id)], f'X:{tune_id}\nabc')
+            self.assertGreater(len(store.segment_numbers()), 1)
+            self.assertEqual(store.read(5), ('a b 5', 'X:5\nabc'))
+            self.assertIsNone(store.read(11))
+            self.assertNotIn(11, store)
+            
+            store.write(5, ['c'], 'X:5\nc')
+            self.assertEqual(store.read(5), ('c', 'X:5\nc'))
+            self.assertEqual(store.rebuild_index(), 11)
+            self.assertEqual(store.read(5), ('c', 'X:5\nc'))
+            self.assertEqual(store.read(10), ('a b 10', 'X:10\nabc'))
+    
+    def test_read_legacy_files(self):
+        tune = folk_rnn_create_tune()
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.object(tune_store, 'store', tune_store.TuneStore(tmp, 100)):
+            self.assertIsNone(tune_store.read(tune))
+            with open(tune.path_raw, 'w') as f:
+                f.write(FOLKRNN_OUT_RAW)
+            self.assertEqual(tune_store.read(tune), (FOLKRNN_OUT_RAW, ''))
+            os.remove(tune.path_raw)
+            
+            tune_store.write(tune, FOLKRNN_OUT_RAW.split(' '), 'X:1')
+            self.assertEqual(tune_store.read(tune), (FOLKRNN_OUT_RAW, 'X:1'))
+
+class ABCAssemblerTest(TestCase):
+
+    def test_deltas_and_snapshot(self):
+        tokens = FOLKRNN_OUT_RAW.split(' ')
+        assembler = ABCAssembler(1, title='Folk RNN Tune №')
+        deltas = [assembler.append(x) for x in tokens]
+        self.assertEqual(''.join(deltas), assembler.snapshot())
+        self.assertEqual(assembler.seq, len(assembler.snapshot()))
+        self.assertEqual(assembler.snapshot(), ''.join(FOLKRNN_OUT.splitlines(keepends=True)[:4]) + ''.join(tokens[2:]))
+
+    def test_header_fields(self):
+        assembler = ABCAssembler(2, title=None)
+        on_delta = mock.Mock()
+        for token in ['K:Cmaj', '[L:1/8]', 'K:Cdor', 'a', 'M:3/4', '[K:Cmaj]', 'b']:
+            assembler.feed(token, on_delta)
+        self.assertEqual(assembler.snapshot(), 'X:2\nM:none\nK:Cmaj\nL:1/8\na[M:3/4][K:Cmaj]b')
+        self.assertEqual(on_delta.call_args_list, [
+                                        mock.call('X:2\n', 4),
+                                        mock.call('M:none\nK:Cmaj\nL:1/8\na', 25),
+                                        mock.call('[M:3/4]', 32),
+                                        mock.call('[K:Cmaj]', 40),
+                                        mock.call('b', 41),
+                                        ])
+
+class PublisherRecord:
+    '''
+    Stands in for Publisher, recording what is sent.
+    '''
+    def __init__(self):
+        self.sent = []
+    
+    def group_send(self, group, message):
+        self.sent.append((group, message))
+
+class TuneBroadcastTest(TestCase):
+    
+    def test_flush_policy(self):
+        tune = folk_rnn_create_tune()
+        publisher = PublisherRecord()
+        broadcast = TuneBroadcast(publisher, tune.id, flush_tokens=3, flush_ms=60000, flush_on_bar=True)
+        broadcast.on_delta('X:1\n', 4)
+        broadcast.on_delta('a', 5)
+        self.assertEqual(publisher.sent, [])
+        broadcast.on_delta('b', 6)
+        self.assertEqual([x[1]['abc'] for x in publisher.sent], ['X:1\nab'])
+        broadcast.on_delta('|', 7)
+        self.assertEqual([x[1]['abc'] for x in publisher.sent], ['X:1\nab', '|'])
+        broadcast.on_delta('c', 8)
+        self.assertEqual(tune_stream.read(tune.id), 'X:1\nab|')
+        broadcast.close()
+        self.assertEqual([x[1]['seq'] for x in publisher.sent], [6, 7, 8])
+        self.assertEqual(publisher.sent[-1], (f'tune_{tune.id}', {
+                                                    'type': 'generation_status',
+                                                    'status': 'new_abc',
+                                                    'tune_id': tune.id,
+                                                    'abc': 'c',
+                                                    'seq': 8,
+                                                    }))
+        self.assertEqual(tune_stream.read(tune.id), 'X:1\nab|c')
+        tune_stream.remove(tune.id)
+        self.assertEqual(tune_stream.read(tune.id), '')
@@ -5,9 +5,11 @@ from channels.layers import get_channel_layer
 from channels.db import database_sync_to_async
 from datetime import timedelta
 from asyncio import sleep
+from django.utils.timezone import now
 
-from composer import TUNE_PATH
-from composer.consumers import FolkRNNConsumer, ComposerConsumer
+from composer import tune_store, worker_pool
+from composer.abc_assembler import ABCAssembler
+from composer.consumers import FolkRNNConsumer, FolkRNNPostConsumer, ComposerConsumer, CANCELLED_ERROR
 from composer.models import RNNTune
 from folk_rnn_site.tests import FOLKRNN_IN, FOLKRNN_OUT, FOLKRNN_OUT_RAW
 
@@ -23,19 +25,29 @@ async def test_folkrnn_consumer():
         'type': 'folkrnn.generate', 
         'id': tune.id,
     })
-    while RNNTune.objects.last().rnn_finished is None:
-        await sleep(0.1)
+    
+    # The generated tune is handed over to post-processing
+    channel_layer = get_channel_layer()
+    message = await channel_layer.receive('folk_rnn_post')
+    assert message['type'] == 'folkrnn.finish'
+    assert message['id'] == tune.id
+    assert ' '.join(message['tokens']) == FOLKRNN_OUT_RAW
     await communicator.send_input({'type': 'stop'})
     await communicator.wait()
+    
+    post_scope = {'type': 'channel', 'channel': 'folk_rnn_post'}
+    post_communicator = ApplicationCommunicator(FolkRNNPostConsumer, post_scope)
+    await post_communicator.send_input(message)
+    while RNNTune.objects.last().rnn_finished is None:
+        await sleep(0.1)
 
-    with open(TUNE_PATH + f'/thesession_with_repeats_{tune.id}_raw') as f:
-        assert f.read() == FOLKRNN_OUT_RAW
+    raw, abc = tune_store.read(tune)
+    assert raw == FOLKRNN_OUT_RAW
 
     correct_out = FOLKRNN_OUT\
                     .replace('X:1', f'X:{tune.id}')\
                     .replace('№1', f'№{tune.id}')
-    with open(TUNE_PATH + f'/thesession_with_repeats_{tune.id}') as f:
-        assert f.read() == correct_out
+    assert abc == correct_out
 
     tune = RNNTune.objects.last()
     assert tune.rnn_started is not None
@@ -43,6 +55,64 @@ async def test_folkrnn_consumer():
     assert tune.rnn_started < tune.rnn_finished
     assert tune.rnn_finished - tune.rnn_started < timedelta(seconds=5)
     assert tune.abc == correct_out
+    assert tune.rnn_error == ''
+
+@pytest.mark.django_db(transaction=True)  
+@pytest.mark.asyncio
+async def test_folkrnn_consumer_cancelled():
+    # i.e. nobody is listening, see job_queue.unsubscribe
+    tune = RNNTune.objects.create(**FOLKRNN_IN, rnn_cancelled=now())
+
+    scope = {'type': 'channel', 'channel': 'folk_rnn'}
+    communicator = ApplicationCommunicator(FolkRNNConsumer, scope)
+    await communicator.send_input({
+        'type': 'folkrnn.generate', 
+        'id': tune.id,
+    })
+    
+    channel_layer = get_channel_layer()
+    message = await channel_layer.receive('folk_rnn_post')
+    assert message['id'] == tune.id
+    assert message['cancelled']
+    assert len(message['tokens']) < len(FOLKRNN_OUT_RAW.split(' '))
+    await communicator.send_input({'type': 'stop'})
+    await communicator.wait()
+    
+    post_scope = {'type': 'channel', 'channel': 'folk_rnn_post'}
+    post_communicator = ApplicationCommunicator(FolkRNNPostConsumer, post_scope)
+    await post_communicator.send_input(message)
+    while RNNTune.objects.last().rnn_finished is None:
+        await sleep(0.1)
+    
+    tune = RNNTune.objects.last()
+    assert tune.rnn_error == CANCELLED_ERROR
+    assert tune.rnn_cancelled is not None
+
+@pytest.mark.django_db(transaction=True)  
+@pytest.mark.asyncio
+async def test_folkrnn_consumer_draining(monkeypatch):
+    # i.e. a pool worker about to exit, see worker_pool
+    monkeypatch.setattr(worker_pool, 'slot', 0)
+    monkeypatch.setattr(worker_pool, 'shared', [worker_pool.IDLE, 0, 0])
+    monkeypatch.setattr(worker_pool, 'draining', True)
+    monkeypatch.setattr(worker_pool, 'unhandled', 1)
+    tune = RNNTune.objects.create(**FOLKRNN_IN)
+
+    scope = {'type': 'channel', 'channel': 'folk_rnn'}
+    communicator = ApplicationCommunicator(FolkRNNConsumer, scope)
+    await communicator.send_input({
+        'type': 'folkrnn.generate', 
+        'id': tune.id,
+    })
+    
+    # The message is sent again for another worker, rather than lost
+    channel_layer = get_channel_layer()
+    message = await channel_layer.receive('folk_rnn')
+    assert message == {'type': 'folkrnn.generate', 'id': tune.id}
+    assert worker_pool.unhandled == 0
+    assert RNNTune.objects.get(id=tune.id).rnn_started is None
+    await communicator.send_input({'type': 'stop'})
+    await communicator.wait()
 
 @pytest.mark.django_db()
 @pytest.mark.asyncio
@@ -74,13 +144,14 @@ async def test_generation_status():
     
     channel_layer = get_channel_layer()
      
-    # Send the consumer complete ABC via tune group. 
-    # Check it gets back incremental ABC.
+    # Send the consumer ABC deltas via tune group. 
+    # Check it passes on what is new, with the sequence number.
     # And do this for two tunes, to check isolation.
-    await channel_layer.group_send('tune_1', {
+    await channel_layer.group_send(f'tune_{tune_a.id}', {
         'type': 'generation_status',
         'status': 'new_abc',
         'abc': 'a b c',
+        'seq': 5,
         'tune_id': tune_a.id,
         })
     response = await communicator.receive_from()
@@ -88,12 +159,14 @@ async def test_generation_status():
         'command': 'add_token',
         'token': 'a b c',
         'tune_id': tune_a.id,
+        'seq': 5,
     }
     
-    await channel_layer.group_send('tune_2', {
+    await channel_layer.group_send(f'tune_{tune_b.id}', {
         'type': 'generation_status',
         'status': 'new_abc',
         'abc': 'A B C',
+        'seq': 5,
         'tune_id': tune_b.id,
         })
     response = await communicator.receive_from()
@@ -101,12 +174,24 @@ async def test_generation_status():
         'command': 'add_token',
         'token': 'A B C',
         'tune_id': tune_b.id,
+        'seq': 5,
     }
     
-    await channel_layer.group_send('tune_1', {
+    # Already sent, i.e. nothing to send on
+    await channel_layer.group_send(f'tune_{tune_a.id}', {
         'type': 'generation_status',
         'status': 'new_abc',
-        'abc': 'a b c d e f',
+        'abc': 'a b c',
+        'seq': 5,
+        'tune_id': tune_a.id,
+        })
+    assert await communicator.receive_nothing()
+    
+    await channel_layer.group_send(f'tune_{tune_a.id}', {
+        'type': 'generation_status',
+        'status': 'new_abc',
+        'abc': ' d e f',
+        'seq': 11,
         'tune_id': tune_a.id,
         })
     response = await communicator.receive_from()
@@ -114,12 +199,15 @@ async def test_generation_status():
         'command': 'add_token',
         'token': ' d e f',
         'tune_id': tune_a.id,
+        'seq': 11,
     }
     
-    await channel_layer.group_send('tune_2', {
+    # Overlapping what was sent, i.e. only the new part is sent on
+    await channel_layer.group_send(f'tune_{tune_b.id}', {
         'type': 'generation_status',
         'status': 'new_abc',
-        'abc': 'A B C D E F',
+        'abc': 'C D E F',
+        'seq': 11,
         'tune_id': tune_b.id,
         })
     response = await communicator.receive_from()
@@ -127,6 +215,7 @@ async def test_generation_status():
         'command': 'add_token',
         'token': ' D E F',
         'tune_id': tune_b.id,
+        'seq': 11,
     }
     
     await communicator.disconnect()
@@ -164,6 +253,138 @@ async def test_receive_json_compose_valid():
     assert tune.temp == 0.1
     assert tune.seed == 123
     assert tune.prime_tokens == 'M:4/4 K:Cmaj a b c *'
+    
+    response_data = json.loads(await communicator.receive_from())
+    assert response_data['command'] == 'queue_status'
+    assert response_data['tune_id'] == tune.id
+    assert response_data['position'] == 0
+    assert response_data['deferred'] == False
+    await communicator.disconnect()
+
+@pytest.mark.django_db()    
+@pytest.mark.asyncio
+async def test_receive_json_compose_many(monkeypatch):
+    monkeypatch.setattr('composer.consumers.FOLKRNN_BATCH_SIZE', 8)
+    communicator = WebsocketCommunicator(ComposerConsumer, '/')
+    communicator.scope['client'] = ['composer.tests_aync']
+    connected, subprotocol = await communicator.connect()
+    assert connected
+    response_data = json.loads(await communicator.receive_from())
+    assert response_data['command'] == 'set_session'
+    
+    content = {
+        'command': 'compose_many',
+        'count': 3,
+        'data': {
+            'model': 'thesession_with_repeats.pickle',
+            'temp': 0.1,
+            'seed': 123,
+            'meter': 'M:4/4',
+            'key': 'K:Cmaj',
+            'start_abc': 'a b c *',
+            }
+    }
+    await communicator.send_to(json.dumps(content))
+    tune_ids = []
+    for _ in range(3):
+        response_data = json.loads(await communicator.receive_from())
+        assert response_data['command'] == 'add_tune'
+        tune_ids.append(response_data['tune']['id'])
+    tunes = list(RNNTune.objects.filter(id__in=tune_ids).order_by('id'))
+    assert tunes[0].seed == 123
+    assert all(x.prime_tokens == 'M:4/4 K:Cmaj a b c *' and x.session_id == tunes[0].session_id for x in tunes)
+    
+    # Requested together, as one generate message
+    message = await get_channel_layer().receive('folk_rnn')
+    assert message['type'] == 'folkrnn.generate'
+    assert message['ids'] == tune_ids
+    await communicator.disconnect()
+
+@pytest.mark.django_db()    
+@pytest.mark.asyncio
+async def test_receive_json_compose_refused(monkeypatch):
+    monkeypatch.setattr('composer.consumers.FOLKRNN_ADMISSION_MAX_WAIT', 60)
+    monkeypatch.setattr('composer.consumers.FOLKRNN_ADMISSION_REFUSE', True)
+    monkeypatch.setattr('composer.job_queue.estimated_wait', lambda rnn_model_name, position: 600)
+    
+    communicator = WebsocketCommunicator(ComposerConsumer, '/')
+    communicator.scope['client'] = ['composer.tests_aync']
+    connected, subprotocol = await communicator.connect()
+    assert connected
+    response_data = json.loads(await communicator.receive_from())
+    assert response_data['command'] == 'set_session'
+    
+    content = {
+        'command': 'compose',
+        'data': {
+            'model': 'thesession_with_repeats.pickle',
+            'temp': 0.1,
+            'seed': 123,
+            'meter': 'M:4/4',
+            'key': 'K:Cmaj',
+            'start_abc': '',
+            }
+    }
+    await communicator.send_to(json.dumps(content))
+    response_data = json.loads(await communicator.receive_from())
+    assert response_data['command'] == 'compose_refused'
+    assert response_data['wait_seconds'] == 600
+    assert not RNNTune.objects.exists()
+    await communicator.disconnect()
+    
+@pytest.mark.django_db()    
+@pytest.mark.asyncio
+async def test_receive_json_compose_cached():
+    params = {**FOLKRNN_IN, 'meter': 'M:4/4', 'key': 'K:Cmaj'}
+    source = RNNTune.objects.create(**params, rnn_started=now(), rnn_finished=now(), abc=FOLKRNN_OUT)
+    tune_store.write(source, FOLKRNN_OUT_RAW.split(' '), FOLKRNN_OUT)
+    
+    communicator = WebsocketCommunicator(ComposerConsumer, '/')
+    communicator.scope['client'] = ['composer.tests_aync']
+    connected, subprotocol = await communicator.connect()
+    assert connected
+    response = await communicator.receive_from()
+    response_data = json.loads(response)
+    assert response_data['command'] == 'set_session'
+    
+    content = {
+        'command': 'compose',
+        'data': {
+            'model': params['rnn_model_name'],
+            'temp': params['temp'],
+            'seed': params['seed'],
+            'meter': params['meter'],
+            'key': params['key'],
+            'start_abc': params['start_abc'],
+            }
+    }
+    await communicator.send_to(json.dumps(content))
+    response_data = json.loads(await communicator.receive_from())
+    assert response_data['command'] == 'add_tune'
+    tune_id = response_data['tune']['id']
+    
+    response_data = json.loads(await communicator.receive_from())
+    assert response_data['command'] == 'generation_status'
+    assert response_data['status'] == 'start'
+    
+    # The deltas, i.e. not one per token, as header tokens add no ABC until the header is complete
+    assembler = ABCAssembler(tune_id)
+    for token in FOLKRNN_OUT_RAW.split(' '):
+        assembler.append(token)
+    abc = ''
+    while abc != assembler.snapshot():
+        response_data = json.loads(await communicator.receive_from())
+        assert response_data['command'] == 'add_token'
+        assert response_data['tune_id'] == tune_id
+        abc += response_data['token']
+        assert response_data['seq'] == len(abc)
+        assert assembler.snapshot().startswith(abc)
+    assert abc.startswith(f'X:{tune_id}\nM:4/4\nK:Cdor\n')
+    
+    tune = RNNTune.objects.get(id=tune_id)
+    assert tune.rnn_finished is not None
+    assert tune.abc == FOLKRNN_OUT.replace('X:1', f'X:{tune_id}')
+    
     await communicator.disconnect()
     
 @pytest.mark.django_db()    
@@ -0,0 +1,103 @@
+'''
+Tunes pre-generated for the commonest compose parameters, so a compose with an auto seed is served at once.
+
+The worker pool refills each parameter set's pool to FOLKRNN_POOL_HIGH tunes once it falls
+below FOLKRNN_POOL_LOW, with seeds chosen here. Pool tunes are queued at PRIORITY_SPECULATIVE,
+i.e. only generated while no other tunes are waiting, and not refilled while any are.
+
+A compose taking a pool tune is given its seed, so the compose is an identical request,
+replayed from the pool tune as per generation_cache, and reproducible like any other.
+'''
+import logging
+from collections import Counter
+from datetime import timedelta
+from random import randint
+from django.db.models import Count
+from django.utils.timezone import now
+
+from composer import FOLKRNN_MAX_SEED, FOLKRNN_POOL_LOW, FOLKRNN_POOL_HIGH, FOLKRNN_POOL_POPULAR, FOLKRNN_POOL_POPULAR_DAYS
+from composer.models import RNNTune
+from composer.rnn_models import models
+from composer import job_queue
+
+logger = logging.getLogger(__name__)
+
+# Hit and miss counts for this process
+counters = Counter()
+
+PARAMETERS = ['rnn_model_name', 'temp', 'meter', 'key']
+
+def parameters(tune):
+    return tuple(getattr(tune, x) for x in PARAMETERS)
+
+def parameter_sets():
+    '''
+    The parameter sets to pre-generate for, i.e. each model's defaults, as per the compose form,
+    and the most requested with no start ABC over the last FOLKRNN_POOL_POPULAR_DAYS.
+    '''
+    sets = [(name, 1.0, f"M:{model['default_meter']}", f"K:{model['default_mode']}") for name, model in models().items()]
+    popular = RNNTune.objects.filter(
+                            session__isnull=False,
+                            start_abc='',
+                            requested__gt=now() - timedelta(days=FOLKRNN_POOL_POPULAR_DAYS),
+                            ).values_list(*PARAMETERS).annotate(requests=Count('id')).order_by('-requests')
+    for x in popular[:FOLKRNN_POOL_POPULAR]:
+        if x[:-1] not in sets:
+            sets.append(x[:-1])
+    return sets
+
+def pooled(parameters=None):
+    '''
+    The pool tunes not yet taken, generated or to be, for the parameter set if given.
+    '''
+    tunes = RNNTune.objects.filter(priority=RNNTune.PRIORITY_SPECULATIVE, session__isnull=True, rnn_error='', start_abc='')
+    if parameters is not None:
+        tunes = tunes.filter(**dict(zip(PARAMETERS, parameters)))
+    return tunes
+
+def offer(tune):
+    '''
+    Give the tune the seed of a generated pool tune with its parameters, leaving that tune in the pool until
+    taken, i.e. once the compose is admitted. Returns the pool tune, or None if there's none to offer.
+    '''
+    if tune.start_abc:
+        return None
+    source = pooled(parameters(tune)).filter(rnn_finished__isnull=False).order_by('id').first()
+    if source is None:
+        counters['miss'] += 1
+        return None
+    tune.seed = source.seed
+    return source
+
+def take(source):
+    '''
+    Take the pool tune offered from the pool. Returns whether it was still there, i.e. not taken by another compose
+    since, in which case the composes share its seed.
+    '''
+    taken = pooled().filter(id=source.id).update(priority=RNNTune.PRIORITY_BULK) == 1 # i.e. out of the pool
+    counters['hit'] += 1
+    logger.info(f"Tune pool hit, seed {source.seed} from tune {source.id}{'' if taken else ', taken already'}. Hits: {counters['hit']}, misses: {counters['miss']}")
+    return taken
+
+def refill():
+    '''
+    Queue pool tunes for the parameter sets below FOLKRNN_POOL_LOW, up to FOLKRNN_POOL_HIGH,
+    unless other tunes are waiting. Returns the tunes queued.
+    '''
+    if job_queue.pending().filter(priority__gt=RNNTune.PRIORITY_SPECULATIVE).exists():
+        return []
+    tunes = []
+    for x in parameter_sets():
+        count = pooled(x).count()
+        if count >= FOLKRNN_POOL_LOW:
+            continue
+        tunes += [RNNTune(**dict(zip(PARAMETERS, x)),
+                          seed=randint(0, FOLKRNN_MAX_SEED),
+                          priority=RNNTune.PRIORITY_SPECULATIVE,
+                          ) for _ in range(FOLKRNN_POOL_HIGH - count)]
+    # Saved one by one, as the generate messages need the ids
+    for tune in tunes:
+        tune.save()
+    if tunes:
+        logger.info(f'Tune pool refilling, {len(tunes)} tunes queued')
+    return tunes
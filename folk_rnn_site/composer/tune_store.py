@@ -0,0 +1,171 @@
+'''
+The tunes' raw folk-rnn output and formatted ABC, kept in a few large files rather than two files per tune.
+
+Each tune is a record appended to the current segment file, a new segment being started once
+it reaches FOLKRNN_TUNE_SEGMENT_BYTES. Appends are single writes to files opened for appending,
+so the workers' processes can write concurrently. The index file has an entry for each tune id
+at a fixed offset, i.e. a read is one index read and one segment read. Segments are never
+rewritten; a tune stored again, e.g. generated again, supersedes its earlier record.
+
+Tunes from before the store are read from their files in TUNE_PATH until moved into the store,
+see the migratetunestore management command.
+'''
+import os
+import re
+import logging
+import struct
+
+from composer import TUNE_STORE_PATH, FOLKRNN_TUNE_SEGMENT_BYTES
+
+logger = logging.getLogger(__name__)
+
+# A record is this header, then the raw output and formatted ABC, UTF-8 encoded
+RECORD_HEADER = struct.Struct('<4sIII') # magic, tune id, raw length, ABC length
+RECORD_MAGIC = b'TUNE'
+# The index entry of tune id x is at x * INDEX_ENTRY.size, all zero if the tune isn't stored
+INDEX_ENTRY = struct.Struct('<IQII') # segment number, record offset, raw length, ABC length
+INDEX_FILENAME = 'index'
+SEGMENT_REGEX = re.compile(r'^segment_(\d+)$')
+
+class TuneStore:
+    '''
+    Segment files and their index in the directory at path. See module docstring.
+    '''
+    def __init__(self, path, segment_bytes):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.segment = None # (number, fd) being appended to
+        self.index_fd = None
+        self.read_fds = {} # number: fd
+
+    def segment_path(self, number):
+        return os.path.join(self.path, f'segment_{number:06}')
+
+    def segment_numbers(self):
+        return sorted(int(m.group(1)) for m in (SEGMENT_REGEX.match(x) for x in os.listdir(self.path)) if m)
+
+    def index(self):
+        if self.index_fd is None:
+            os.makedirs(self.path, exist_ok=True)
+            self.index_fd = os.open(os.path.join(self.path, INDEX_FILENAME), os.O_RDWR | os.O_CREAT, 0o644)
+        return self.index_fd
+
+    def writable_segment(self):
+        '''
+        The segment to append to, moving on to the latest, or a new one, once it is full.
+        '''
+        if self.segment is not None:
+            if os.fstat(self.segment[1]).st_size < self.segment_bytes:
+                return self.segment
+            os.close(self.segment[1])
+        os.makedirs(self.path, exist_ok=True)
+        numbers = self.segment_numbers()
+        number = numbers[-1] if numbers else 1
+        while True:
+            fd = os.open(self.segment_path(number), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            if os.fstat(fd).st_size < self.segment_bytes:
+                break
+            os.close(fd)
+            number += 1
+        self.segment = (number, fd)
+        return self.segment
+
+    def write(self, tune_id, tokens, abc):
+        '''
+        Store the tune's raw output, i.e. its tokens, and formatted ABC.
+        '''
+        raw = ' '.join(tokens).encode()
+        abc = abc.encode()
+        record = RECORD_HEADER.pack(RECORD_MAGIC, tune_id, len(raw), len(abc)) + raw + abc
+        number, fd = self.writable_segment()
+        # One write, so it isn't interleaved with another process's
+        os.write(fd, record)
+        offset = os.lseek(fd, 0, os.SEEK_CUR) - len(record)
+        os.pwrite(self.index(), INDEX_ENTRY.pack(number, offset, len(raw), len(abc)), tune_id * INDEX_ENTRY.size)
+
+    def entry(self, tune_id):
+        entry = os.pread(self.index(), INDEX_ENTRY.size, tune_id * INDEX_ENTRY.size)
+        if len(entry) < INDEX_ENTRY.size:
+            return None
+        entry = INDEX_ENTRY.unpack(entry)
+        return entry if entry[0] else None
+
+    def __contains__(self, tune_id):
+        return self.entry(tune_id) is not None
+
+    def read(self, tune_id):
+        '''
+        The tune's raw output, i.e. space separated tokens, and formatted ABC, or None if not stored.
+        '''
+        entry = self.entry(tune_id)
+        if entry is None:
+            return None
+        number, offset, raw_length, abc_length = entry
+        if number not in self.read_fds:
+            self.read_fds[number] = os.open(self.segment_path(number), os.O_RDONLY)
+        data = os.pread(self.read_fds[number], RECORD_HEADER.size + raw_length + abc_length, offset)
+        magic, record_id, record_raw_length, record_abc_length = RECORD_HEADER.unpack_from(data)
+        if magic != RECORD_MAGIC or record_id != tune_id:
+            logger.error(f'Tune store: index entry for tune {tune_id} does not match segment {number} at {offset}')
+            return None
+        raw = data[RECORD_HEADER.size:RECORD_HEADER.size + raw_length]
+        abc = data[RECORD_HEADER.size + raw_length:]
+        return raw.decode(), abc.decode()
+
+    def records(self):
+        '''
+        Every record in the segments, in the order written, as (tune id, segment number, offset, raw length, ABC length).
+        '''
+        for number in self.segment_numbers():
+            with open(self.segment_path(number), 'rb') as f:
+                offset = 0
+                while True:
+                    header = f.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+                    magic, tune_id, raw_length, abc_length = RECORD_HEADER.unpack(header)
+                    if magic != RECORD_MAGIC:
+                        logger.error(f'Tune store: segment {number} corrupt at {offset}')
+                        break
+                    yield tune_id, number, offset, raw_length, abc_length
+                    offset = f.seek(raw_length + abc_length, os.SEEK_CUR)
+
+    def rebuild_index(self):
+        '''
+        Write the index afresh from the segments, e.g. having restored them. Returns the number of records.
+        '''
+        index = self.index()
+        os.ftruncate(index, 0)
+        count = 0
+        for tune_id, number, offset, raw_length, abc_length in self.records():
+            os.pwrite(index, INDEX_ENTRY.pack(number, offset, raw_length, abc_length), tune_id * INDEX_ENTRY.size)
+            count += 1
+        return count
+
+store = TuneStore(TUNE_STORE_PATH, FOLKRNN_TUNE_SEGMENT_BYTES)
+
+def write(tune, tokens, abc):
+    '''
+    Store the tune's raw output, i.e. its tokens, and formatted ABC.
+    '''
+    store.write(tune.id, tokens, abc)
+
+def read(tune):
+    '''
+    The tune's raw output, i.e. space separated tokens, and formatted ABC, or None if not stored.
+    A tune from before the store is read from its files.
+    '''
+    record = store.read(tune.id)
+    if record is not None:
+        return record
+    try:
+        with open(tune.path_raw) as f:
+            raw = f.read()
+    except OSError:
+        return None
+    try:
+        with open(tune.path) as f:
+            abc = f.read()
+    except OSError:
+        abc = ''
+    return raw, abc
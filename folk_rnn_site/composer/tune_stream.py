@@ -0,0 +1,59 @@
+'''
+The ABC of a tune being generated, as streamed to consumers.
+
+The worker appends each new part of the ABC to the tune's stream file before
+broadcasting it, with a sequence number that is the length of the ABC so far.
+A consumer registering mid-generation, or resuming after a reconnect, can then
+read everything after the sequence number it has, and take broadcasts from there.
+The file is removed once the tune has finished, the finished ABC being in the database.
+'''
+import os
+
+from composer import STREAM_PATH
+
+def stream_path(tune_id):
+    return os.path.join(STREAM_PATH, str(tune_id))
+
+def read(tune_id, after=0):
+    '''
+    The tune's streamed ABC after the sequence number, i.e. '' if there is none (yet, or any more).
+    '''
+    try:
+        with open(stream_path(tune_id), encoding='utf-8') as f:
+            return f.read()[after:]
+    except FileNotFoundError:
+        return ''
+
+def remove(tune_id):
+    '''
+    Remove the tune's stream, i.e. the tune has finished.
+    '''
+    try:
+        os.remove(stream_path(tune_id))
+    except FileNotFoundError:
+        pass
+
+class StreamWriter:
+    '''
+    Appends to a tune's stream file, tracking the sequence number.
+    '''
+    def __init__(self, tune_id):
+        self.tune_id = tune_id
+        self.seq = 0
+        self.file = open(stream_path(tune_id), 'w', encoding='utf-8')
+
+    def write(self, delta):
+        '''
+        Append the delta, flushed for consumers to read. Returns the new sequence number.
+        '''
+        self.file.write(delta)
+        self.file.flush()
+        self.seq += len(delta)
+        return self.seq
+
+    def close(self):
+        self.file.close()
+
+    def remove(self):
+        self.close()
+        remove(self.tune_id)
@@ -22,5 +22,6 @@ urlpatterns = [
     url(r'^tune/(?P<tune_id>[0-9]+)$', views.tune_page, name='tune'),
     url(r'^tune/(?P<tune_id>[0-9]+)/archive$', views.archive_tune, name='archive_tune'),
     url(r'^dataset$', views.dataset_download),
+    url(r'^models/(?P<digest>[0-9a-f]+)\.js$', views.models_js, name='models_js'),
     url(r'^competition/$', views.competition_page, name='competition')
 ]
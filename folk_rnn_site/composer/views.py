@@ -1,6 +1,7 @@
 import json
 from django.shortcuts import redirect, render
 from django.http import HttpResponse
+from django.utils.cache import patch_cache_control
 from django.core.files import File as dFile
 from django.utils.timezone import now
 from channels.layers import get_channel_layer
@@ -10,16 +11,24 @@ from tempfile import TemporaryFile
 
 from folk_rnn_site.models import conform_abc
 from composer.models import RNNTune
-from composer.rnn_models import models
+from composer.rnn_models import models, models_manifest
 from composer.forms import ComposeForm, ArchiveForm
 from composer.dataset import dataset_as_csv
 from archiver.models import Tune
 
+# The models script's URL is fingerprinted with its content, so it can be cached indefinitely
+MODELS_JS_MAX_AGE = 365 * 24 * 60 * 60
+
+def models_js_url():
+    js, digest = models_manifest()
+    return reverse('models_js', host='composer', kwargs={'digest': digest})
+
 def home_page(request):
     return render(request, 'composer/home.html', {
                                 'compose_form': ComposeForm(),
                                 'archive_form': ArchiveForm(),
                                 'machine_folk_tune_count': Tune.objects.count(),
+                                'models_js_url': models_js_url(),
                                 })
 
 def tune_page(request, tune_id=None):
@@ -33,6 +42,7 @@ def tune_page(request, tune_id=None):
         'compose_form': ComposeForm(),
         'archive_form': ArchiveForm(),
         'tune_id': tune.id,
+        'models_js_url': models_js_url(),
         })
 
 def archive_tune(request, tune_id=None):
@@ -69,5 +79,13 @@ def dataset_download(request):
         response['Content-Disposition'] = 'attachment; filename="folkrnn_dataset_{}"'.format(now().strftime('%Y%m%d-%H%M%S'))
         return response
 
+def models_js(request, digest):
+    js, current_digest = models_manifest()
+    if digest != current_digest:
+        return redirect(models_js_url())
+    response = HttpResponse(js, content_type='application/javascript')
+    patch_cache_control(response, public=True, max_age=MODELS_JS_MAX_AGE, immutable=True)
+    return response
+
 def competition_page(request):
     return render(request, 'composer/competition.html', {})
\ No newline at end of file
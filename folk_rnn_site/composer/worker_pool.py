@@ -0,0 +1,243 @@
+'''
+A pre-fork pool of folk_rnn workers, see the runfolkrnnpool management command.
+
+The pool process loads the models, then forks the workers, so they share the
+weights' memory copy-on-write rather than each loading their own. It restarts
+any worker that dies, and on SIGTERM drains them, i.e. each worker finishes
+any generation in progress before exiting.
+
+A draining worker stops receiving, and any generate messages it has already received
+are sent again for another worker, rather than being lost with the process.
+
+Each worker's state is kept in memory shared with the pool, and the pool
+writes it out to a status file. The pool also runs any housekeeping periodically,
+e.g. requeuing the tunes of workers that died mid-generation.
+'''
+import os
+import gc
+import asyncio
+import json
+import signal
+import logging
+import threading
+from time import time, sleep
+from multiprocessing.sharedctypes import RawArray
+
+from django.db import connections
+from channels.worker import Worker
+
+from composer.publisher import publishers
+
+logger = logging.getLogger(__name__)
+
+IDLE, BUSY, EXITING = 0, 1, 2
+STATE_NAMES = {IDLE: 'idle', BUSY: 'busy', EXITING: 'exiting'}
+FIELDS = 3 # state, since, jobs
+
+# This process's slot in the pool, if it is a pool worker
+slot = None
+shared = None
+draining = False
+unhandled = 0 # generate messages received but not yet handled, see PoolWorker
+lock = threading.RLock() # re-entrant, as the SIGTERM handler may interrupt PoolWorker holding it
+
+def set_state(state):
+    shared[slot * FIELDS] = state
+    shared[slot * FIELDS + 1] = time()
+
+def start_job():
+    '''
+    Mark this worker busy. Returns False if the worker is draining, i.e. the job should be sent again
+    for another worker, and skip_job called once it has been.
+    '''
+    if slot is None:
+        return True
+    with lock:
+        if draining:
+            return False
+        set_state(BUSY)
+        return True
+
+def end_job():
+    if slot is None:
+        return
+    with lock:
+        handled()
+        shared[slot * FIELDS + 2] += 1
+        set_state(IDLE)
+
+def skip_job():
+    if slot is None:
+        return
+    with lock:
+        handled()
+
+def handled():
+    global unhandled
+    unhandled = max(0, unhandled - 1)
+
+def exit_when_idle():
+    '''
+    Drain this worker, i.e. once any job in progress has ended and its messages are sent, exit.
+    '''
+    while True:
+        with lock:
+            if shared[slot * FIELDS] == IDLE and unhandled == 0:
+                set_state(EXITING)
+                break
+        sleep(0.1)
+    for publisher in list(publishers):
+        publisher.join()
+    connections.close_all()
+    os._exit(0)
+
+def on_sigterm(signum, frame):
+    global draining
+    with lock:
+        draining = True
+    threading.Thread(target=exit_when_idle, name='folk_rnn pool drain', daemon=True).start()
+
+class PoolWorker(Worker):
+    '''
+    A channels Worker that stops receiving once draining, leaving the channels' messages for
+    other workers, and counts the generate messages it queues, so it exits only once they are handled.
+    '''
+    async def listener(self, channel):
+        global unhandled
+        while not draining:
+            message = await self.channel_layer.receive(channel)
+            if not message.get('type', None):
+                raise ValueError('Worker received message with no type.')
+            if message['type'] == 'folkrnn.generate':
+                with lock:
+                    unhandled += 1
+            # As per Worker.listener
+            scope = {'type': 'channel', 'channel': channel}
+            instance_queue = self.get_or_create_application_instance(channel, scope)
+            await instance_queue.put(message)
+        # Wait to be exited, see exit_when_idle
+        await asyncio.Future()
+
+class Pool:
+    '''
+    Forks and supervises `processes` workers running `run_worker`, calling `housekeeping` every `housekeeping_seconds`.
+    '''
+    def __init__(self, processes, run_worker, status_path, drain_timeout=120, housekeeping=None, housekeeping_seconds=60):
+        self.processes = processes
+        self.run_worker = run_worker
+        self.status_path = status_path
+        self.drain_timeout = drain_timeout
+        self.housekeeping = housekeeping
+        self.housekeeping_seconds = housekeeping_seconds
+        self.housekept = time()
+        self.shared = RawArray('d', processes * FIELDS)
+        self.pids = [None] * processes
+        self.restarts = [0] * processes
+        self.draining_since = None
+
+    def fork(self, index):
+        pid = os.fork()
+        if pid == 0:
+            global slot, shared
+            slot = index
+            shared = self.shared
+            signal.signal(signal.SIGTERM, on_sigterm)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            set_state(IDLE)
+            try:
+                self.run_worker()
+            except BaseException:
+                logger.exception(f'Pool worker {index} failed')
+                os._exit(1)
+            os._exit(0)
+        self.pids[index] = pid
+        logger.info(f'Pool worker {index} started, pid {pid}')
+
+    def drain(self, signum=None, frame=None):
+        if self.draining_since is not None:
+            return
+        logger.info('Pool draining')
+        self.draining_since = time()
+        for pid in self.pids:
+            if pid is not None:
+                os.kill(pid, signal.SIGTERM)
+
+    def run(self):
+        # Children get their own database connections, and gc needn't touch the shared pages
+        connections.close_all()
+        if hasattr(gc, 'freeze'):
+            gc.freeze()
+        for index in range(self.processes):
+            self.fork(index)
+        signal.signal(signal.SIGTERM, self.drain)
+        signal.signal(signal.SIGINT, self.drain)
+
+        while any(self.pids):
+            self.reap()
+            if self.draining_since is not None and time() - self.draining_since > self.drain_timeout:
+                logger.warning('Pool drain timed out, killing workers')
+                for pid in self.pids:
+                    if pid is not None:
+                        os.kill(pid, signal.SIGKILL)
+                self.draining_since = float('inf') # i.e. killed, don't time out again
+            if self.housekeeping is not None and self.draining_since is None and time() - self.housekept >= self.housekeeping_seconds:
+                self.housekeep()
+            self.write_status()
+            sleep(0.5)
+        self.write_status()
+        logger.info('Pool stopped')
+
+    def housekeep(self):
+        self.housekept = time()
+        try:
+            self.housekeeping()
+        except Exception:
+            logger.exception('Pool housekeeping failed')
+        finally:
+            # Workers forked later mustn't inherit the connections
+            connections.close_all()
+
+    def reap(self):
+        '''
+        Collect exited workers, restarting them unless draining.
+        '''
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid not in self.pids:
+                continue
+            index = self.pids.index(pid)
+            self.pids[index] = None
+            if self.draining_since is None:
+                logger.warning(f'Pool worker {index} (pid {pid}) exited with status {status}, restarting')
+                self.restarts[index] += 1
+                self.fork(index)
+            else:
+                self.shared[index * FIELDS] = EXITING
+
+    def status(self):
+        return {
+            'pid': os.getpid(),
+            'draining': self.draining_since is not None,
+            'updated': time(),
+            'workers': [{
+                'pid': pid,
+                'state': STATE_NAMES[int(self.shared[x * FIELDS])] if pid else 'exited',
+                'since': self.shared[x * FIELDS + 1],
+                'jobs': int(self.shared[x * FIELDS + 2]),
+                'restarts': self.restarts[x],
+            } for x, pid in enumerate(self.pids)],
+        }
+
+    def write_status(self):
+        tmp_path = f'{self.status_path}.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.status(), f, indent=2)
+            os.replace(tmp_path, self.status_path)
+        except OSError:
+            logger.warning(f'Could not write pool status {self.status_path}')
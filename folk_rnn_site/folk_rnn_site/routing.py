@@ -1,11 +1,13 @@
 from channels.routing import ProtocolTypeRouter, ChannelNameRouter
 
-from composer import consumers
+from composer import consumers, FOLKRNN_MODEL_CHANNELS
 
 application = ProtocolTypeRouter({
     # Empty for now (http->django views is added by default)
     'websocket': consumers.ComposerConsumer,
     'channel': ChannelNameRouter({
         'folk_rnn': consumers.FolkRNNConsumer,
+        'folk_rnn_post': consumers.FolkRNNPostConsumer,
+        **{consumers.model_channel(x): consumers.FolkRNNConsumer for x in FOLKRNN_MODEL_CHANNELS},
         })
 })
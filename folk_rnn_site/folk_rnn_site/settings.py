@@ -75,6 +75,10 @@ CHANNEL_LAYERS = {
         'BACKEND': 'channels_redis.core.RedisChannelLayer',
         'CONFIG': {
             'hosts': [('localhost', 6379)],
+            # A model's own channel is kept short, so requests overflow to the shared folk_rnn channel. See FOLKRNN_MODEL_CHANNELS
+            'channel_capacity': {
+                'folk_rnn.*': 10,
+            },
         },
     },
 }
@@ -111,11 +111,15 @@ cat ./tools/systemd/daphne.service \
 > /etc/systemd/system/daphne.service
 
 cp ./tools/systemd/worker-folkrnn@.service /etc/systemd/system/worker-folkrnn@.service
+cp ./tools/systemd/worker-folkrnn-model@.service /etc/systemd/system/worker-folkrnn-model@.service
+cp ./tools/systemd/worker-folkrnn-pool.service /etc/systemd/system/worker-folkrnn-pool.service # Sharing models between workers, rather than worker-folkrnn@
+cp ./tools/systemd/worker-folkrnn-post.service /etc/systemd/system/worker-folkrnn-post.service
 cp ./tools/systemd/folkrnn-backup.service /etc/systemd/system/folkrnn-backup.service
 cp ./tools/systemd/folkrnn-backup.timer /etc/systemd/system/folkrnn-backup.timer
 
 systemctl enable nginx
 systemctl enable daphne
 systemctl enable redis-server
-systemctl enable worker-folkrnn\@{1..1} # Worker numbers should scale with CPU cores.
+systemctl enable worker-folkrnn-pool # A worker per CPU core, also requeuing lost tunes and refilling the tune pool.
+systemctl enable worker-folkrnn-post
 systemctl enable --now folkrnn-backup.timer # Now as `runserver` won't start it.
\ No newline at end of file